@@ -0,0 +1,160 @@
+"""Memory and delivery latency of the result cache with and without compression.
+
+Fills a cache with a realistic mix of `_search` responses (mostly aggregations, some hit lists
+of transactions) and measures the RSS growth and the latency of delivering cached entries.
+Every store is measured in a fresh process, so that RSS numbers do not influence each other.
+
+Usage:
+    python benchmarks/cache_compression.py --entries 20000
+"""
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import click
+
+from ethevents.server.backend import Resource
+from ethevents.server.cache import ResourceCache
+from ethevents.server.compression import CompressedContent, get_codec
+
+STORES = ['dict', 'lru', 'gzip', 'gzip-passthrough', 'zstd']
+
+
+def random_hex(rng: random.Random, num_bytes: int) -> str:
+    return '0x' + ''.join('{:02x}'.format(rng.getrandbits(8)) for _ in range(num_bytes))
+
+
+def tx_hit(rng: random.Random) -> dict:
+    block = rng.randint(4000000, 5000000)
+    return {
+        '_index': 'ethereum_2',
+        '_type': 'tx',
+        '_id': random_hex(rng, 32),
+        '_score': None,
+        '_routing': random_hex(rng, 32),
+        '_source': {
+            'blockHash': random_hex(rng, 32),
+            'blockNumber': {'num': block, 'raw': hex(block)},
+            'from': random_hex(rng, 20),
+            'to': random_hex(rng, 20),
+            'gas': {'num': 21000, 'raw': '0x5208'},
+            'gasPrice': {'num': 20000000000, 'raw': '0x4a817c800'},
+            'hash': random_hex(rng, 32),
+            'input': '0x',
+            'nonce': {'num': rng.randint(0, 1000), 'raw': '0x0'},
+            'timestamp': '2018-01-0{}T12:00:00'.format(rng.randint(1, 9)),
+            'value': {'num': rng.randint(0, 10 ** 18), 'raw': '0x0'},
+        },
+        'sort': [block],
+    }
+
+
+def search_response(rng: random.Random) -> dict:
+    kind = rng.random()
+    response = {
+        'took': rng.randint(1, 3000),
+        'timed_out': False,
+        '_shards': {'total': 5, 'successful': 5, 'skipped': 0, 'failed': 0},
+        'hits': {'total': rng.randint(0, 10 ** 7), 'max_score': None, 'hits': []},
+    }
+    if kind < 0.6:
+        # Aggregations only, like the example queries.
+        response['aggregations'] = {
+            'gas_price_histogram': {'buckets': [
+                {'key': i * 10 ** 9, 'doc_count': rng.randint(1, 10 ** 5)}
+                for i in range(rng.randint(5, 100))
+            ]},
+            'gasprice_stats': {
+                'count': 1000, 'min': 1.0, 'max': 10.0 ** 11, 'avg': 2.1 * 10 ** 10,
+                'sum': 2.1 * 10 ** 13, 'sum_of_squares': 1.0 * 10 ** 24,
+                'variance': 1.0 * 10 ** 20, 'std_deviation': 1.0 * 10 ** 10,
+            },
+        }
+    elif kind < 0.9:
+        response['hits']['hits'] = [tx_hit(rng) for _ in range(10)]
+    else:
+        response['hits']['hits'] = [tx_hit(rng) for _ in range(100)]
+    return response
+
+
+def rss() -> int:
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+def deliver(content) -> bytes:
+    if isinstance(content, CompressedContent):
+        return content.decompress()
+    return json.dumps(content).encode('utf-8')
+
+
+def run_store(store: str, entries: int, reads: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    responses = [search_response(rng) for _ in range(entries)]
+    serialized = [json.dumps(response) for response in responses]
+    del responses
+
+    baseline = rss()
+    if store == 'dict':
+        cache = dict()
+        for key, data in enumerate(serialized):
+            cache[key] = Resource(content=json.loads(data), price=1, expires_at=float('inf'))
+    else:
+        codec = get_codec(store.split('-')[0]) if store != 'lru' else None
+        cache = ResourceCache(max_bytes=10 ** 12, codec=codec)
+        for key, data in enumerate(serialized):
+            # Contents are cached as they come out of the client, i.e. decoded.
+            cache.put(key, Resource(content=json.loads(data), price=1, expires_at=float('inf')))
+    memory = rss() - baseline
+
+    latencies = []
+    for _ in range(reads):
+        key = rng.randrange(entries)
+        start = time.perf_counter()
+        content = cache.get(key).content
+        if store == 'gzip-passthrough':
+            body = content.data
+        else:
+            body = deliver(content)
+        assert body
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return dict(
+        store=store,
+        rss_mb=memory / 1024 ** 2,
+        p50_us=latencies[len(latencies) // 2] * 10 ** 6,
+        p99_us=latencies[int(len(latencies) * 0.99)] * 10 ** 6,
+    )
+
+
+@click.command()
+@click.option('--entries', default=20000, help='Number of cached responses')
+@click.option('--reads', default=20000, help='Number of deliveries to time')
+@click.option('--seed', default=0)
+@click.option('--store', default=None, type=click.Choice(STORES), help='Run only this store')
+def main(entries: int, reads: int, seed: int, store: str):
+    if store is not None:
+        print(json.dumps(run_store(store, entries, reads, seed)))
+        return
+
+    print('{:<18} {:>10} {:>10} {:>10}'.format('store', 'RSS [MB]', 'p50 [us]', 'p99 [us]'))
+    for store in STORES:
+        output = subprocess.check_output(
+            [
+                sys.executable, os.path.abspath(__file__),
+                '--entries', str(entries),
+                '--reads', str(reads),
+                '--seed', str(seed),
+                '--store', store,
+            ]
+        )
+        result = json.loads(output.decode('utf-8').strip().split('\n')[-1])
+        print('{store:<18} {rss_mb:>10.1f} {p50_us:>10.1f} {p99_us:>10.1f}'.format(**result))
+
+
+if __name__ == '__main__':
+    main()
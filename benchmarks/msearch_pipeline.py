@@ -0,0 +1,119 @@
+"""Preparation of `_msearch` bodies for Elasticsearch, before and after streaming the lines.
+
+Builds NDJSON `_msearch` bodies of typical log queries and measures the time from the request
+body to the body forwarded to Elasticsearch: splitting, parsing, sanitizing and adding the
+time budget of each search. The previous pipeline decoded the whole body and serialized every
+line again, the streaming one parses each line once and forwards the original bytes.
+
+Usage:
+    python benchmarks/msearch_pipeline.py --lines 1000
+"""
+import json
+import random
+import statistics
+import time
+from typing import Callable
+
+import click
+from flask import abort
+
+from ethevents.server import msearch
+from ethevents.server.backend import msearch_lines, split_msearch
+
+LIMITS = {'timeout': '60000ms'}
+
+
+def random_hex(rng: random.Random, num_bytes: int) -> str:
+    return '0x' + ''.join('{:02x}'.format(rng.getrandbits(8)) for _ in range(num_bytes))
+
+
+def log_search(rng: random.Random) -> dict:
+    block = rng.randint(4000000, 5000000)
+    return {
+        'query': {'bool': {'must': [
+            {'term': {'address': random_hex(rng, 20)}},
+            {'terms': {'topics': [random_hex(rng, 32) for _ in range(rng.randint(1, 3))]}},
+            {'range': {'blockNumber.num': {'gte': block, 'lte': block + 10000}}},
+        ]}},
+        'sort': [{'blockNumber.num': 'desc'}],
+        'size': rng.choice([0, 10, 100]),
+    }
+
+
+def msearch_body(rng: random.Random, lines: int) -> bytes:
+    ndjson = []
+    for _ in range(lines // 2):
+        ndjson.append(json.dumps({'index': rng.choice(['ethereum', 'abi']), 'type': 'log'}))
+        ndjson.append(json.dumps(log_search(rng)))
+    return '\n'.join(ndjson + ['']).encode('utf-8')
+
+
+def previous_sanitize(kwargs):
+    """`sanitize` of the previous pipeline, before searches were validated."""
+    result = dict()
+    for key, value in kwargs.items():
+        if key == 'index':
+            if value not in ('ethereum', 'abi'):
+                result[key] = 'ethereum'
+            else:
+                result[key] = value
+        elif key == 'body':
+            body_content = json.dumps(value)
+            if 'script' in body_content and 'lang' in body_content:
+                abort(405)
+            result['body'] = value
+        else:
+            result[key] = value
+    return result
+
+
+def previous_pipeline(data: bytes) -> bytes:
+    lines = [json.loads(line) for line in data.decode('utf-8').split('\n') if line.strip()]
+    new_body = []
+    for header, body in zip(lines[0::2], lines[1::2]):
+        new_body.append(json.dumps(previous_sanitize(header)))
+        new_body.append(json.dumps(dict(previous_sanitize(dict(body=body))['body'], **LIMITS)))
+    return '\n'.join(new_body + ['']).encode('utf-8')
+
+
+def streaming_pipeline(data: bytes) -> bytes:
+    new_body = []
+    for search in split_msearch(data):
+        new_body.extend(msearch_lines(search, LIMITS))
+    return b'\n'.join(new_body + [b''])
+
+
+def measure(pipeline: Callable[[bytes], bytes], data: bytes, repeat: int) -> dict:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pipeline(data)
+        durations.append(time.perf_counter() - start)
+    return dict(
+        p50_ms=statistics.median(durations) * 1000,
+        min_ms=min(durations) * 1000,
+    )
+
+
+@click.command()
+@click.option('--lines', default=1000, help='NDJSON lines per _msearch body')
+@click.option('--repeat', default=200, help='Number of timed runs per pipeline')
+@click.option('--seed', default=0)
+def main(lines: int, repeat: int, seed: int):
+    data = msearch_body(random.Random(seed), lines)
+    # Both pipelines must forward the same searches.
+    previous = [json.loads(line) for line in previous_pipeline(data).splitlines()]
+    assert previous == [json.loads(line) for line in streaming_pipeline(data).splitlines()]
+    print('{} lines, {:.1f} kB, JSON parser: {}'.format(
+        lines,
+        len(data) / 1024,
+        'orjson' if msearch.orjson is not None else 'json'
+    ))
+    print('{:<12} {:>10} {:>10}'.format('pipeline', 'p50 [ms]', 'min [ms]'))
+    for name, pipeline in (('previous', previous_pipeline), ('streaming', streaming_pipeline)):
+        result = measure(pipeline, data, repeat)
+        print('{name:<12} {p50_ms:>10.2f} {min_ms:>10.2f}'.format(name=name, **result))
+
+
+if __name__ == '__main__':
+    main()
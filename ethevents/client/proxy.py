@@ -18,6 +18,10 @@ log = logging.getLogger(__name__)
 
 monkey.patch_all(thread=False)
 
+# Headers describing the body as it was transferred. `requests` decodes the body, so they do
+# not apply to the forwarded one.
+TRANSFER_HEADERS = ('content-length', 'content-encoding', 'transfer-encoding')
+
 
 class Forwarder(Resource):
     def __init__(self, session: Session, base_url='http://localhost', semaphore=None):
@@ -45,7 +49,7 @@ class Forwarder(Resource):
             )
             forwarded_headers = {
                 header: value for header, value in response.headers.items()
-                if 'content-length' not in header.lower()
+                if header.lower() not in TRANSFER_HEADERS
             }
             content = response.text
             log.debug('content {}'.format(content))
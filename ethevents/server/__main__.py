@@ -2,15 +2,27 @@ from gevent import monkey
 monkey.patch_all()
 import os
 import sys
+from typing import Tuple
+
 import click
+import gevent
 
 from microraiden.click_helpers import main, pass_app
 from microraiden.proxy.paywalled_proxy import PaywalledProxy
 
-from elasticsearch import Elasticsearch
-
+from ethevents.server.addresses import AddressIndex
 from ethevents.server.api_server import APIServer
 from ethevents.server.backend import ElasticsearchBackend
+from ethevents.server.blocks import BlockTracker
+from ethevents.server.breaker import CircuitBreaker
+from ethevents.server.cache import DEFAULT_CACHE_SIZE, AdmissionCache
+from ethevents.server.cancellation import DEFAULT_DEADLINES
+from ethevents.server.compression import CODECS, get_codec
+from ethevents.server.es_pool import connect
+from ethevents.server.joins import JoinIndex
+from ethevents.server.limiter import AdaptiveLimiter, ConcurrencyLimiter
+from ethevents.server.mappings import MappingStore
+from ethevents.server.shared_cache import RedisCache, SqliteCache, TieredCache
 
 import logging
 
@@ -28,19 +40,324 @@ import logging
 )
 @click.option(
     '--elasticsearch',
-    default='https://es1.eth.events',
+    default=['https://es1.eth.events'],
+    multiple=True,
+    help='Elasticsearch node URL, can be given several times'
+)
+@click.option(
+    '--es-sniff/--no-es-sniff',
+    default=False,
+    help='Discover the other nodes of the Elasticsearch cluster'
+)
+@click.option(
+    '--es-hedge/--no-es-hedge',
+    default=True,
+    help='Send slow read requests to a second node as well and use the first answer'
+)
+@click.option(
+    '--cache-size',
+    default=DEFAULT_CACHE_SIZE,
+    help='Byte budget of the result cache'
+)
+@click.option(
+    '--cache-path',
+    default=None,
+    help='Path of a sqlite result cache shared by all server processes on this host'
+)
+@click.option(
+    '--cache-redis',
+    default=None,
+    help='URL of a Redis compatible server for a result cache shared by all server processes'
+)
+@click.option(
+    '--cache-disk',
+    default=None,
+    help='Path of a sqlite database keeping finalized results across restarts'
+)
+@click.option(
+    '--cache-disk-size',
+    default=8 * 1024 ** 3,
+    help='Byte budget of the on-disk result cache'
+)
+@click.option(
+    '--warm-up',
+    default=1000,
+    help='Number of the most requested results to load from the on-disk cache on start'
+)
+@click.option(
+    '--cache-compression',
+    default='none',
+    type=click.Choice(['none'] + sorted(CODECS)),
+    help='Compression of cached results, zstd falls back to gzip if unavailable'
+)
+@click.option(
+    '--raw-responses/--no-raw-responses',
+    default=False,
+    help='Keep and deliver raw Elasticsearch response bodies instead of decoding them'
+)
+@click.option(
+    '--block-poll-interval',
+    default=5.0,
+    help='Seconds between checks for newly indexed blocks, cached results over blocks that are '
+         'not final yet are invalidated by new blocks'
+)
+@click.option(
+    '--finality-split/--no-finality-split',
+    default=True,
+    help='Split range queries into a cached finalized part and a live tail'
+)
+@click.option(
+    '--es-concurrency',
+    default=16,
+    help='Maximum number of concurrent Elasticsearch queries, the initial one if adaptive'
+)
+@click.option(
+    '--es-adaptive-concurrency/--no-es-adaptive-concurrency',
+    default=True,
+    help='Adapt the number of concurrent Elasticsearch queries to observed latencies'
+)
+@click.option(
+    '--es-max-concurrency',
+    default=256,
+    help='Upper bound of the adaptive number of concurrent Elasticsearch queries'
+)
+@click.option(
+    '--es-queue-size',
+    default=128,
+    help='Maximum number of queries waiting for Elasticsearch, further ones get a 503'
+)
+@click.option(
+    '--es-queue-deadline',
+    default=10.0,
+    help='Seconds a query may wait for Elasticsearch before it gets a 503'
+)
+@click.option(
+    '--search-deadline',
+    default=DEFAULT_DEADLINES['_search'],
+    help='Seconds a _search may take, including queueing, before it returns partial results'
+)
+@click.option(
+    '--msearch-deadline',
+    default=DEFAULT_DEADLINES['_msearch'],
+    help='Seconds a _msearch may take, including queueing, before it returns partial results'
+)
+@click.option(
+    '--mapping-deadline',
+    default=DEFAULT_DEADLINES['_mapping'],
+    help='Seconds a _mapping request may take, including queueing'
+)
+@click.option(
+    '--mapping-refresh-interval',
+    default=3600.0,
+    help='Seconds between refreshes of the index mappings, which are served from memory'
+)
+@click.option(
+    '--mapping-dir',
+    default=None,
+    type=click.Path(exists=True, file_okay=False),
+    help='Directory of mapping files (like docs/mappings) to serve until Elasticsearch answers'
+)
+@click.option(
+    '--es-terminate-after',
+    default=None,
+    type=int,
+    help='Maximum number of documents a search collects per shard'
+)
+@click.option(
+    '--optimize-queries/--no-optimize-queries',
+    default=True,
+    help='Rewrite search bodies into cheaper equivalents before executing them'
+)
+@click.option(
+    '--join-index/--no-join-index',
+    default=False,
+    help='Replace joins of transactions or blocks with their logs by filters on precomputed '
+         'parents'
+)
+@click.option(
+    '--join-refresh-interval',
+    default=60.0,
+    help='Seconds between updates of the precomputed joins with newly finalized blocks'
+)
+@click.option(
+    '--join-max-transactions',
+    default=500000,
+    help='Number of transaction hashes held for the precomputed joins'
+)
+@click.option(
+    '--address-index/--no-address-index',
+    default=False,
+    help='Answer searches for the latest transactions of an address with the ones held in '
+         'memory'
+)
+@click.option(
+    '--address-history',
+    default=100,
+    help='Number of the latest transactions held per address'
+)
+@click.option(
+    '--boost-deposit',
+    default=None,
+    type=int,
+    help='Channel deposit from which senders get a larger share of Elasticsearch'
+)
+@click.option(
+    '--deposit-boost',
+    default=2.0,
+    help='Scheduling weight of senders with at least --boost-deposit, others have weight 1'
+)
+@click.option(
+    '--stale-ttl',
+    default=60.0,
+    help='Seconds an expired result is still served (marked stale) while it is refreshed'
+)
+@click.option(
+    '--price-grace',
+    default=30.0,
+    help='Seconds a priced result is still delivered to the paid request after a new block'
+)
+@click.option(
+    '--breaker-error-rate',
+    default=0.5,
+    help='Share of failing Elasticsearch queries that opens the circuit breaker'
+)
+@click.option(
+    '--breaker-latency',
+    default=10.0,
+    help='Median Elasticsearch query latency in seconds that opens the circuit breaker'
 )
 @pass_app
-def start(app: PaywalledProxy, host: str, port: int, elasticsearch: str):
+def start(
+        app: PaywalledProxy,
+        host: str,
+        port: int,
+        elasticsearch: Tuple[str],
+        es_sniff: bool,
+        es_hedge: bool,
+        cache_size: int,
+        cache_path: str,
+        cache_redis: str,
+        cache_disk: str,
+        cache_disk_size: int,
+        warm_up: int,
+        cache_compression: str,
+        raw_responses: bool,
+        block_poll_interval: float,
+        finality_split: bool,
+        es_concurrency: int,
+        es_adaptive_concurrency: bool,
+        es_max_concurrency: int,
+        es_queue_size: int,
+        es_queue_deadline: float,
+        search_deadline: float,
+        msearch_deadline: float,
+        mapping_deadline: float,
+        mapping_refresh_interval: float,
+        mapping_dir: str,
+        es_terminate_after: int,
+        optimize_queries: bool,
+        join_index: bool,
+        join_refresh_interval: float,
+        join_max_transactions: int,
+        address_index: bool,
+        address_history: int,
+        boost_deposit: int,
+        deposit_boost: float,
+        stale_ttl: float,
+        price_grace: float,
+        breaker_error_rate: float,
+        breaker_latency: float
+):
     auth = os.environ.get('ES_CREDENTIALS')
     if auth is None:
         print('Please provide elasticsearch credentials via ES_CREDENTIALS environment.')
         sys.exit(1)
-    elasticsearch_connection = Elasticsearch(elasticsearch, timeout=30, http_auth=auth)
-    backend = ElasticsearchBackend(elasticsearch_connection)
-    APIServer(app, backend)
+    elasticsearch_connection = connect(
+        list(elasticsearch),
+        sniff=es_sniff,
+        hedge=es_hedge,
+        # One keep-alive connection per concurrent query.
+        pool_size=es_max_concurrency if es_adaptive_concurrency else es_concurrency,
+        timeout=30,
+        http_auth=auth
+    )
+    codec = get_codec(cache_compression)
+    if cache_redis is not None:
+        cache = RedisCache(cache_redis, codec=codec, stale_ttl=stale_ttl)
+    elif cache_path is not None:
+        cache = SqliteCache(cache_path, max_bytes=cache_size, codec=codec, stale_ttl=stale_ttl)
+    else:
+        cache = AdmissionCache(max_bytes=cache_size, codec=codec, stale_ttl=stale_ttl)
+    if cache_disk is not None:
+        cache = TieredCache(cache, SqliteCache(cache_disk, max_bytes=cache_disk_size, codec=codec))
+        gevent.spawn(cache.warm_up, warm_up)
+    block_tracker = BlockTracker(elasticsearch_connection, poll_interval=block_poll_interval)
+    block_tracker.start()
+    mappings = MappingStore(elasticsearch_connection, refresh_interval=mapping_refresh_interval)
+    if mapping_dir is not None:
+        mappings.load_directory(mapping_dir)
+    mappings.start()
+    joins = None
+    if join_index:
+        joins = JoinIndex(
+            elasticsearch_connection,
+            block_tracker,
+            refresh_interval=join_refresh_interval,
+            max_transactions=join_max_transactions
+        )
+        joins.start()
+    addresses = None
+    if address_index:
+        addresses = AddressIndex(elasticsearch_connection, block_tracker, history=address_history)
+        addresses.start()
+    backend = ElasticsearchBackend(
+        elasticsearch_connection,
+        raw_responses=raw_responses,
+        block_tracker=block_tracker,
+        historic_cache=cache if finality_split else None,
+        deadlines=dict(
+            DEFAULT_DEADLINES,
+            _search=search_deadline,
+            _msearch=msearch_deadline,
+            _mapping=mapping_deadline
+        ),
+        terminate_after=es_terminate_after,
+        optimize_queries=optimize_queries,
+        join_index=joins,
+        address_index=addresses
+    )
+    if es_adaptive_concurrency:
+        limiter = AdaptiveLimiter(
+            initial_limit=es_concurrency,
+            max_limit=es_max_concurrency,
+            max_queue=es_queue_size,
+            queue_deadline=es_queue_deadline
+        )
+    else:
+        limiter = ConcurrencyLimiter(
+            max_concurrency=es_concurrency,
+            max_queue=es_queue_size,
+            queue_deadline=es_queue_deadline
+        )
+    APIServer(
+        app,
+        backend,
+        cache=cache,
+        limiter=limiter,
+        boost_deposit=boost_deposit,
+        deposit_boost=deposit_boost,
+        breaker=CircuitBreaker(
+            error_threshold=breaker_error_rate,
+            latency_threshold=breaker_latency
+        ),
+        stale_ttl=stale_ttl,
+        price_grace=price_grace,
+        mappings=mappings
+    )
     app.run(host=host, port=port, debug=True)
     app.join()
+    if cache_disk is not None:
+        cache.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,383 @@
+"""Recent transactions of addresses, held in memory.
+
+Searches for the transactions from or to an address (e.g. `last_transactions_to`) are among
+the most frequent ones. For the addresses of recent paid searches, the hashes and block numbers of
+their latest transactions are kept in a ring buffer, with the number of all their
+transactions. Like the joins, only finalized blocks are held; the index is updated whenever
+the block tracker sees a new block.
+
+A search for the latest transactions of an address (sorted by block number, descending) is
+rewritten to fetch the held transactions that can be among its hits by `ids`, plus the
+transactions in blocks above the held ones. Elasticsearch only sorts these few transactions,
+and the total of the response is corrected by the number of held transactions left out. A
+search without hits only counts the transactions in the newer blocks. Searches reaching
+deeper than the held transactions are left as they are, and so are searches sorted by score
+like `tx/by_from_or_to_address.json`: Elasticsearch breaks ties of equal scores in index order,
+so only their counting form (`size` 0) is rewritten.
+"""
+import binascii
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import gevent
+from elasticsearch.helpers import scan
+
+from ethevents.config import ETH_INDEX, TX
+from .blocks import BlockTracker
+from .finality import as_list
+from .joins import BLOCK_NUMBER_FIELD, term_keys
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Which side of a transaction an address is on, as bits.
+FROM = 1
+TO = 2
+SIDES = {'from': FROM, 'to': TO}
+HASH_SIZE = 32
+# Search parameters that do not depend on anything but the hits.
+HITS_PARAMS = frozenset([
+    'query', 'sort', 'size', 'from', '_source', 'stored_fields', 'docvalue_fields', 'version',
+])
+SOURCE_FIELDS = ['hash', 'from', 'to', BLOCK_NUMBER_FIELD]
+
+# A rewritten search: the body to execute and the number of transactions to add to its total.
+AddressSearch = namedtuple('AddressSearch', ['body', 'omitted'])
+
+
+def address_query(query: Any) -> Optional[Tuple[str, int]]:
+    """The address and the sides (`FROM` and/or `TO`) it must be on for a transaction to
+    match `query`, `None` if `query` is not such a query."""
+    if not isinstance(query, dict) or len(query) != 1:
+        return None
+    ((clause_type, params), ) = query.items()
+    if not isinstance(params, dict):
+        return None
+    if clause_type == 'multi_match':
+        fields = params.get('fields')
+        if set(params) != {'query', 'fields'} or not isinstance(params['query'], str):
+            return None
+        if not isinstance(fields, list) or not fields or not set(fields) <= set(SIDES):
+            return None
+        sides = 0
+        for field in fields:
+            sides |= SIDES[field]
+        return params['query'], sides
+    if clause_type == 'bool':
+        clauses = [clause for value in params.values() for clause in as_list(value)]
+        if set(params) <= {'filter', 'must'} and len(clauses) == 1:
+            return address_query(clauses[0])
+        if 'should' not in params or params.get('minimum_should_match', 1) != 1:
+            return None
+        if not set(params) <= {'should', 'minimum_should_match'}:
+            return None
+        found = [address_query(clause) for clause in as_list(params['should'])]
+        if not found or None in found or len({address for address, _ in found}) != 1:
+            return None
+        sides = 0
+        for _, side in found:
+            sides |= side
+        return found[0][0], sides
+    keys = term_keys(query, SIDES)
+    if keys is None or len({value for _, value in keys}) != 1:
+        return None
+    sides = 0
+    for field, _ in keys:
+        sides |= SIDES[field]
+    return keys[0][1], sides
+
+
+def sorted_by_block(sort: Any) -> bool:
+    """Whether `sort` sorts by block number, latest first."""
+    items = as_list(sort)
+    if len(items) != 1 or not isinstance(items[0], dict) or len(items[0]) != 1:
+        return False
+    ((field, order), ) = items[0].items()
+    if isinstance(order, dict):
+        order = order.get('order') if list(order) == ['order'] else None
+    return field == BLOCK_NUMBER_FIELD and order == 'desc'
+
+
+def hits_window(body: Dict, params: Dict) -> Optional[int]:
+    """`from` + `size` of a search, URL parameters take precedence."""
+    try:
+        return int(params.get('from', body.get('from', 0))) + int(
+            params.get('size', body.get('size', 10))
+        )
+    except (TypeError, ValueError):
+        return None
+
+
+class Activity(object):
+    """The latest transactions of an address in a ring buffer, oldest first, and the numbers
+    of all its transactions (by sides) up to block `height`."""
+    __slots__ = ('capacity', 'hashes', 'blocks', 'sides', 'start', 'counts', 'height')
+
+    def __init__(self, capacity: int, height: int):
+        self.capacity = capacity
+        # 32 bytes per transaction hash
+        self.hashes = bytearray()
+        self.blocks = array('I')
+        self.sides = bytearray()
+        # position of the oldest transaction once the buffer is full
+        self.start = 0
+        # sides => number of transactions with the address on any of these sides
+        self.counts = [0, 0, 0, 0]
+        self.height = height
+
+    def __len__(self) -> int:
+        return len(self.blocks)
+
+    def add(self, tx_hash: str, block: int, sides: int):
+        """Add a transaction, newer than all held ones."""
+        data = binascii.unhexlify(tx_hash[2:])
+        if len(data) != HASH_SIZE:
+            raise ValueError('Invalid transaction hash {}'.format(tx_hash))
+        if len(self) < self.capacity:
+            self.hashes.extend(data)
+            self.blocks.append(block)
+            self.sides.append(sides)
+        else:
+            position = self.start
+            self.hashes[position * HASH_SIZE:(position + 1) * HASH_SIZE] = data
+            self.blocks[position] = block
+            self.sides[position] = sides
+            self.start = (position + 1) % self.capacity
+        for query_sides in (FROM, TO, FROM | TO):
+            if sides & query_sides:
+                self.counts[query_sides] += 1
+
+    def latest(self) -> Iterator[Tuple[int, int]]:
+        """(position, block number) of the held transactions, latest first."""
+        for offset in range(len(self)):
+            position = (self.start - 1 - offset) % len(self)
+            yield position, self.blocks[position]
+
+    def tx_hash(self, position: int) -> str:
+        data = self.hashes[position * HASH_SIZE:(position + 1) * HASH_SIZE]
+        return '0x' + binascii.hexlify(data).decode('ascii')
+
+    def candidates(self, sides: int, window: int) -> Optional[List[str]]:
+        """The hashes of all held transactions with the address on `sides` that can be among
+        the latest `window` ones, `None` if some of these are not held anymore."""
+        complete = self.counts[FROM | TO] == len(self)
+        found = []
+        boundary = None
+        for position, block in self.latest():
+            if not self.sides[position] & sides:
+                continue
+            if boundary is not None and block < boundary:
+                break
+            found.append(position)
+            if len(found) == window:
+                # Others in the same block can be sorted before the last one.
+                boundary = block
+        else:
+            if not complete and (boundary is None or boundary <= self.blocks[self.start]):
+                # The oldest block held may be missing transactions.
+                return None
+        return [self.tx_hash(position) for position in found]
+
+
+class AddressIndex(object):
+    """Recent transactions of the addresses searched for, loaded on demand and updated as
+    blocks become final.
+
+    Up to `history` transactions are held for each of at most `max_addresses` addresses, the
+    least recently used ones are dropped first. At most `max_pending` addresses are loaded at
+    a time, further requests are dropped.
+    """
+
+    def __init__(
+            self,
+            es,
+            block_tracker: BlockTracker,
+            history: int = 100,
+            max_addresses: int = 10000,
+            max_pending: int = 10
+    ):
+        self.es = es
+        self.block_tracker = block_tracker
+        self.history = history
+        self.max_addresses = max_addresses
+        self.max_pending = max_pending
+        # address => Activity, least recently used first
+        self.activities = OrderedDict()
+        # addresses being loaded
+        self.pending = set()
+        self.updated_at = None
+        self.updating = None
+
+    def store(self, address: str, activity: Activity):
+        self.activities[address] = activity
+        self.activities.move_to_end(address)
+        while len(self.activities) > self.max_addresses:
+            self.activities.popitem(last=False)
+
+    def load(self, address: str):
+        """Load the latest transactions of `address` in finalized blocks."""
+        height = self.block_tracker.finalized_height
+        if height is None:
+            return
+        response = self.es.search(index=ETH_INDEX, doc_type=TX, body={
+            'query': {'bool': {
+                'should': [{'term': {'from': address}}, {'term': {'to': address}}],
+                'minimum_should_match': 1,
+                'filter': [{'range': {BLOCK_NUMBER_FIELD: {'lte': height}}}],
+            }},
+            'size': self.history,
+            'sort': [{BLOCK_NUMBER_FIELD: 'desc'}],
+            '_source': SOURCE_FIELDS,
+            'aggs': {
+                'from': {'filter': {'term': {'from': address}}},
+                'to': {'filter': {'term': {'to': address}}},
+            },
+        })
+        activity = Activity(self.history, height)
+        for hit in reversed(response['hits']['hits']):
+            source = hit['_source']
+            sides = 0
+            for field, side in SIDES.items():
+                if source.get(field) == address:
+                    sides |= side
+            activity.add(source['hash'], int(source['blockNumber']['num']), sides)
+        activity.counts[FROM] = response['aggregations']['from']['doc_count']
+        activity.counts[TO] = response['aggregations']['to']['doc_count']
+        activity.counts[FROM | TO] = response['hits']['total']
+        self.store(address, activity)
+
+    def run_load(self, address: str, run: Callable = None):
+        try:
+            if run is None:
+                self.load(address)
+            else:
+                run(self.load, address)
+        except Exception as e:
+            log.warning('Could not load the transactions of {}: {}'.format(address, e))
+        finally:
+            self.pending.discard(address)
+
+    def request(self, address: str, run: Callable = None):
+        """Load `address` in the background, by `run(load, address)` if given (e.g. through a
+        limiter)."""
+        if address not in self.pending and len(self.pending) < self.max_pending:
+            self.pending.add(address)
+            gevent.spawn(self.run_load, address, run)
+
+    def update(self) -> bool:
+        """Add the transactions of newly finalized blocks, return whether that succeeded."""
+        height = self.block_tracker.finalized_height
+        # Addresses loaded meanwhile are updated next time.
+        behind = {
+            address: activity for address, activity in self.activities.items()
+            if activity.height < height
+        } if height is not None else {}
+        if not behind:
+            return True
+        above = min(activity.height for activity in behind.values())
+        body = {
+            'query': {'range': {BLOCK_NUMBER_FIELD: {'gt': above, 'lte': height}}},
+            '_source': SOURCE_FIELDS,
+        }
+        try:
+            txs = [
+                hit['_source']
+                for hit in scan(self.es, query=body, index=ETH_INDEX, doc_type=TX, size=5000)
+            ]
+        except Exception as e:
+            log.warning('Could not update the transactions of addresses: {}'.format(e))
+            return False
+        txs.sort(key=lambda source: int(source['blockNumber']['num']))
+        for source in txs:
+            block = int(source['blockNumber']['num'])
+            sides = dict()
+            for field, side in SIDES.items():
+                if source.get(field) in behind:
+                    sides[source[field]] = sides.get(source[field], 0) | side
+            for address, side in sides.items():
+                activity = behind[address]
+                if block > activity.height and self.activities.get(address) is activity:
+                    activity.add(source['hash'], block, side)
+        for activity in behind.values():
+            activity.height = height
+        self.updated_at = time.time()
+        return True
+
+    def on_block(self, height: int):
+        """Block tracker listener."""
+        if self.updating is None or self.updating.ready():
+            self.updating = gevent.spawn(self.update)
+
+    def searched(self, body: Any, params: Dict = None) -> Optional[Tuple[str, int, int]]:
+        """The address, the sides it is searched on and the number of hits of a search the
+        transactions held for the address can answer, `None` if it is not such a search."""
+        params = params or {}
+        if not isinstance(body, dict) or not set(body) <= HITS_PARAMS:
+            return None
+        found = address_query(body.get('query'))
+        window = hits_window(body, params)
+        if found is None or window is None:
+            return None
+        if window > 0 and not sorted_by_block(body.get('sort')):
+            return None
+        address, sides = found
+        return address, sides, window
+
+    def wanted(self, body: Any, params: Dict = None) -> List[str]:
+        """The address of a search with `body` if it is not held (or being loaded) yet."""
+        searched = self.searched(body, params)
+        if searched is None:
+            return []
+        address = searched[0]
+        if address in self.activities or address in self.pending:
+            return []
+        return [address]
+
+    def rewrite(self, body: Any, params: Dict = None) -> Optional[AddressSearch]:
+        """A search of transactions with the same hits as a search with `body` (and the URL
+        parameters `params`), `None` if the transactions held can not answer it."""
+        searched = self.searched(body, params)
+        if searched is None:
+            return None
+        address, sides, window = searched
+        activity = self.activities.get(address)
+        if activity is None:
+            return None
+        self.activities.move_to_end(address)
+        candidates = activity.candidates(sides, window) if window else []
+        if candidates is None:
+            return None
+        tail = {'bool': {'filter': [
+            body['query'],
+            {'range': {BLOCK_NUMBER_FIELD: {'gt': activity.height}}},
+        ]}}
+        query = tail
+        if candidates:
+            query = {'bool': {
+                'should': [{'ids': {'type': TX, 'values': candidates}}, tail],
+                'minimum_should_match': 1,
+            }}
+        return AddressSearch(
+            body=dict(body, query=query),
+            omitted=activity.counts[sides] - len(candidates)
+        )
+
+    def start(self):
+        self.block_tracker.listeners.append(self.on_block)
+
+    def stop(self):
+        if self.on_block in self.block_tracker.listeners:
+            self.block_tracker.listeners.remove(self.on_block)
+        if self.updating is not None:
+            self.updating.kill()
+            self.updating = None
+
+    def stats(self) -> Dict:
+        return dict(
+            addresses=len(self.activities),
+            transactions=sum(len(activity) for activity in self.activities.values()),
+            updated_at=self.updated_at,
+        )
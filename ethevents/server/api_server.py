@@ -1,82 +1,441 @@
 import time
-from typing import Dict
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
+import gevent
 from flask import request, abort
-from flask import jsonify
-from gevent.threading import Lock
+from flask import copy_current_request_context, jsonify, Response
+from flask_restful import Resource as RestResource
 
+from microraiden import HTTPHeaders
+from microraiden.constants import API_PATH
+from microraiden.proxy.resources.login import auth
 from microraiden.proxy.resources.expensive import Expensive
 from microraiden.proxy.paywalled_proxy import PaywalledProxy
-from .backend import ElasticsearchBackend, Resource
+from . import canonical
+from .backend import (
+    ElasticsearchBackend,
+    Resource,
+    combine_msearch,
+    combine_resources,
+    count_body,
+    is_error,
+    decode_content,
+    split_msearch,
+)
+from .breaker import CircuitBreaker, CircuitOpen
+from .cancellation import DeadlineExceeded, DisconnectWatcher, query_context
+from .compression import CompressedContent
+from .es_pool import HedgingTransport
+from .export import export_lines, page_body
+from .cache import AdmissionCache, CacheBackend, SingleFlight, DEFAULT_CACHE_SIZE
+from .limiter import AdaptiveLimiter, ConcurrencyLimiter, Overloaded
+from .mappings import MappingStore
+from .msearch import MsearchItem
 
 import logging
 
 log = logging.getLogger(__name__)
 
+# Names of the rewrites of the query optimizer, if any were applied.
+OPTIMIZATIONS_HEADER = 'X-Query-Optimizations'
+# Endpoints whose responses are not cached as a whole: batches are combined from the cache
+# entries of their items.
+UNCACHED_ENDPOINTS = ('_msearch', '_exists')
+
+
+def msearch_cached(
+        cache: CacheBackend,
+        es: ElasticsearchBackend,
+        searches: List[MsearchItem],
+        item_keys: List[str],
+        grace: float = 0,
+        **kwargs: Any
+) -> Resource:
+    """Answer a `_msearch` from the per-search cache entries, forwarding only the missing
+    searches to the backend in one reduced `_msearch`."""
+    return combine_msearch(items_cached(
+        cache,
+        es,
+        searches,
+        item_keys,
+        lambda missing: es.msearch_items(missing, **kwargs),
+        grace
+    ))
+
+
+def exists_cached(
+        cache: CacheBackend,
+        es: ElasticsearchBackend,
+        queries: List[Dict],
+        item_keys: List[str],
+        grace: float = 0,
+        **kwargs: Any
+) -> Resource:
+    """Whether each of `queries` matches any document, from the per-query cache entries."""
+    resources = items_cached(
+        cache,
+        es,
+        queries,
+        item_keys,
+        lambda missing: es.exists_items(missing, **kwargs),
+        grace
+    )
+    return combine_resources(resources, [resource.content for resource in resources])
+
+
+def exists_queries(body: Any) -> List[Dict]:
+    """The queries of an `_exists` request body, `{"queries": [query, ...]}`."""
+    queries = body.get('queries') if isinstance(body, dict) else None
+    if not isinstance(queries, list) or not all(isinstance(query, dict) for query in queries):
+        abort(400)
+    return queries
+
+
+def items_cached(
+        cache: CacheBackend,
+        es: ElasticsearchBackend,
+        items: List[Any],
+        item_keys: List[str],
+        fetch: Callable[[List[Any]], List[Resource]],
+        grace: float = 0
+) -> List[Resource]:
+    """Resources of a batch of `items`, from the cache where possible (see
+    `ElasticsearchBackend.is_current` for `grace`). The missing ones are fetched all at once,
+    duplicates only once."""
+    resources = [cache.get(key) for key in item_keys]
+    resources = [
+        resource if resource is not None and es.is_current(resource, grace) else None
+        for resource in resources
+    ]
+    # key => positions of the search in the request, so that duplicates are only run once
+    missing = OrderedDict()
+    for i, resource in enumerate(resources):
+        if resource is None:
+            missing.setdefault(item_keys[i], []).append(i)
+    if missing:
+        fresh = fetch([items[positions[0]] for positions in missing.values()])
+        for (key, positions), resource in zip(missing.items(), fresh):
+            for i in positions:
+                resources[i] = resource
+            if not is_error(resource.content):
+                cache.put(key, resource)
+    return resources
+
+
+def make_content_response(resource: Resource) -> Response:
+    content = resource.content
+    if isinstance(content, CompressedContent):
+        if content.codec.name in request.accept_encodings:
+            response = Response(content.data, mimetype='application/json')
+            response.headers['Content-Encoding'] = content.codec.name
+            response.vary.add('Accept-Encoding')
+            return response
+        # Decompressed contents are JSON text, no matter if they were raw or not.
+        content = content.decompress()
+    if isinstance(content, bytes):
+        # Raw Elasticsearch response body, deliver as is.
+        return Response(content, mimetype='application/json')
+    return jsonify(content)
+
+
+def make_count_response(resource: Resource) -> Response:
+    content = decode_content(resource.content)
+    if is_error(content):
+        return make_content_response(resource)
+    return jsonify(count=content)
+
+
+def make_exists_response(resource: Resource) -> Response:
+    """Existence as booleans, `null` for queries that failed."""
+    return jsonify(exists=[
+        None if is_error(item) else bool(item) for item in decode_content(resource.content)
+    ])
+
+
+def make_export_response(resource: Resource, page_size: int) -> Response:
+    """Stream an export page as NDJSON, hit by hit."""
+    if is_error(resource.content):
+        return make_content_response(resource)
+    return Response(
+        export_lines(decode_content(resource.content), page_size),
+        mimetype='application/x-ndjson'
+    )
+
+
+class DepositBoost(object):
+    """Scheduling weight of senders: `boost` for senders whose channel deposit is at least
+    `min_deposit`, 1 for everybody else."""
+
+    def __init__(self, channel_manager, min_deposit: int, boost: float = 2.0):
+        self.channel_manager = channel_manager
+        self.min_deposit = min_deposit
+        self.boost = boost
+
+    def __call__(self, sender: str, open_block: Optional[int]) -> float:
+        channel = self.channel_manager.channels.get((sender, open_block))
+        if channel is not None and channel.deposit >= self.min_deposit:
+            return self.boost
+        return 1.0
+
 
 class ExpensiveElasticsearch(Expensive):
     def __init__(
             self,
-            resource_cache: Dict[int, Resource],
-            cache_lock: Lock,
+            resource_cache: CacheBackend,
+            in_flight: SingleFlight,
+            limiter: ConcurrencyLimiter,
+            breaker: CircuitBreaker,
             es: ElasticsearchBackend,
             *args,
+            sender_weight: Callable[[str, Optional[int]], float] = None,
+            stale_ttl: float = 0,
+            price_grace: float = 0,
+            mappings: MappingStore = None,
             **kwargs
     ):
         self.resource_cache = resource_cache
-        self.cache_lock = cache_lock
+        self.in_flight = in_flight
+        self.limiter = limiter
+        self.breaker = breaker
+        self.sender_weight = sender_weight
+        self.stale_ttl = stale_ttl
+        self.price_grace = price_grace
+        self.mappings = mappings
         self.es = es
+        # The resource that was priced for this request, delivered once the payment is verified.
+        self.request_key = None
+        self.resource = None
+        # Whether that resource is an outdated one, served while it is refreshed.
+        self.stale = False
+        # ETag of a mapping answered from memory
+        self.etag = None
+        # The searches of a `_msearch`, read once
+        self.searches = None
         Expensive.__init__(self, *args, **kwargs)
 
     @staticmethod
-    def get_request_key(request: request) -> int:
-        # FIXME: this assumes that serialized json data doesn't change order between requests
-        # it's a compromise to make NDJSON _msearch requests work (otherwise we could
-        # explicitely dump json with `sort_keys=True`).
-        data = request.get_data()
-        request_key = hash((
-            request.method.lower(),
-            request.url.lower(),
-            data
-        ))
-        return request_key
-
-    def fetch_resource(self, request_key: int, _index: str, _type: str) -> Resource:
-        resource = self.resource_cache.get(request_key)
-
-        if resource is not None and resource.expires_at < time.time():
-            self.cache_lock.acquire()
-            self.resource_cache.pop(request_key)
-            self.cache_lock.release()
-            resource = None
+    def get_request_key(request: request) -> str:
+        return canonical.request_key(
+            request.method,
+            request.path,
+            request.args.items(multi=True),
+            request.get_data()
+        )
 
-        if resource is None:
-            other_args = {key: request.values.get(key) for key in request.values.keys()}
-            api_endpoint = request.path.split('/')[-1]
-            if api_endpoint == '_search':
-                resource = self.es.search(
-                    index=_index,
-                    doc_type=_type,
-                    body=request.json,
-                    **other_args
-                )
-            elif api_endpoint == '_mapping':
-                resource = self.es.get_mapping(
-                    index=_index,
-                    doc_type=_type
+    def sender(self) -> Tuple[Optional[str], float]:
+        """The sender of the request and their scheduling weight.
+
+        Requests without payment headers (i.e. price probes of new clients) share a sender.
+        """
+        sender = request.headers.get(HTTPHeaders.SENDER_ADDRESS)
+        if sender is None or self.sender_weight is None:
+            return sender, 1.0
+        try:
+            open_block = int(request.headers.get(HTTPHeaders.OPEN_BLOCK))
+        except (TypeError, ValueError):
+            open_block = None
+        return sender, self.sender_weight(sender, open_block)
+
+    def grace(self) -> float:
+        """Seconds results stay current after a newer block was indexed. Paid requests get
+        the result they were quoted a price for, unless the block is older than the
+        `price_grace`."""
+        if request.headers.get(HTTPHeaders.SENDER_ADDRESS) is None:
+            return 0
+        return self.price_grace
+
+    def is_fresh(self, resource: Resource) -> bool:
+        # Results computed before the latest block was indexed are outdated as well.
+        return resource.expires_at >= time.time() and self.es.is_current(resource, self.grace())
+
+    def fetch_resource(self, request_key: str, _index: str, _type: str) -> Resource:
+        resource = self.resource_cache.get(request_key, ignore_expiry=True)
+        if resource is not None:
+            if self.is_fresh(resource):
+                return resource
+            if self.breaker.is_open():
+                # Anything is better than an error.
+                self.stale = True
+                return resource
+            # Results outdated by a new block are not served stale, only expired ones.
+            stale = resource.expires_at + self.stale_ttl >= time.time()
+            if self.stale_ttl > 0 and stale and self.es.is_current(resource, self.grace()):
+                self.stale = True
+                self.revalidate(request_key, _index, _type)
+                return resource
+
+        try:
+            return self.query_limited(request_key, _index, _type)
+        except Overloaded as e:
+            response = jsonify(error='Elasticsearch is overloaded, try again later.')
+            response.status_code = 503
+            response.headers['Retry-After'] = str(e.retry_after)
+            abort(response)
+        except DeadlineExceeded:
+            response = jsonify(error='The query could not be run in time.')
+            response.status_code = 504
+            abort(response)
+
+    def query_limited(self, request_key: str, _index: str, _type: str) -> Resource:
+        if self.breaker.is_open():
+            raise CircuitOpen(self.breaker.retry_after())
+        # Concurrent requests for the same key wait for a single backend query, which waits
+        # for a free slot of the limiter, scheduled fairly across senders.
+        sender, weight = self.sender()
+        budget = self.es.deadlines.get(request.path.split('/')[-1])
+        deadline = None if budget is None else time.time() + budget
+
+        @copy_current_request_context
+        def query() -> Resource:
+            # Tag the Elasticsearch requests, so that they can be cancelled with the query.
+            query_context.opaque_id = request_key
+            query_context.deadline = deadline
+            return self.limiter.run(
+                self.breaker.call,
+                self.query_backend,
+                request_key,
+                _index,
+                _type,
+                sender=sender,
+                weight=weight
+            )
+
+        return self.in_flight.run(request_key, query)
+
+    def revalidate(self, request_key: str, _index: str, _type: str):
+        """Refresh the cached resource in the background."""
+        if request_key in self.in_flight.in_flight:
+            return
+
+        @copy_current_request_context
+        def refresh():
+            try:
+                self.query_limited(request_key, _index, _type)
+            except Exception as e:
+                log.info('Refreshing a stale result failed: {}'.format(e))
+
+        gevent.spawn(refresh)
+
+    def query_backend(self, request_key: str, _index: str, _type: str) -> Resource:
+        other_args = {key: request.values.get(key) for key in request.values.keys()}
+        api_endpoint = request.path.split('/')[-1]
+        if api_endpoint == '_search':
+            resource = self.es.search(
+                index=_index,
+                doc_type=_type,
+                body=request.json,
+                **other_args
+            )
+        elif api_endpoint == '_export':
+            resource = self.es.export_page(
+                index=_index,
+                doc_type=_type,
+                body=request.json,
+                cursor=request.args.get('cursor')
+            )
+        elif api_endpoint == '_count':
+            resource = self.es.count(index=_index, doc_type=_type, body=request.json)
+        elif api_endpoint == '_exists':
+            queries = exists_queries(request.json)
+            item_keys = [
+                canonical.msearch_item_key(
+                    request.path,
+                    request.args.items(multi=True),
+                    {},
+                    query
                 )
-            elif api_endpoint == '_msearch':
-                data = request.get_data()
-                resource = self.es.msearch(
-                    index=_index,
-                    doc_type=_type,
-                    body=data,
-                    **other_args,
+                for query in queries
+            ]
+            resource = exists_cached(
+                self.resource_cache,
+                self.es,
+                queries,
+                item_keys,
+                grace=self.grace(),
+                index=_index,
+                doc_type=_type
+            )
+        elif api_endpoint == '_mapping':
+            resource = self.es.get_mapping(
+                index=_index,
+                doc_type=_type
+            )
+        elif api_endpoint == '_msearch':
+            searches = self.msearch_searches()
+            item_keys = [
+                canonical.msearch_item_key(
+                    request.path,
+                    request.args.items(multi=True),
+                    search.header,
+                    search.body
                 )
-            self.resource_cache[request_key] = resource
-
+                for search in searches
+            ]
+            resource = msearch_cached(
+                self.resource_cache,
+                self.es,
+                searches,
+                item_keys,
+                grace=self.grace(),
+                index=_index,
+                doc_type=_type,
+                **other_args
+            )
+        if api_endpoint not in UNCACHED_ENDPOINTS:
+            self.resource_cache.put(request_key, resource)
         return resource
 
+    def msearch_searches(self) -> List[MsearchItem]:
+        if self.searches is None:
+            self.searches = split_msearch(request.get_data())
+        return self.searches
+
+    def search_bodies(self) -> List[Tuple[Any, Optional[Dict]]]:
+        """The search bodies sent to the endpoint of this request and their parameters."""
+        api_endpoint = request.path.split('/')[-1]
+        params = {key: request.values.get(key) for key in request.values.keys()}
+        if api_endpoint == '_search':
+            return [(request.json, params)]
+        if api_endpoint in ('_count', '_export'):
+            return [(request.json, None)]
+        if api_endpoint == '_msearch':
+            return [
+                (search.body, dict(params, **search.header))
+                for search in self.msearch_searches()
+            ]
+        if api_endpoint == '_exists':
+            return [
+                (count_body(dict(query=query)), None) for query in exists_queries(request.json)
+            ]
+        return []
+
+    def rewrites(self) -> List[str]:
+        """Names of the rewrites of the query optimizer for this request."""
+        api_endpoint = request.path.split('/')[-1]
+        rewrites = set()
+        for body, params in self.search_bodies():
+            rewrites.update(self.es.rewrites(api_endpoint, body, params))
+        return sorted(rewrites)
+
+    def load_indexes(self):
+        """Load what the in-memory indexes lack for the searches of this request, in the
+        background and through the limiter and breaker like any query."""
+        sender, weight = self.sender()
+
+        def run(load: Callable, *args):
+            return self.limiter.run(self.breaker.call, load, *args, sender=sender, weight=weight)
+
+        api_endpoint = request.path.split('/')[-1]
+        for body, params in self.search_bodies():
+            self.es.load_indexes(
+                api_endpoint,
+                body,
+                params,
+                doc_type=request.view_args.get('_type'),
+                run=run
+            )
+
     def price(self) -> int:
         """
         Request the resource price by querying the resource itself and caching it for later
@@ -92,35 +451,78 @@ class ExpensiveElasticsearch(Expensive):
             raise ValueError('Method {} not allowed.'.format(request.method))
 
     def price_get(self, _index: str = None, _type: str = None):
-        request_key = ExpensiveElasticsearch.get_request_key(request)
-
-        return self.fetch_resource(request_key, _index, _type).price
+        if self.mappings is not None and request.path.split('/')[-1] == '_mapping':
+            mapping = self.mappings.lookup(_index, _type)
+            if mapping is not None:
+                # Priced like any mapping. Revalidations pay as well and get a 304.
+                self.resource, self.etag = mapping
+                return self.resource.price
+        self.request_key = ExpensiveElasticsearch.get_request_key(request)
+        self.resource = self.fetch_resource(self.request_key, _index, _type)
+        return self.resource.price
 
     def price_post(self, _index: str = None, _type: str = None):
         return self.price_get(_index, _type)
 
     def get_resource_cached(self):
-        # Price was just checked moments ago, so ignore expiry here.
-        request_key = self.get_request_key(request)
-        resource = self.resource_cache.get(request_key)
+        if self.etag is not None:
+            # Answered from memory, nothing to cache.
+            return self.resource
+        # Deliver exactly what was priced, even if it was evicted from the cache since.
+        resource = self.resource
+        request_key = self.request_key
+        uncached = request.path.split('/')[-1] in UNCACHED_ENDPOINTS
+        if resource is None:
+            # Price was just checked moments ago, so ignore expiry here.
+            request_key = self.get_request_key(request)
+            if uncached:
+                resource = self.query_backend(
+                    request_key,
+                    request.view_args.get('_index'),
+                    request.view_args.get('_type')
+                )
+            else:
+                resource = self.resource_cache.get(request_key, ignore_expiry=True)
 
-        # FIXME: there is a very rare edge case in which multiple concurrent requests to the same
-        # resource might lead to the resource being deleted between the final price check and the
-        # cache access.
         if resource is None:
             # Cache miss => 409 Conflict because bad code.
             abort(409)
 
+        if not uncached:
+            # Paid for, so keep it over results of price probes.
+            self.resource_cache.promote(request_key, resource)
+        # Only paid queries may cost the work of loading indexes, not price probes.
+        self.load_indexes()
         self.clean_cache()
         return resource
 
+    def make_response(self, resource: Resource) -> Response:
+        api_endpoint = request.path.split('/')[-1]
+        if api_endpoint == '_export':
+            response = make_export_response(resource, page_body(request.json)['size'])
+        elif api_endpoint == '_count':
+            response = make_count_response(resource)
+        elif api_endpoint == '_exists':
+            response = make_exists_response(resource)
+        else:
+            response = make_content_response(resource)
+        if self.stale:
+            response.headers['Warning'] = '110 - "Response is Stale"'
+        rewrites = self.rewrites()
+        if rewrites:
+            response.headers[OPTIMIZATIONS_HEADER] = ', '.join(rewrites)
+        if self.etag is not None:
+            response.set_etag(self.etag)
+            response.make_conditional(request)
+        return response
+
     def get(self, url: str, _index: str = None, _type: str = None):
         resource = self.get_resource_cached()
-        return jsonify(resource.content)
+        return self.make_response(resource)
 
     def post(self, url: str, _index: str = None, _type: str = None):
         resource = self.get_resource_cached()
-        return jsonify(resource.content)
+        return self.make_response(resource)
 
     def put(self, *args):
         return 'PUT not allowed', 405
@@ -129,22 +531,70 @@ class ExpensiveElasticsearch(Expensive):
         return 'DELETE not allowed', 405
 
     def clean_cache(self):
-        self.cache_lock.acquire()
-        now = time.time()
-        expired_resource_keys = [
-            key for key, resource in self.resource_cache.items()
-            if resource.expires_at < now
-        ]
-        for expired_resource_key in expired_resource_keys:
-            del self.resource_cache[expired_resource_key]
-        self.cache_lock.release()
+        self.resource_cache.expire()
+
+
+class MappingAdmin(RestResource):
+    """Status and refresh of the mappings held in memory."""
+
+    def __init__(self, mappings: MappingStore):
+        super(MappingAdmin, self).__init__()
+        self.mappings = mappings
+
+    @auth.login_required
+    def get(self):
+        return self.mappings.stats(), 200
+
+    @auth.login_required
+    def post(self):
+        if not self.mappings.refresh():
+            return 'Could not fetch the mappings', 502
+        return self.mappings.stats(), 200
+
+
+class StatsAdmin(RestResource):
+    """Counters of the query scheduling and caching of the server."""
+
+    def __init__(self, stats: Callable[[], Dict[str, Any]]):
+        super(StatsAdmin, self).__init__()
+        self.stats = stats
+
+    @auth.login_required
+    def get(self):
+        return self.stats(), 200
 
 
 class APIServer(object):
-    def __init__(self, proxy: PaywalledProxy, es: ElasticsearchBackend):
+    def __init__(
+            self,
+            proxy: PaywalledProxy,
+            es: ElasticsearchBackend,
+            cache_size: int = DEFAULT_CACHE_SIZE,
+            cache: CacheBackend = None,
+            limiter: ConcurrencyLimiter = None,
+            boost_deposit: int = None,
+            deposit_boost: float = 2.0,
+            breaker: CircuitBreaker = None,
+            stale_ttl: float = 60,
+            price_grace: float = 30,
+            mappings: MappingStore = None
+    ):
         self.proxy = proxy
-        self.resource_cache = {}
-        self.cache_lock = Lock()
+        self.es = es
+        if cache is None:
+            cache = AdmissionCache(max_bytes=cache_size, stale_ttl=stale_ttl)
+        self.resource_cache = cache
+        # Backend queries nobody waits for anymore are cancelled.
+        self.in_flight = SingleFlight(on_cancel=es.cancel_tasks)
+        self.disconnect_watcher = DisconnectWatcher(proxy.app.wsgi_app)
+        proxy.app.wsgi_app = self.disconnect_watcher
+        self.limiter = limiter or ConcurrencyLimiter()
+        self.breaker = breaker or CircuitBreaker()
+        if isinstance(self.limiter, AdaptiveLimiter):
+            es.took_listeners.append(self.limiter.observe_took)
+        sender_weight = None
+        if boost_deposit is not None:
+            sender_weight = DepositBoost(proxy.channel_manager, boost_deposit, deposit_boost)
         proxy.add_paywalled_resource(
             ExpensiveElasticsearch,
             '/_search',
@@ -157,9 +607,48 @@ class APIServer(object):
             '/_mapping',
             '/<string:_index>/_mapping',
             '/<string:_index>/<string:_type>/_mapping',
+            '/_count',
+            '/<string:_index>/_count',
+            '/<string:_index>/<string:_type>/_count',
+            '/_exists',
+            '/<string:_index>/_exists',
+            '/<string:_index>/<string:_type>/_exists',
+            '/<string:_index>/_export',
+            '/<string:_index>/<string:_type>/_export',
             resource_class_kwargs=dict(
                 resource_cache=self.resource_cache,
-                cache_lock=self.cache_lock,
+                in_flight=self.in_flight,
+                limiter=self.limiter,
+                breaker=self.breaker,
                 es=es,
+                sender_weight=sender_weight,
+                stale_ttl=stale_ttl,
+                price_grace=price_grace,
+                mappings=mappings,
             )
         )
+        if mappings is not None:
+            proxy.api.add_resource(
+                MappingAdmin,
+                API_PATH + '/admin/mappings',
+                resource_class_kwargs=dict(mappings=mappings)
+            )
+        proxy.api.add_resource(
+            StatsAdmin,
+            API_PATH + '/admin/stats',
+            resource_class_kwargs=dict(stats=self.stats)
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        stats = dict(
+            limiter=self.limiter.stats(),
+            senders=self.limiter.sender_stats(),
+            in_flight=self.in_flight.stats(),
+            disconnects=self.disconnect_watcher.disconnects,
+            breaker=self.breaker.stats(),
+            cache=self.resource_cache.stats(),
+        )
+        transport = getattr(self.es.es, 'transport', None)
+        if isinstance(transport, HedgingTransport):
+            stats['transport'] = transport.stats()
+        return stats
@@ -1,12 +1,35 @@
 import logging
 import json
+import re
 
 import time
 from collections import namedtuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import quote
 
 from flask import abort
 from gevent.event import AsyncResult
 
+from ethevents.server.addresses import AddressIndex
+from ethevents.server.blocks import BlockTracker
+from ethevents.server.cancellation import (
+    DEFAULT_DEADLINES,
+    TIMEOUT_GRACE,
+    DeadlineExceeded,
+    cancel_tasks,
+    query_context,
+    request_headers,
+)
+from ethevents.server.compression import CompressedContent
+from ethevents.server import canonical
+from ethevents.server.export import page_body
+from ethevents.server.finality import BLOCK_FIELDS, block_upper_bound, split_query
+from ethevents.server.joins import JoinIndex
+from ethevents.server.merge import merge_responses, mergeable
+from ethevents.server import msearch
+from ethevents.server.msearch import MsearchItem, read_msearch
+from ethevents.server.optimizer import optimize
+from ethevents.server.validation import InvalidQuery, ScriptRejected, validate_search
 from ethevents.config import (
     ETH_INDEX,
     LOG,
@@ -14,10 +37,26 @@ from ethevents.config import (
     TX,
 )
 
-Resource = namedtuple('Resource', ['content', 'price', 'expires_at'])
+Resource = namedtuple(
+    'Resource',
+    ['content', 'price', 'expires_at', 'block_height', 'finalized']
+)
+# `block_height` is the latest indexed block when the result was computed. `finalized` results
+# only cover blocks that are safe from reorgs and never go stale.
+Resource.__new__.__defaults__ = (None, False)
 
 log = logging.getLogger(__name__)
 
+# `took` is the first field of every search response.
+TOOK_PATTERN = re.compile(rb'^\s*\{\s*"took"\s*:\s*(\d+)')
+ERROR_PATTERN = re.compile(rb'^\s*\{\s*"error"\s*:')
+# ... and `timed_out` the second.
+# Only the parts of a search response needed for counting.
+COUNT_FILTER_PATH = 'took,timed_out,hits.total'
+TIMED_OUT_PATTERN = re.compile(rb'^\s*\{\s*"took"\s*:\s*\d+\s*,\s*"timed_out"\s*:\s*true')
+# Fixed price of a `_mapping` request, which reports no `took`.
+MAPPING_PRICE = 5
+
 ONLY_BLOCK = dict(
     index=ETH_INDEX,
     doc_type=BLOCK,
@@ -36,12 +75,18 @@ ONLY_LOG = dict(
 
 class ESCostCollector(object):
 
-    def __init__(self):
+    def __init__(self, listeners=()):
         self.accumulated = 0
         self.price = AsyncResult()
+        # called with the `took` of every response
+        self.listeners = listeners
 
     def add(self, result):
-        self.accumulated += result['took']
+        # Failed searches of a `_msearch` have no `took`.
+        took = result.get('took', 0)
+        self.accumulated += took
+        for listener in self.listeners:
+            listener(took)
 
     def finalize(self):
         self.price.set(self.accumulated)
@@ -71,59 +116,664 @@ def sanitize(kwargs):
                 result[key] = 'ethereum'
             else:
                 result[key] = value
-        elif key == 'body':
-            body_content = json.dumps(value)
-            if 'script' in body_content and 'lang' in body_content:
-                abort(405)
-            result['body'] = value
         else:
             result[key] = value
+    check_search(kwargs.get('body'), kwargs)
     return result
 
 
+def check_search(body: Any, params: Dict = None):
+    """Refuse searches with scripts (405) and otherwise invalid or too expensive ones (400)."""
+    try:
+        validate_search(body, params)
+    except ScriptRejected:
+        abort(405)
+    except InvalidQuery as e:
+        abort(400, str(e))
+
+
+def split_msearch(body: bytes) -> List[MsearchItem]:
+    """Split a NDJSON `_msearch` body into its searches."""
+    try:
+        return list(read_msearch(body))
+    except ValueError:
+        abort(400)
+
+
+def msearch_lines(search: MsearchItem, limits: Dict[str, Any]) -> Tuple[bytes, bytes]:
+    """Sanitized header and body line of a checked search, with `limits` added to the body.
+    The original lines are forwarded unless they have to change."""
+    header = sanitize(search.header)
+    header_line = search.header_line
+    if header_line is None or header != search.header:
+        header_line = msearch.dumps(header)
+    body_line = search.body_line
+    if body_line is None:
+        body_line = msearch.dumps(search.body)
+    if 'terminate_after' in limits and 'terminate_after' in (search.body or {}):
+        # Searches may stop even earlier than the limits require.
+        try:
+            terminate_after = min(limits['terminate_after'], int(search.body['terminate_after']))
+        except (TypeError, ValueError):
+            terminate_after = limits['terminate_after']
+        limits = dict(limits, terminate_after=terminate_after)
+    return header_line, msearch.splice(body_line, search.body, limits)
+
+
+def merge_body(body: Any, params: Dict) -> Any:
+    """`body` with the hits window given by URL parameters, which take precedence."""
+    window = {key: params[key] for key in ('from', 'size') if key in params}
+    if not isinstance(body, dict) or not window:
+        return body
+    try:
+        return dict(body, **{key: int(value) for key, value in window.items()})
+    except (TypeError, ValueError):
+        return body
+
+
+def window_in_body(search_kwargs: Dict) -> Optional[Dict]:
+    """`search_kwargs` with the hits window of the URL parameters moved into the body, for
+    searches executed in parts. `None` if the window is not valid."""
+    if 'from' not in search_kwargs and 'size' not in search_kwargs:
+        return search_kwargs
+    body = search_kwargs.get('body')
+    windowed = merge_body(body, search_kwargs)
+    if windowed is body:
+        return None
+    search_kwargs = {
+        key: value for key, value in search_kwargs.items() if key not in ('from', 'size')
+    }
+    return dict(search_kwargs, body=windowed)
+
+
+def content_bytes(content: Any) -> bytes:
+    if isinstance(content, bytes):
+        return content
+    if isinstance(content, CompressedContent):
+        return content.decompress()
+    return json.dumps(content, separators=(',', ':')).encode('utf-8')
+
+
+def decode_content(content: Any) -> Any:
+    """The decoded JSON document of a content."""
+    if isinstance(content, CompressedContent):
+        content = content.decompress()
+    if isinstance(content, bytes):
+        return json.loads(content.decode('utf-8'))
+    return content
+
+
+def is_error(content: Any) -> bool:
+    if isinstance(content, CompressedContent):
+        content = content.decompress()
+    if isinstance(content, bytes):
+        return ERROR_PATTERN.match(content) is not None
+    return isinstance(content, dict) and 'error' in content
+
+
+def is_timed_out(content: Any) -> bool:
+    """Whether a search response only has the results found until its timeout."""
+    if isinstance(content, CompressedContent):
+        content = content.decompress()
+    if isinstance(content, bytes):
+        return TIMED_OUT_PATTERN.match(content) is not None
+    return content.get('timed_out') is True
+
+
+def count_body(body: Any) -> Dict:
+    """Search body that only counts the hits of the query of `body`."""
+    count = dict(size=0)
+    if isinstance(body, dict) and 'query' in body:
+        count['query'] = body['query']
+    return count
+
+
+def hits_total(response: Dict) -> int:
+    total = response['hits']['total']
+    # An object from Elasticsearch 7 on.
+    if isinstance(total, dict):
+        return total['value']
+    return total
+
+
+def parse_took(data: bytes) -> Dict[str, int]:
+    """Read `took` from a raw search response without decoding all of it."""
+    match = TOOK_PATTERN.match(data)
+    if match is None:
+        return json.loads(data.decode('utf-8'))
+    return dict(took=int(match.group(1)))
+
+
+def split_msearch_response(data: bytes) -> List[bytes]:
+    """Cut a raw `_msearch` response into the raw responses of its searches."""
+    text = data.decode('utf-8')
+    decoder = json.JSONDecoder()
+    responses = []
+    position = text.index('[', text.index('"responses"')) + 1
+    while True:
+        while text[position] in ' \t\r\n,':
+            position += 1
+        if text[position] == ']':
+            return responses
+        _, end = decoder.raw_decode(text, position)
+        responses.append(text[position:end].encode('utf-8'))
+        position = end
+
+
+def combine_msearch(resources: List[Resource]) -> Resource:
+    """Assemble the per-search resources of a `_msearch` into one."""
+    if any(not isinstance(resource.content, dict) for resource in resources):
+        content = b''.join((
+            b'{"responses":[',
+            b','.join(content_bytes(resource.content) for resource in resources),
+            b']}'
+        ))
+    else:
+        content = dict(responses=[resource.content for resource in resources])
+    return combine_resources(resources, content)
+
+
+def combine_resources(resources: List[Resource], content: Any) -> Resource:
+    """Resource with `content` combined from `resources`, priced and tagged accordingly."""
+    return Resource(
+        content=content,
+        price=sum(resource.price for resource in resources),
+        expires_at=min(
+            (resource.expires_at for resource in resources),
+            default=time.time()
+        ),
+        block_height=min(
+            (resource.block_height for resource in resources
+             if resource.block_height is not None),
+            default=None
+        ),
+        finalized=bool(resources) and all(resource.finalized for resource in resources)
+    )
+
+
+class RawDeserializer(object):
+    """Leaves the response bodies of `perform_raw` requests undecoded."""
+
+    def __init__(self, deserializer):
+        self.deserializer = deserializer
+
+    def loads(self, s, mimetype=None):
+        if query_context.raw:
+            return s
+        return self.deserializer.loads(s, mimetype)
+
+
+def make_path(*parts: str) -> str:
+    return '/' + '/'.join(quote(part, safe=',*') for part in parts if part)
+
+
 class ElasticsearchBackend(object):
-    def __init__(self, es, result_ttl: float = 30):
+    """Runs the paid queries against Elasticsearch.
+
+    With `raw_responses`, response bodies are not decoded but kept as the raw JSON bytes, which
+    are delivered as they are. Only `took` is extracted for pricing.
+
+    With a `block_tracker`, results are tagged with the latest indexed block. Results of
+    queries over finalized blocks are kept until evicted, all others go stale as soon as a new
+    block is indexed (or after `result_ttl`, whichever comes first).
+
+    With a `historic_cache` as well, searches over a block number or timestamp range reaching
+    into unfinalized blocks are split at a finalized block boundary (a multiple of
+    `split_alignment`). The finalized part is computed once and kept in `historic_cache`, only
+    the live tail is executed for every request and the results are merged.
+
+    Requests to Elasticsearch must be answered within the `deadlines` (seconds per endpoint)
+    or the deadline of the current query, whichever is earlier. Searches that time out return
+    the results found so far, which are not cached. With `terminate_after`, searches stop
+    after collecting that many documents per shard.
+
+    With `optimize_queries`, search bodies are rewritten into cheaper equivalents before they
+    are executed (see `optimizer`). With a `join_index`, joins of transactions or blocks with
+    their logs are replaced by filters on the precomputed parents (see `joins`). With an
+    `address_index`, searches for the latest transactions of an address only fetch the ones
+    that can be among the hits (see `addresses`).
+    """
+
+    def __init__(
+            self,
+            es,
+            result_ttl: float = 30,
+            raw_responses: bool = False,
+            block_tracker: BlockTracker = None,
+            historic_cache=None,
+            split_alignment: int = 1000,
+            deadlines: Dict[str, float] = None,
+            terminate_after: int = None,
+            optimize_queries: bool = True,
+            join_index: JoinIndex = None,
+            address_index: AddressIndex = None
+    ):
         self.es = es
         self.result_ttl = result_ttl
+        self.raw_responses = raw_responses
+        if raw_responses:
+            es.transport.deserializer = RawDeserializer(es.transport.deserializer)
+        self.block_tracker = block_tracker
+        self.historic_cache = historic_cache
+        self.split_alignment = split_alignment
+        self.deadlines = DEFAULT_DEADLINES if deadlines is None else deadlines
+        self.terminate_after = terminate_after
+        self.optimize_queries = optimize_queries
+        self.join_index = join_index
+        self.address_index = address_index
+        # called with the `took` of every search response, e.g. for adapting concurrency
+        self.took_listeners = []
+
+    def validity(self, body: Dict, response: Any = None) -> Dict:
+        """Expiry and block height tags for the result of a search with `body`."""
+        expires_at = time.time() + self.result_ttl
+        if response is not None and is_timed_out(response):
+            # Incomplete, compute it again next time.
+            expires_at = time.time()
+            body = None
+        tracker = self.block_tracker
+        if tracker is None or tracker.height is None:
+            return dict(expires_at=expires_at)
+        finalized = tracker.is_finalized(block_upper_bound(body))
+        return dict(
+            expires_at=float('inf') if finalized else expires_at,
+            block_height=tracker.height,
+            finalized=finalized
+        )
+
+    def is_current(self, resource: Resource, grace: float = 0) -> bool:
+        """Whether no block was indexed since a head-dependent `resource` was computed, or
+        only within the last `grace` seconds."""
+        if resource.finalized or resource.block_height is None or self.block_tracker is None:
+            return True
+        height = self.block_tracker.height
+        if height is None or resource.block_height >= height:
+            return True
+        if not grace:
+            return False
+        superseded_at = self.block_tracker.superseded_at(resource.block_height)
+        return superseded_at is not None and superseded_at + grace >= time.time()
+
+    def time_budget(self, endpoint: str) -> Optional[float]:
+        """Seconds a request to `endpoint` may take, `None` if it is not limited."""
+        budget = self.deadlines.get(endpoint)
+        remaining = query_context.remaining()
+        if remaining is not None:
+            budget = remaining if budget is None else min(budget, remaining)
+        if budget is not None and budget <= 0:
+            raise DeadlineExceeded()
+        return budget
+
+    def search_limits(self, budget: Optional[float]) -> Dict[str, Any]:
+        """Search parameters that make Elasticsearch stop working on a search in time."""
+        limits = dict()
+        if budget is not None:
+            limits['timeout'] = '{}ms'.format(max(int(budget * 1000), 1))
+        if self.terminate_after is not None:
+            limits['terminate_after'] = self.terminate_after
+        return limits
+
+    @staticmethod
+    def request_timeout(budget: Optional[float]) -> Optional[float]:
+        """Client side timeout, leaving Elasticsearch time to return partial results."""
+        return None if budget is None else budget + TIMEOUT_GRACE
+
+    def optimize(self, body: Any, params: Dict = None) -> Tuple[Any, List[str]]:
+        """The search body to execute instead of `body` and the names of the rewrites."""
+        if not self.optimize_queries:
+            return body, []
+        return optimize(body, params)
+
+    @staticmethod
+    def endpoint_body(endpoint: str, body: Any) -> Any:
+        """The search body run for a body sent to `endpoint`, `ValueError` if it is invalid."""
+        if endpoint == '_count':
+            return count_body(body)
+        if endpoint == '_export':
+            return page_body(body)
+        return body
+
+    def rewrites(self, endpoint: str, body: Any, params: Dict = None) -> List[str]:
+        """Names of the rewrites of a search body sent to `endpoint`."""
+        try:
+            body = self.endpoint_body(endpoint, body)
+        except ValueError:
+            return []
+        return self.optimize(body, params)[1]
+
+    def load_indexes(
+            self,
+            endpoint: str,
+            body: Any,
+            params: Dict = None,
+            doc_type: str = None,
+            run: Callable = None
+    ):
+        """Load what the in-memory indexes lack for a search body sent to `endpoint` (with the
+        URL parameters `params`), in the background, each by `run(load, key)` if given."""
+        try:
+            body = self.endpoint_body(endpoint, body)
+        except ValueError:
+            return
+        if self.join_index is not None:
+            for key in self.join_index.wanted(body):
+                self.join_index.request(key, run)
+        # The searches of batches are not answered from the address index.
+        batch = endpoint in ('_msearch', '_exists')
+        if self.address_index is not None and doc_type == TX and not batch:
+            for address in self.address_index.wanted(body, params):
+                self.address_index.request(address, run)
+
+    def join_parts(self, search_kwargs: Dict) -> Optional[List[Dict]]:
+        """The bodies to search instead of the body of a sanitized search, several if they
+        are disjoint parts whose responses are merged. `None` if no join can be replaced."""
+        if self.join_index is None:
+            return None
+        body = search_kwargs.get('body')
+        # Merged responses have all fields, `filter_path` removes some of them. Shards are
+        # arbitrary slices of the parents, so the top terms of each may be far off overall.
+        shardable = 'filter_path' not in search_kwargs and mergeable(
+            merge_body(body, search_kwargs),
+            exact=True
+        )
+        return self.join_index.rewrite(body, shardable)
+
+    def cancel_tasks(self, opaque_id: str):
+        """Stop the Elasticsearch searches of an abandoned query tagged with `opaque_id`."""
+        try:
+            cancelled = cancel_tasks(self.es, opaque_id)
+        except Exception as e:
+            log.info('Could not cancel the Elasticsearch tasks of a query: {}'.format(e))
+            return
+        if cancelled:
+            log.debug('Cancelled {} Elasticsearch tasks.'.format(cancelled))
+
+    def perform_raw(
+            self,
+            method: str,
+            path: str,
+            params: Dict = None,
+            body: bytes = None,
+            timeout: float = None
+    ) -> bytes:
+        params = dict(params or {})
+        if timeout is not None:
+            params['request_timeout'] = timeout
+        query_context.raw = True
+        try:
+            data = self.es.transport.perform_request(
+                method,
+                path,
+                headers=request_headers(),
+                params=params,
+                body=body
+            )
+        finally:
+            query_context.raw = False
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return data
 
     def search(self, **kwargs) -> Resource:
         search_kwargs = sanitize(kwargs)
-        collector = ESCostCollector()
-        response = self.es.search(**search_kwargs)
-        collector.add(response)
+        # Each part returns the whole window, the merged response is cut to it.
+        windowed = window_in_body(search_kwargs)
+        split = None if windowed is None else self.split_search(windowed.get('body'))
+        if split is not None:
+            return self.search_split(windowed, *split)
+        return self.search_sanitized(search_kwargs)
+
+    def search_sanitized(self, search_kwargs: Dict) -> Resource:
+        resource = self.search_address(search_kwargs)
+        if resource is not None:
+            return resource
+        parts = self.join_parts(search_kwargs)
+        if parts is not None and len(parts) > 1:
+            return self.search_parts(search_kwargs, parts)
+        if parts is not None:
+            search_kwargs = dict(search_kwargs, body=parts[0])
+        return self.search_executed(search_kwargs)
+
+    def search_executed(self, search_kwargs: Dict) -> Resource:
+        """Execute a sanitized search as it is, apart from optimizing its body."""
+        budget = self.time_budget('_search')
+        body, _ = self.optimize(search_kwargs.get('body'), search_kwargs)
+        search_kwargs = dict(search_kwargs, body=body, **self.search_limits(budget))
+        collector = ESCostCollector(self.took_listeners)
+        if self.raw_responses:
+            index = search_kwargs.pop('index', None)
+            doc_type = search_kwargs.pop('doc_type', None)
+            search_kwargs.pop('body', None)
+            response = self.perform_raw(
+                'POST',
+                make_path(index, doc_type, '_search'),
+                params=search_kwargs,
+                body=None if body is None else content_bytes(body),
+                timeout=self.request_timeout(budget)
+            )
+            collector.add(parse_took(response))
+        else:
+            response = self.es.search(
+                request_timeout=self.request_timeout(budget),
+                **search_kwargs
+            )
+            collector.add(response)
         collector.finalize()
         result = Resource(
             content=response,
             price=collector.get_price(),
-            expires_at=time.time() + self.result_ttl
+            **self.validity(body, response)
         )
         assert isinstance(result, Resource)
         return result
 
+    def split_search(self, body: Dict):
+        """(body, historic body, tail body) if a search should be split at a finalized block."""
+        if self.historic_cache is None or self.block_tracker is None or not mergeable(body):
+            return None
+        boundary = self.block_tracker.split_boundary(self.split_alignment)
+        if boundary is None:
+            return None
+        split = split_query(body, boundary)
+        if split is None:
+            return None
+        field, historic, tail = split
+        if field not in BLOCK_FIELDS:
+            try:
+                timestamp = self.block_tracker.block_timestamp(boundary)
+            except Exception as e:
+                log.warning('No timestamp for block {}: {}'.format(boundary, e))
+                return None
+            split = split_query(body, timestamp)
+            if split is None:
+                return None
+            field, historic, tail = split
+        return body, historic, tail
+
+    def search_split(
+            self,
+            search_kwargs: Dict,
+            body: Dict,
+            historic: Dict,
+            tail: Dict
+    ) -> Resource:
+        historic_kwargs = dict(search_kwargs, body=historic)
+        historic_key = canonical.digest(b'historic', canonical.dump_canonical(historic_kwargs))
+        historic_resource = self.historic_cache.get(historic_key)
+        if historic_resource is not None:
+            # Shared by several requests, keep it over one-off results.
+            self.historic_cache.promote(historic_key, historic_resource)
+        else:
+            historic_resource = self.search_sanitized(historic_kwargs)
+            content = historic_resource.content
+            if not is_error(content) and not is_timed_out(content):
+                historic_resource = historic_resource._replace(
+                    expires_at=float('inf'),
+                    finalized=True
+                )
+                self.historic_cache.put(historic_key, historic_resource)
+        tail_resource = self.search_sanitized(dict(search_kwargs, body=tail))
+        merged = merge_responses(body, [
+            decode_content(historic_resource.content),
+            decode_content(tail_resource.content),
+        ])
+        return tail_resource._replace(
+            content=merged,
+            price=historic_resource.price + tail_resource.price,
+            expires_at=min(historic_resource.expires_at, tail_resource.expires_at)
+        )
+
+    def search_address(self, search_kwargs: Dict) -> Optional[Resource]:
+        """Search the transactions of an address with the held ones, `None` if they can not
+        answer the search."""
+        if self.address_index is None or search_kwargs.get('doc_type') != TX:
+            return None
+        body = search_kwargs.get('body')
+        rewritten = self.address_index.rewrite(body, search_kwargs)
+        if rewritten is None:
+            return None
+        resource = self.search_executed(dict(search_kwargs, body=rewritten.body))
+        if is_error(resource.content):
+            return resource
+        content = decode_content(resource.content)
+        total = content['hits']['total']
+        if isinstance(total, dict):
+            total = dict(total, value=total['value'] + rewritten.omitted)
+        else:
+            total += rewritten.omitted
+        content['hits']['total'] = total
+        return resource._replace(content=content, **self.validity(body, content))
+
+    def search_parts(self, search_kwargs: Dict, parts: List[Dict]) -> Resource:
+        """Search the disjoint `parts` of a search and merge the responses."""
+        resources = []
+        for part in parts:
+            resource = self.search_executed(dict(search_kwargs, body=part))
+            if is_error(resource.content):
+                return resource
+            resources.append(resource)
+        body = search_kwargs.get('body')
+        merged = merge_responses(merge_body(body, search_kwargs), [
+            decode_content(resource.content) for resource in resources
+        ])
+        return combine_resources(resources, merged)._replace(**self.validity(body, merged))
+
+    def export_page(self, cursor: str = None, **kwargs) -> Resource:
+        """The page after `cursor` of an export of all hits of a search.
+
+        Pages are large and fetched once, so they are only kept for `result_ttl`, long enough
+        for the paid request following the price request.
+        """
+        search_kwargs = sanitize(kwargs)
+        try:
+            search_kwargs['body'] = page_body(
+                search_kwargs.get('body'),
+                cursor,
+                search_kwargs.get('doc_type')
+            )
+        except ValueError:
+            abort(400)
+        resource = self.search_sanitized(search_kwargs)
+        if is_timed_out(resource.content):
+            # The next page would skip the hits missing from a partial one.
+            raise DeadlineExceeded()
+        return resource._replace(
+            expires_at=min(resource.expires_at, time.time() + self.result_ttl)
+        )
+
+    def count(self, **kwargs) -> Resource:
+        """Number of documents matching the query of a search body.
+
+        The content is the plain number, which takes next to no room in the cache.
+        """
+        search_kwargs = sanitize(kwargs)
+        search_kwargs['body'] = count_body(search_kwargs.get('body'))
+        search_kwargs['filter_path'] = COUNT_FILTER_PATH
+        resource = self.search_sanitized(search_kwargs)
+        return resource._replace(content=hits_total(decode_content(resource.content)))
+
+    def exists_items(self, queries: List[Dict], **kwargs) -> List[Resource]:
+        """Whether any document matches each of `queries`, as 1 or 0, from a single
+        `_msearch` that stops searching each shard at the first match."""
+        searches = [
+            (dict(), dict(count_body(dict(query=query)), terminate_after=1))
+            for query in queries
+        ]
+        return [
+            resource if is_error(resource.content) else resource._replace(
+                content=int(hits_total(decode_content(resource.content)) > 0)
+            )
+            for resource in self.msearch_items(searches, **kwargs)
+        ]
+
     def msearch(self, **kwargs) -> Resource:
-        new_body = []
-        if 'body' in kwargs:
-            body = kwargs.pop('body')
-            body = body.decode('utf-8')
-            for search in body.strip().split('\n'):
-                new_body.append(json.dumps(sanitize(json.loads(search))))
+        searches = split_msearch(kwargs.pop('body', b''))
+        return combine_msearch(self.msearch_items(searches, **kwargs))
+
+    def msearch_items(self, searches: List[MsearchItem], **kwargs) -> List[Resource]:
+        """Run the searches (or (header, search body) pairs) in a single `_msearch` and return
+        one priced resource per search, in order."""
+        searches = [MsearchItem(*search) for search in searches]
+        budget = self.time_budget('_msearch')
+        # `_msearch` has no timeout parameter, each search gets its own.
+        limits = self.search_limits(budget)
         other_kwargs = sanitize(kwargs)
-        collector = ESCostCollector()
-        multi_response = self.es.msearch(body=new_body, **other_kwargs)
-        for response in multi_response['responses']:
-            collector.add(response)
-        collector.finalize()
-        result = Resource(
-            content=multi_response,
-            price=collector.get_price(),
-            expires_at=time.time() + self.result_ttl
-        )
+        new_body = []
+        for search in searches:
+            # Parameters of the search: the ones of the `_msearch`, unless its header says else.
+            params = dict(other_kwargs, **search.header)
+            # Checked as requested, the rewrites below may only make it cheaper.
+            check_search(search.body, params)
+            body = search.body
+            if self.join_index is not None:
+                parts = self.join_index.rewrite(body)
+                body = body if parts is None else parts[0]
+            body, rewrites = self.optimize(body, params)
+            if rewrites or body is not search.body:
+                search = search._replace(body=body, body_line=None)
+            new_body.extend(msearch_lines(search, limits))
+        if self.raw_responses:
+            index = other_kwargs.pop('index', None)
+            doc_type = other_kwargs.pop('doc_type', None)
+            responses = split_msearch_response(self.perform_raw(
+                'POST',
+                make_path(index, doc_type, '_msearch'),
+                params=other_kwargs,
+                body=b'\n'.join(new_body + [b'']),
+                timeout=self.request_timeout(budget)
+            ))
+            took = [parse_took(response) for response in responses]
+        else:
+            responses = self.es.msearch(
+                body=[line.decode('utf-8') for line in new_body],
+                request_timeout=self.request_timeout(budget),
+                **other_kwargs
+            )['responses']
+            took = responses
+        result = []
+        for search, response, response_took in zip(searches, responses, took):
+            collector = ESCostCollector(self.took_listeners)
+            collector.add(response_took)
+            collector.finalize()
+            result.append(Resource(
+                content=response,
+                price=collector.get_price(),
+                **self.validity(search.body, response)
+            ))
         return result
 
     def get_mapping(self, **kwargs) -> Resource:
-        response = self.es.indices.get_mapping(**kwargs)
+        timeout = self.request_timeout(self.time_budget('_mapping'))
+        if self.raw_responses:
+            response = self.perform_raw(
+                'GET',
+                make_path(kwargs.get('index'), '_mapping', kwargs.get('doc_type')),
+                timeout=timeout
+            )
+        else:
+            response = self.es.indices.get_mapping(request_timeout=timeout, **kwargs)
         return Resource(
             content=response,
-            price=5,
+            price=MAPPING_PRICE,
             expires_at=time.time() + 10 * self.result_ttl
         )
@@ -0,0 +1,129 @@
+import time
+from collections import deque
+from typing import Optional
+
+import gevent
+
+from ethevents.config import BLOCK, ETH_INDEX, INDEXING_REORG_SAFE
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class BlockTracker(object):
+    """Follows the number of the latest indexed block by polling Elasticsearch in a
+    background greenlet. Listeners are called with the new block number whenever it changes.
+    """
+
+    def __init__(
+            self,
+            es,
+            poll_interval: float = 5,
+            reorg_safe: int = INDEXING_REORG_SAFE
+    ):
+        self.es = es
+        self.poll_interval = poll_interval
+        self.reorg_safe = reorg_safe
+        self.height = None
+        self.updated_at = None
+        # (block number, time it was seen) of the recent updates
+        self.history = deque(maxlen=100)
+        # called with the new block number
+        self.listeners = []
+        self.greenlet = None
+        # block number => timestamp, for split boundaries only
+        self.timestamps = dict()
+
+    @property
+    def finalized_height(self) -> Optional[int]:
+        """Highest block number that is considered safe from reorgs."""
+        if self.height is None:
+            return None
+        return self.height - self.reorg_safe
+
+    def is_finalized(self, block_number: Optional[int]) -> bool:
+        finalized_height = self.finalized_height
+        if block_number is None or finalized_height is None:
+            return False
+        return block_number <= finalized_height
+
+    def superseded_at(self, block_number: int) -> Optional[float]:
+        """Time a block above `block_number` was first seen, `None` if that is not known."""
+        for height, seen_at in self.history:
+            if height > block_number:
+                return seen_at
+        return None
+
+    def split_boundary(self, alignment: int) -> Optional[int]:
+        """Highest finalized block number that is a multiple of `alignment` minus one.
+
+        Queries split at this boundary have the same finalized part for `alignment` blocks.
+        """
+        finalized_height = self.finalized_height
+        if finalized_height is None:
+            return None
+        boundary = (finalized_height + 1) // alignment * alignment - 1
+        if boundary < 0:
+            return None
+        return boundary
+
+    def block_timestamp(self, number: int):
+        """Timestamp of the block `number`, as indexed."""
+        if number not in self.timestamps:
+            response = self.es.search(
+                index=ETH_INDEX,
+                doc_type=BLOCK,
+                body={
+                    'size': 1,
+                    'query': {'term': {'number.num': number}},
+                    '_source': ['timestamp'],
+                }
+            )
+            self.timestamps[number] = response['hits']['hits'][0]['_source']['timestamp']
+        return self.timestamps[number]
+
+    def fetch_height(self) -> int:
+        response = self.es.search(
+            index=ETH_INDEX,
+            doc_type=BLOCK,
+            body={
+                'size': 1,
+                'sort': {'number.num': 'desc'},
+                '_source': ['number'],
+            }
+        )
+        return int(response['hits']['hits'][0]['_source']['number']['num'])
+
+    def update(self, height: int):
+        if self.height is not None and height <= self.height:
+            return
+        log.debug('New indexed block {}'.format(height))
+        self.height = height
+        self.updated_at = time.time()
+        self.history.append((height, self.updated_at))
+        for listener in self.listeners:
+            try:
+                listener(height)
+            except Exception:
+                log.exception('Block listener failed')
+
+    def poll(self):
+        try:
+            self.update(self.fetch_height())
+        except Exception as e:
+            log.warning('Could not fetch latest block: {}'.format(e))
+
+    def run(self):
+        while True:
+            self.poll()
+            gevent.sleep(self.poll_interval)
+
+    def start(self):
+        assert self.greenlet is None
+        self.greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
@@ -0,0 +1,133 @@
+"""Circuit breaker for Elasticsearch queries.
+
+While Elasticsearch fails or is very slow, queries are rejected right away instead of each
+waiting for a timeout. After `open_duration` seconds, a single query is let through to test
+whether Elasticsearch has recovered.
+"""
+import math
+import time
+from collections import deque
+from typing import Any, Callable, Dict
+
+from elasticsearch.exceptions import TransportError
+from gevent import GreenletExit
+
+from .limiter import Overloaded, percentile
+
+import logging
+
+log = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpen(Overloaded):
+    """Elasticsearch is considered down."""
+
+
+def is_backend_failure(error: BaseException) -> bool:
+    """Whether an exception means that Elasticsearch is in trouble, rather than the query."""
+    if not isinstance(error, TransportError):
+        return False
+    # Connection errors and timeouts have no HTTP status.
+    return not isinstance(error.status_code, int) or error.status_code >= 500
+
+
+class CircuitBreaker(object):
+    """Opens when at least `error_threshold` of the last `window` queries failed or their
+    median latency exceeds `latency_threshold` seconds, once `min_queries` were observed."""
+
+    def __init__(
+            self,
+            error_threshold: float = 0.5,
+            latency_threshold: float = 10.0,
+            window: int = 50,
+            min_queries: int = 10,
+            open_duration: float = 30.0,
+            clock: Callable[[], float] = time.time
+    ):
+        self.error_threshold = error_threshold
+        self.latency_threshold = latency_threshold
+        self.min_queries = min_queries
+        self.open_duration = open_duration
+        self.clock = clock
+        self.state = CLOSED
+        self.opened_at = None
+        # (failed, latency) of recent queries
+        self.outcomes = deque(maxlen=window)
+        self.rejected = 0
+        self.openings = 0
+
+    def is_open(self) -> bool:
+        """Whether queries are currently rejected."""
+        return self.state != CLOSED and not (
+            self.state == OPEN and self.clock() >= self.opened_at + self.open_duration
+        )
+
+    def allow(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and self.clock() >= self.opened_at + self.open_duration:
+            # Let a single probe query through.
+            self.state = HALF_OPEN
+            return True
+        return False
+
+    def retry_after(self) -> int:
+        if self.opened_at is None:
+            return 1
+        remaining = self.opened_at + self.open_duration - self.clock()
+        return max(int(math.ceil(remaining)), 1)
+
+    def call(self, func: Callable, *args, **kwargs) -> Any:
+        if not self.allow():
+            self.rejected += 1
+            raise CircuitOpen(self.retry_after())
+        started_at = self.clock()
+        try:
+            result = func(*args, **kwargs)
+        except GreenletExit:
+            if self.state == HALF_OPEN:
+                # The probe query was cancelled, let the next one through instead.
+                self.state = OPEN
+            raise
+        except BaseException as e:
+            self.record(is_backend_failure(e), self.clock() - started_at)
+            raise
+        self.record(False, self.clock() - started_at)
+        return result
+
+    def record(self, failed: bool, latency: float):
+        if self.state == HALF_OPEN:
+            if failed or latency > self.latency_threshold:
+                self.open()
+            else:
+                log.info('Elasticsearch recovered, closing the circuit breaker.')
+                self.state = CLOSED
+                self.outcomes.clear()
+            return
+        self.outcomes.append((failed, latency))
+        if self.state == CLOSED and len(self.outcomes) >= self.min_queries:
+            error_rate = sum(failed for failed, _ in self.outcomes) / len(self.outcomes)
+            median_latency = percentile([latency for _, latency in self.outcomes], 0.5)
+            if error_rate >= self.error_threshold or median_latency > self.latency_threshold:
+                log.warning(
+                    'Opening the circuit breaker: error rate {:.2f}, median latency {:.2f}s.'
+                    .format(error_rate, median_latency)
+                )
+                self.open()
+
+    def open(self):
+        self.state = OPEN
+        self.opened_at = self.clock()
+        self.openings += 1
+        self.outcomes.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            state=self.state,
+            openings=self.openings,
+            rejected=self.rejected,
+        )
@@ -0,0 +1,495 @@
+import heapq
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+import gevent
+from gevent.event import AsyncResult
+from gevent.threading import Lock
+
+from .backend import Resource
+from .compression import Codec, CompressedContent
+
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_SIZE = 256 * 1024 ** 2
+
+# Rough per-container overhead in bytes, so that many tiny entries are not sized as free.
+CONTAINER_OVERHEAD = 16
+
+
+def estimate_size(content: Any) -> int:
+    """Estimate the memory/serialization footprint of a decoded Elasticsearch response.
+
+    This is roughly the length of its JSON representation and is only used for enforcing
+    the cache byte budget, so it favours speed over accuracy.
+    """
+    size = 0
+    stack = [content]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, (bytes, bytearray, str, CompressedContent)):
+            size += len(item)
+        elif isinstance(item, dict):
+            size += CONTAINER_OVERHEAD
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            size += CONTAINER_OVERHEAD
+            stack.extend(item)
+        else:
+            size += 8
+    return size
+
+
+def resource_size(resource: Resource) -> int:
+    return estimate_size(resource.content)
+
+
+def compress_resource(resource: Resource, codec: Codec = None) -> Resource:
+    if codec is None or isinstance(resource.content, (CompressedContent, int)):
+        return resource
+    return resource._replace(content=CompressedContent.compress(resource.content, codec))
+
+
+class CacheBackend(object):
+    """Interface of the result caches behind `APIServer`."""
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def __contains__(self, key: Hashable) -> bool:
+        raise NotImplementedError
+
+    def __getitem__(self, key: Hashable) -> Resource:
+        resource = self.get(key)
+        if resource is None:
+            raise KeyError(key)
+        return resource
+
+    def __setitem__(self, key: Hashable, resource: Resource):
+        self.put(key, resource)
+
+    def get(self, key: Hashable, ignore_expiry: bool = False) -> Optional[Resource]:
+        raise NotImplementedError
+
+    def put(self, key: Hashable, resource: Resource):
+        raise NotImplementedError
+
+    def update(self, resources: Dict[Hashable, Resource]):
+        for key, resource in resources.items():
+            self.put(key, resource)
+
+    def pop(self, key: Hashable, default: Resource = None) -> Optional[Resource]:
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def expire(self):
+        """Drop all expired entries."""
+        raise NotImplementedError
+
+    def promote(self, key: Hashable, resource: Resource):
+        """Called when `resource` was delivered to a paying client."""
+        pass
+
+    def stats(self) -> Dict[str, int]:
+        raise NotImplementedError
+
+
+class ResourceCache(CacheBackend):
+    """Byte-budgeted LRU cache for `Resource`s with heap-based expiry.
+
+    All lookups, insertions and evictions are O(1), expiry costs O(log n) per expired entry
+    instead of a scan over the whole cache. Entries larger than the budget are still admitted,
+    they are just the first to go once anything else is inserted.
+    With a `codec`, contents are stored compressed and handed out compressed as well.
+    Expired entries are kept for another `stale_ttl` seconds, only for `ignore_expiry` lookups.
+    """
+
+    def __init__(
+            self,
+            max_bytes: int = DEFAULT_CACHE_SIZE,
+            sizeof: Callable[[Resource], int] = resource_size,
+            clock: Callable[[], float] = time.time,
+            codec: Codec = None,
+            stale_ttl: float = 0
+    ):
+        assert max_bytes > 0
+        self.max_bytes = max_bytes
+        self.codec = codec
+        self.stale_ttl = stale_ttl
+        self.sizeof = sizeof
+        self.clock = clock
+        self.lock = Lock()
+        # key => (resource, size), ordered from least to most recently used
+        self.entries = OrderedDict()
+        # (removal time, sequence, key), may contain stale items of replaced/removed entries
+        self.expiry_heap = []
+        self.sequence = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.entries
+
+    def get(self, key: Hashable, ignore_expiry: bool = False) -> Optional[Resource]:
+        with self.lock:
+            entry = self.entries.get(key)
+            now = self.clock()
+            if entry is not None and not ignore_expiry and entry[0].expires_at < now:
+                if self._removal_time(entry[0]) < now:
+                    self._remove(key)
+                    self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, resource: Resource):
+        assert isinstance(resource, Resource)
+        resource = compress_resource(resource, self.codec)
+        size = self.sizeof(resource)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (resource, size)
+            self.size += size
+            self.sequence += 1
+            heapq.heappush(self.expiry_heap, (self._removal_time(resource), self.sequence, key))
+            self._expire(self.clock())
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+            self._compact()
+
+    def pop(self, key: Hashable, default: Resource = None) -> Optional[Resource]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            self._remove(key)
+            return entry[0]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.expiry_heap = []
+            self.size = 0
+
+    def expire(self):
+        with self.lock:
+            self._expire(self.clock())
+
+    def stats(self) -> Dict[str, int]:
+        return dict(
+            entries=len(self.entries),
+            size=self.size,
+            max_bytes=self.max_bytes,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            expirations=self.expirations,
+        )
+
+    def _remove(self, key: Hashable):
+        _, size = self.entries.pop(key)
+        self.size -= size
+
+    def _removal_time(self, resource: Resource) -> float:
+        return resource.expires_at + self.stale_ttl
+
+    def _is_current_item(self, item: tuple) -> bool:
+        entry = self.entries.get(item[2])
+        return entry is not None and self._removal_time(entry[0]) == item[0]
+
+    def _expire(self, now: float):
+        heap = self.expiry_heap
+        while heap and heap[0][0] < now:
+            item = heapq.heappop(heap)
+            # Skip heap items of entries that were replaced or removed in the meantime.
+            if self._is_current_item(item):
+                self._remove(item[2])
+                self.expirations += 1
+
+    def _compact(self):
+        # Stale heap items are dropped lazily, rebuild once they dominate the heap.
+        if len(self.expiry_heap) > 2 * len(self.entries) + 64:
+            self.expiry_heap = [item for item in self.expiry_heap if self._is_current_item(item)]
+            heapq.heapify(self.expiry_heap)
+
+
+class FrequencySketch(object):
+    """Count-min sketch of approximate access frequencies (as in TinyLFU).
+
+    Counters saturate at 15 and are all halved every `10 * width` increments, so that the
+    sketch follows changes in popularity.
+    """
+
+    # Odd 64 bit multipliers of the rows' hash functions. The low bits of hashes of tuples
+    # like `(row, key)` are too correlated across rows.
+    MULTIPLIERS = (
+        0x9E3779B97F4A7C15,
+        0xC2B2AE3D27D4EB4F,
+        0x165667B19E3779F9,
+        0xD6E8FEB86659FD93,
+    )
+    DEPTH = len(MULTIPLIERS)
+    MAX_COUNT = 15
+
+    def __init__(self, width: int = 2 ** 16):
+        assert width & (width - 1) == 0, 'width must be a power of two'
+        # Indexes are the top bits of the multiplied hashes.
+        self.shift = 64 - (width.bit_length() - 1)
+        self.rows = [bytearray(width) for _ in range(self.DEPTH)]
+        self.sample_size = 10 * width
+        self.additions = 0
+
+    def _indexes(self, key: Hashable):
+        key_hash = hash(key) & 0xFFFFFFFFFFFFFFFF
+        for row, multiplier in enumerate(self.MULTIPLIERS):
+            yield row, ((key_hash * multiplier) & 0xFFFFFFFFFFFFFFFF) >> self.shift
+
+    def frequency(self, key: Hashable) -> int:
+        return min(self.rows[row][i] for row, i in self._indexes(key))
+
+    def increment(self, key: Hashable):
+        indexes = list(self._indexes(key))
+        count = min(self.rows[row][i] for row, i in indexes)
+        if count >= self.MAX_COUNT:
+            return
+        # Conservative update: only raise the counters holding the minimum.
+        for row, i in indexes:
+            if self.rows[row][i] == count:
+                self.rows[row][i] = count + 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.reset()
+
+    def reset(self):
+        for row in self.rows:
+            row[:] = bytes(count >> 1 for count in row)
+        self.additions //= 2
+
+
+class AdmissionCache(CacheBackend):
+    """Two tier cache that protects results clients paid for from being flushed by results of
+    price probes that are never paid.
+
+    New results go to a small LRU probation tier. Results that are delivered (`promote`) move
+    to the protected tier if it has room, or if they were requested more often than the least
+    recently used protected entry according to a `FrequencySketch`. That entry is then demoted
+    to probation.
+    """
+
+    def __init__(
+            self,
+            max_bytes: int = DEFAULT_CACHE_SIZE,
+            probation_fraction: float = 0.2,
+            sizeof: Callable[[Resource], int] = resource_size,
+            clock: Callable[[], float] = time.time,
+            codec: Codec = None,
+            sketch: FrequencySketch = None,
+            stale_ttl: float = 0
+    ):
+        probation_bytes = max(int(max_bytes * probation_fraction), 1)
+        self.probation = ResourceCache(
+            max_bytes=probation_bytes,
+            sizeof=sizeof,
+            clock=clock,
+            codec=codec,
+            stale_ttl=stale_ttl
+        )
+        self.protected = ResourceCache(
+            max_bytes=max(max_bytes - probation_bytes, 1),
+            sizeof=sizeof,
+            clock=clock,
+            codec=codec,
+            stale_ttl=stale_ttl
+        )
+        self.sketch = sketch or FrequencySketch()
+        self.lookups = 0
+        self.probation_hits = 0
+        self.protected_hits = 0
+        self.admissions = 0
+        self.rejections = 0
+
+    def __len__(self) -> int:
+        return len(self.probation) + len(self.protected)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.protected or key in self.probation
+
+    @property
+    def size(self) -> int:
+        return self.probation.size + self.protected.size
+
+    def get(self, key: Hashable, ignore_expiry: bool = False) -> Optional[Resource]:
+        self.lookups += 1
+        self.sketch.increment(key)
+        if key in self.protected.entries:
+            resource = self.protected.get(key, ignore_expiry=ignore_expiry)
+            if resource is not None:
+                self.protected_hits += 1
+            return resource
+        resource = self.probation.get(key, ignore_expiry=ignore_expiry)
+        if resource is not None:
+            self.probation_hits += 1
+        return resource
+
+    def put(self, key: Hashable, resource: Resource):
+        if key in self.protected.entries:
+            self.protected.put(key, resource)
+        else:
+            self.probation.put(key, resource)
+
+    def promote(self, key: Hashable, resource: Resource):
+        if key in self.protected.entries:
+            return
+        protected = self.protected
+        size = protected.sizeof(compress_resource(resource, protected.codec))
+        if protected.size + size > protected.max_bytes and protected.entries:
+            victim = next(iter(protected.entries))
+            if self.sketch.frequency(key) <= self.sketch.frequency(victim):
+                self.rejections += 1
+                return
+        self.admissions += 1
+        self.probation.pop(key)
+        # Make room explicitly, so that the evicted entries can be demoted.
+        while protected.entries and protected.size + size > protected.max_bytes:
+            victim = next(iter(protected.entries))
+            self.probation.put(victim, protected.pop(victim))
+        protected.put(key, resource)
+
+    def pop(self, key: Hashable, default: Resource = None) -> Optional[Resource]:
+        resource = self.protected.pop(key)
+        if resource is None:
+            resource = self.probation.pop(key)
+        return default if resource is None else resource
+
+    def clear(self):
+        self.probation.clear()
+        self.protected.clear()
+
+    def expire(self):
+        self.probation.expire()
+        self.protected.expire()
+
+    def stats(self) -> Dict:
+        lookups = max(self.lookups, 1)
+        hits = self.probation_hits + self.protected_hits
+        return dict(
+            entries=len(self),
+            size=self.size,
+            hits=hits,
+            misses=self.lookups - hits,
+            evictions=self.probation.evictions + self.protected.evictions,
+            expirations=self.probation.expirations + self.protected.expirations,
+            probation_hit_rate=self.probation_hits / lookups,
+            protected_hit_rate=self.protected_hits / lookups,
+            admissions=self.admissions,
+            rejections=self.rejections,
+            probation=self.probation.stats(),
+            protected=self.protected.stats(),
+        )
+
+
+class Flight(object):
+    """A computation of `SingleFlight` and the callers waiting for it."""
+
+    def __init__(self):
+        self.result = AsyncResult()
+        self.worker = None
+        self.waiters = 0
+        self.started_at = time.time()
+
+
+class SingleFlight(object):
+    """Registry of in-flight computations, so that concurrent calls for the same key share
+    a single execution and its result (or exception).
+
+    Computations run in a greenlet of their own. Once all callers waiting for one are gone
+    (killed, e.g. because their clients disconnected), it is killed as well and `on_cancel`
+    is called with its key.
+    """
+
+    def __init__(self, on_cancel: Callable[[Hashable], Any] = None):
+        self.on_cancel = on_cancel
+        # key => Flight
+        self.in_flight = dict()
+        self.executions = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        # exponentially weighted moving average of execution times in seconds
+        self.average_run_time = None
+        # estimated seconds of computation that cancellations saved
+        self.time_saved = 0.0
+
+    def __len__(self) -> int:
+        return len(self.in_flight)
+
+    def run(self, key: Hashable, func: Callable, *args, **kwargs) -> Any:
+        flight = self.in_flight.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        else:
+            flight = Flight()
+            self.in_flight[key] = flight
+            self.executions += 1
+            flight.worker = gevent.spawn(self.execute, key, flight, func, *args, **kwargs)
+
+        flight.waiters += 1
+        try:
+            return flight.result.get()
+        finally:
+            flight.waiters -= 1
+            if not flight.waiters and not flight.result.ready():
+                self.cancel(key, flight)
+
+    def execute(self, key: Hashable, flight: Flight, func: Callable, *args, **kwargs):
+        try:
+            flight.result.set(func(*args, **kwargs))
+        except Exception as e:
+            flight.result.set_exception(e)
+        finally:
+            if self.in_flight.get(key) is flight:
+                del self.in_flight[key]
+        run_time = time.time() - flight.started_at
+        if self.average_run_time is None:
+            self.average_run_time = run_time
+        else:
+            self.average_run_time += 0.1 * (run_time - self.average_run_time)
+
+    def cancel(self, key: Hashable, flight: Flight):
+        if self.in_flight.get(key) is flight:
+            del self.in_flight[key]
+        flight.worker.kill(block=False)
+        self.cancelled += 1
+        # Assume the computation would have taken as long as usual.
+        saved = max((self.average_run_time or 0.0) - (time.time() - flight.started_at), 0.0)
+        self.time_saved += saved
+        log.info('Cancelled an abandoned query, saving about {:.2f}s.'.format(saved))
+        if self.on_cancel is not None:
+            gevent.spawn(self.on_cancel, key)
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            in_flight=len(self.in_flight),
+            executions=self.executions,
+            coalesced=self.coalesced,
+            cancelled=self.cancelled,
+            time_saved=self.time_saved,
+        )
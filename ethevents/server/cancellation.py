@@ -0,0 +1,132 @@
+"""Deadlines and cancellation of Elasticsearch queries.
+
+Every backend query gets a deadline, by default a fixed time budget per endpoint. The
+remaining budget is passed to Elasticsearch as search `timeout`, so that it returns what it
+found so far instead of working on a query nobody waits for anymore.
+
+Queries whose clients all disconnected are cancelled: their greenlet is killed, which closes
+the connection to Elasticsearch, and their Elasticsearch tasks are cancelled as well, found by
+the `X-Opaque-Id` header they were tagged with.
+"""
+import io
+import socket
+import time
+from typing import Any, Callable, Dict, Iterable, Optional
+
+import gevent
+import gevent.local
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Seconds an Elasticsearch request may take per endpoint, including time spent queued.
+DEFAULT_DEADLINES = {
+    '_search': 30.0,
+    '_msearch': 60.0,
+    '_mapping': 10.0,
+    '_count': 10.0,
+    '_exists': 10.0,
+}
+# Extra seconds the HTTP request to Elasticsearch gets beyond the search `timeout`, for
+# returning the partial results.
+TIMEOUT_GRACE = 1.0
+
+
+class DeadlineExceeded(Exception):
+    """The deadline of a query passed before it was sent to Elasticsearch."""
+
+
+class ClientDisconnected(gevent.GreenletExit):
+    """Kills the greenlet of a request whose client closed the connection."""
+
+
+class QueryContext(gevent.local.local):
+    """Per greenlet tags of the backend query being run."""
+    # `X-Opaque-Id` of the Elasticsearch requests
+    opaque_id = None
+    # time by which the query should be answered
+    deadline = None
+    # whether Elasticsearch response bodies are kept as the raw JSON, undecoded
+    raw = False
+
+    def remaining(self) -> Optional[float]:
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+
+query_context = QueryContext()
+
+
+def request_headers(headers: Dict[str, str] = None) -> Optional[Dict[str, str]]:
+    """`headers` of an Elasticsearch request, tagged with the current query."""
+    if query_context.opaque_id is None:
+        return headers
+    return dict(headers or {}, **{'X-Opaque-Id': query_context.opaque_id})
+
+
+def cancel_tasks(es, opaque_id: str) -> int:
+    """Cancel the running Elasticsearch searches tagged with `opaque_id`, return how many."""
+    tasks = es.tasks.list(actions='*search*', detailed=True)
+    task_ids = []
+    for node in tasks.get('nodes', {}).values():
+        for task_id, task in node.get('tasks', {}).items():
+            # Cancelling the parent task cancels its shard level children.
+            if 'parent_task_id' in task:
+                continue
+            if task.get('headers', {}).get('X-Opaque-Id') == opaque_id:
+                task_ids.append(task_id)
+    for task_id in task_ids:
+        es.tasks.cancel(task_id=task_id)
+    return len(task_ids)
+
+
+def client_socket(environ: Dict[str, Any]) -> Optional[socket.socket]:
+    """The connection to the client of a gevent `pywsgi` request, if it can be watched."""
+    if environ.get('wsgi.url_scheme') != 'http':
+        return None
+    rfile = getattr(environ.get('wsgi.input'), 'rfile', None)
+    return getattr(getattr(rfile, 'raw', None), '_sock', None)
+
+
+class DisconnectWatcher(object):
+    """WSGI middleware that kills the greenlet handling a request with `ClientDisconnected`
+    as soon as its client closes the connection.
+
+    The request body is read up front, so that the connection only becomes readable again
+    when it is closed (or the client pipelines its next request).
+    """
+
+    def __init__(self, app: Callable):
+        self.app = app
+        self.disconnects = 0
+
+    def __call__(self, environ: Dict[str, Any], start_response: Callable) -> Iterable[bytes]:
+        sock = client_socket(environ)
+        if sock is None or 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+            return self.app(environ, start_response)
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        if length:
+            environ['wsgi.input'] = io.BytesIO(environ['wsgi.input'].read(length))
+        watcher = gevent.spawn(self.watch, sock, gevent.getcurrent())
+        try:
+            return self.app(environ, start_response)
+        finally:
+            watcher.kill(block=False)
+
+    def watch(self, sock: socket.socket, greenlet: gevent.Greenlet):
+        while True:
+            try:
+                data = sock.recv(1, socket.MSG_PEEK)
+            except socket.timeout:
+                continue
+            except OSError:
+                data = b''
+            if data:
+                # The next request, the client is still there.
+                return
+            self.disconnects += 1
+            log.debug('Client disconnected, aborting its request.')
+            greenlet.kill(ClientDisconnected, block=False)
+            return
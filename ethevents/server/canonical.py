@@ -0,0 +1,98 @@
+"""Canonical forms of API requests.
+
+Two requests that Elasticsearch would answer identically should map to the same cache key,
+no matter which client library serialized them. Request keys are digested with blake2b, so
+unlike Python's `hash()` they are stable across processes and restarts.
+"""
+import hashlib
+import json
+from typing import Any, Iterable, Tuple
+from urllib.parse import urlencode
+
+from .msearch import loads
+
+KEY_DIGEST_SIZE = 16
+
+
+def normalize(value: Any) -> Any:
+    """Normalize numeric forms in a decoded JSON value, e.g. `1.0` and `1e0` become `1`."""
+    if isinstance(value, float):
+        if value.is_integer():
+            return int(value)
+        return value
+    if isinstance(value, dict):
+        return {key: normalize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [normalize(item) for item in value]
+    return value
+
+
+def dump_canonical(value: Any) -> bytes:
+    # JSON strings may contain lone surrogates like `"\ud800"`, which UTF-8 can not encode.
+    return json.dumps(
+        normalize(value),
+        sort_keys=True,
+        separators=(',', ':'),
+        ensure_ascii=False
+    ).encode('utf-8', errors='surrogatepass')
+
+
+def canonical_json(data: bytes) -> bytes:
+    """Canonical JSON document: sorted keys, no insignificant whitespace, normalized numbers.
+    Data that is not valid JSON is returned unchanged."""
+    if not data.strip():
+        return b''
+    try:
+        return dump_canonical(loads(data))
+    except ValueError:
+        return data
+
+
+def canonical_ndjson(data: bytes) -> bytes:
+    """Canonicalize each line of a NDJSON body (e.g. `_msearch`), dropping blank lines."""
+    return b'\n'.join(
+        canonical_json(line) for line in data.split(b'\n') if line.strip()
+    )
+
+
+def canonical_query_string(args: Iterable[Tuple[str, str]]) -> str:
+    return urlencode(sorted(args))
+
+
+def digest(*parts: bytes) -> str:
+    h = hashlib.blake2b(digest_size=KEY_DIGEST_SIZE)
+    for part in parts:
+        # Length prefixes keep the parts from bleeding into each other.
+        h.update(len(part).to_bytes(8, 'big'))
+        h.update(part)
+    return h.hexdigest()
+
+
+def request_key(method: str, path: str, args: Iterable[Tuple[str, str]], data: bytes) -> str:
+    path = path.lower()
+    if path.endswith('_msearch'):
+        body = canonical_ndjson(data)
+    else:
+        body = canonical_json(data)
+    return digest(
+        method.lower().encode('utf-8'),
+        path.encode('utf-8'),
+        canonical_query_string(args).encode('utf-8'),
+        body
+    )
+
+
+def msearch_item_key(
+        path: str,
+        args: Iterable[Tuple[str, str]],
+        header: Any,
+        body: Any
+) -> str:
+    """Key of a single search within a `_msearch`, independent of the other searches."""
+    return digest(
+        b'msearch-item',
+        path.lower().encode('utf-8'),
+        canonical_query_string(args).encode('utf-8'),
+        dump_canonical(header),
+        dump_canonical(body)
+    )
@@ -0,0 +1,122 @@
+"""Compressed representations of cached response contents.
+
+Contents are compressed once when they are cached and only decompressed when they are
+delivered. Gzip compressed contents are delivered as they are to clients that accept
+`Content-Encoding: gzip`.
+"""
+import json
+import zlib
+from typing import Any
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# zlib window bits for the gzip container format
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class Codec(object):
+    def __init__(self, codec_id: int, name: str, level: int):
+        self.codec_id = codec_id
+        self.name = name
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+
+class GzipCodec(Codec):
+    def __init__(self, level: int = 6):
+        super(GzipCodec, self).__init__(1, 'gzip', level)
+
+    def compress(self, data: bytes) -> bytes:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, GZIP_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data, GZIP_WBITS)
+
+
+class ZstdCodec(Codec):
+    def __init__(self, level: int = 3):
+        if zstandard is None:
+            raise RuntimeError('zstd compression requires the `zstandard` package.')
+        super(ZstdCodec, self).__init__(2, 'zstd', level)
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self.decompressor.decompress(data)
+
+
+CODECS = {
+    'gzip': GzipCodec,
+    'zstd': ZstdCodec,
+}
+
+
+def get_codec(name: str) -> Codec:
+    """Codec by name, `None` for 'none'. Falls back to gzip if zstd is not available."""
+    if name is None or name == 'none':
+        return None
+    if name == 'zstd' and zstandard is None:
+        name = 'gzip'
+    return CODECS[name]()
+
+
+_codecs_by_id = dict()
+
+
+def codec_by_id(codec_id: int) -> Codec:
+    """Codec for decompressing stored contents."""
+    codec = _codecs_by_id.get(codec_id)
+    if codec is None:
+        codec = {1: GzipCodec, 2: ZstdCodec}[codec_id]()
+        _codecs_by_id[codec_id] = codec
+    return codec
+
+
+class CompressedContent(object):
+    """A compressed response body. `raw` tells whether the uncompressed content was a raw
+    response body or a decoded JSON document."""
+    __slots__ = ('data', 'codec', 'raw')
+
+    def __init__(self, data: bytes, codec: Codec, raw: bool):
+        self.data = data
+        self.codec = codec
+        self.raw = raw
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, CompressedContent):
+            return False
+        return (self.data, self.codec.codec_id, self.raw) == \
+            (other.data, other.codec.codec_id, other.raw)
+
+    @classmethod
+    def compress(cls, content: Any, codec: Codec) -> 'CompressedContent':
+        raw = isinstance(content, bytes)
+        if not raw:
+            content = json.dumps(content, separators=(',', ':')).encode('utf-8')
+        return cls(codec.compress(content), codec, raw)
+
+    def decompress(self) -> bytes:
+        """The uncompressed JSON text."""
+        return self.codec.decompress(self.data)
+
+    def decode(self) -> Any:
+        """The content as it was before compression."""
+        data = self.decompress()
+        if self.raw:
+            return data
+        return json.loads(data.decode('utf-8'))
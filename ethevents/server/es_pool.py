@@ -0,0 +1,212 @@
+"""Elasticsearch transport for a cluster of several nodes.
+
+Requests are routed to the node with the fewest outstanding requests. Read requests that have
+not been answered by the time most requests are (`hedge_quantile` of recent latencies) are
+sent to a second node as well, and the first answer wins. This cuts the latency tail caused
+by single slow nodes (GC pauses, merges, hot shards).
+"""
+import random
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+import gevent
+from elasticsearch import Elasticsearch, Transport
+from elasticsearch.connection import Urllib3HttpConnection
+from elasticsearch.connection_pool import ConnectionSelector
+from elasticsearch.exceptions import ConnectionError
+
+from .cancellation import request_headers
+from .limiter import percentile
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Endpoints whose requests can be sent twice without side effects.
+READ_ENDPOINTS = ('_search', '_msearch', '_count', '_mapping')
+
+
+class NodeConnection(Urllib3HttpConnection):
+    """Keep-alive connection pool to a single node that counts its outstanding requests."""
+
+    def __init__(self, *args, **kwargs):
+        super(NodeConnection, self).__init__(*args, **kwargs)
+        self.outstanding = 0
+
+    def perform_request(self, *args, **kwargs):
+        self.outstanding += 1
+        try:
+            return super(NodeConnection, self).perform_request(*args, **kwargs)
+        finally:
+            self.outstanding -= 1
+
+
+class LeastOutstandingSelector(ConnectionSelector):
+    """Selects the node with the fewest outstanding requests, ties at random."""
+
+    def select(self, connections: List[NodeConnection]) -> NodeConnection:
+        fewest = min(connection.outstanding for connection in connections)
+        return random.choice([
+            connection for connection in connections if connection.outstanding == fewest
+        ])
+
+
+class HedgedConnection(object):
+    """Stands in for the selected connection, sending hedged requests through the transport."""
+
+    def __init__(self, transport: 'HedgingTransport', connection: NodeConnection):
+        self.transport = transport
+        self.connection = connection
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.connection, name)
+
+    def __repr__(self) -> str:
+        return '<Hedged: {!r}>'.format(self.connection)
+
+    def perform_request(self, method: str, url: str, *args, **kwargs):
+        return self.transport.perform_hedged(self.connection, method, url, *args, **kwargs)
+
+
+class HedgingTransport(Transport):
+    """Transport with least outstanding requests routing and hedged read requests.
+
+    Hedging starts once `min_samples` latencies were observed and waits at least
+    `min_hedge_delay` seconds.
+    """
+
+    def __init__(
+            self,
+            hosts,
+            hedge: bool = True,
+            hedge_quantile: float = 0.95,
+            min_hedge_delay: float = 0.05,
+            min_samples: int = 20,
+            **kwargs
+    ):
+        kwargs.setdefault('connection_class', NodeConnection)
+        kwargs.setdefault('selector_class', LeastOutstandingSelector)
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_delay = min_hedge_delay
+        self.min_samples = min_samples
+        # seconds of recent successful requests
+        self.latencies = deque(maxlen=1000)
+        self.cached_delay = None
+        self.hedged = 0
+        self.hedge_wins = 0
+        super(HedgingTransport, self).__init__(hosts, **kwargs)
+
+    def perform_request(self, method, url, headers=None, params=None, body=None):
+        return super(HedgingTransport, self).perform_request(
+            method,
+            url,
+            headers=request_headers(headers),
+            params=params,
+            body=body
+        )
+
+    def get_connection(self):
+        return HedgedConnection(self, super(HedgingTransport, self).get_connection())
+
+    def mark_dead(self, connection):
+        if isinstance(connection, HedgedConnection):
+            connection = connection.connection
+        super(HedgingTransport, self).mark_dead(connection)
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds to wait before hedging, `None` until enough latencies are known."""
+        if len(self.latencies) < self.min_samples:
+            return None
+        # Sorting the samples for every request would cost more than hedging saves.
+        if self.cached_delay is None or random.random() < 0.02:
+            self.cached_delay = max(
+                percentile(list(self.latencies), self.hedge_quantile),
+                self.min_hedge_delay
+            )
+        return self.cached_delay
+
+    def backup_connection(self, primary: NodeConnection) -> Optional[NodeConnection]:
+        others = [
+            connection for connection in self.connection_pool.connections
+            if connection is not primary
+        ]
+        if not others:
+            return None
+        return self.connection_pool.selector.select(others)
+
+    def timed_request(self, connection: NodeConnection, method: str, url: str, *args, **kwargs):
+        started_at = time.time()
+        try:
+            result = connection.perform_request(method, url, *args, **kwargs)
+        except ConnectionError:
+            self.connection_pool.mark_dead(connection)
+            raise
+        self.latencies.append(time.time() - started_at)
+        return result
+
+    def perform_hedged(self, connection: NodeConnection, method: str, url: str, *args, **kwargs):
+        delay = self.hedge_delay() if self.hedge else None
+        endpoint = url.split('?')[0].rstrip('/').rsplit('/', 1)[-1]
+        if delay is None or (method != 'HEAD' and endpoint not in READ_ENDPOINTS):
+            return self.timed_request(connection, method, url, *args, **kwargs)
+
+        primary = gevent.spawn(self.timed_request, connection, method, url, *args, **kwargs)
+        pending = [primary]
+        try:
+            if not gevent.wait(pending, timeout=delay, count=1):
+                backup = self.backup_connection(connection)
+                if backup is not None:
+                    self.hedged += 1
+                    pending.append(
+                        gevent.spawn(self.timed_request, backup, method, url, *args, **kwargs)
+                    )
+            error = None
+            while pending:
+                for attempt in gevent.wait(pending, count=1):
+                    pending.remove(attempt)
+                    if attempt.successful():
+                        if attempt is not primary:
+                            self.hedge_wins += 1
+                        return attempt.value
+                    error = error or attempt.exception
+            raise error
+        finally:
+            # The losing request is cancelled, its connection is closed and not reused.
+            gevent.killall(pending, block=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            nodes={
+                connection.host: getattr(connection, 'outstanding', 0)
+                for connection in self.connection_pool.connections
+            },
+            hedge_delay=self.hedge_delay(),
+            hedged=self.hedged,
+            hedge_wins=self.hedge_wins,
+        )
+
+
+def connect(
+        hosts: List[str],
+        sniff: bool = False,
+        hedge: bool = True,
+        pool_size: int = 64,
+        **kwargs
+) -> Elasticsearch:
+    """Client for the cluster of `hosts`, with `pool_size` keep-alive connections per node.
+
+    The pool should be about as large as the number of concurrent queries, so that no greenlet
+    waits for a connection.
+    """
+    return Elasticsearch(
+        hosts,
+        transport_class=HedgingTransport,
+        hedge=hedge,
+        maxsize=pool_size,
+        sniff_on_start=sniff,
+        sniff_on_connection_fail=sniff,
+        sniffer_timeout=60 if sniff else None,
+        **kwargs
+    )
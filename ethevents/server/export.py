@@ -0,0 +1,94 @@
+"""Paginated export of all documents matching a query.
+
+Each page is a separate paid request, which continues after the last document of the
+previous page with `search_after`. Unlike deep `from`/`size` pagination, every page costs
+about the same, and the server keeps no state between pages: the cursor to the next page is
+handed to the client, which can resume from it at any time.
+
+Pages are delivered as NDJSON, one hit per line, followed by a line with the cursor of the
+next page (`null` after the last page).
+"""
+import base64
+import binascii
+import copy
+import json
+from typing import Any, Dict, Iterator, List, Optional
+
+from ethevents.config import BLOCK, LOG, TX
+from .finality import as_list
+
+# Hits per page, unless the query asks for fewer.
+EXPORT_PAGE_SIZE = 1000
+# Sort on fields unique to each document last, so that the sort order is total and no hits
+# are skipped or repeated between pages. Unlike `_id`, they have doc values.
+TIEBREAKERS = {
+    BLOCK: ['hash'],
+    TX: ['hash'],
+    LOG: ['transactionHash', 'logIndex.num'],
+}
+# Documents of different types can only be told apart by their id.
+DEFAULT_TIEBREAKERS = ['_id']
+# Parts of a search body that make no sense for an export.
+IGNORED_KEYS = ('from', 'aggs', 'aggregations', 'search_after', 'scroll')
+
+
+def encode_cursor(sort_values: List[Any]) -> str:
+    data = json.dumps(sort_values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    """The sort values of the last exported hit, `ValueError` if `cursor` is invalid."""
+    try:
+        sort_values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (binascii.Error, UnicodeError) as e:
+        raise ValueError(e)
+    if not isinstance(sort_values, list):
+        raise ValueError('Cursor is not a list of sort values.')
+    return sort_values
+
+
+def sort_fields(sort: List[Any]) -> List[str]:
+    fields = []
+    for item in sort:
+        fields.extend(item if isinstance(item, dict) else [item])
+    return fields
+
+
+def page_body(body: Optional[Dict], cursor: str = None, doc_type: str = None) -> Dict:
+    """Search body for the page of an export of documents of `doc_type` with search `body`
+    after `cursor`."""
+    page = copy.deepcopy(body) if isinstance(body, dict) else {}
+    for key in IGNORED_KEYS:
+        page.pop(key, None)
+    try:
+        size = int(page.get('size', EXPORT_PAGE_SIZE))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid page size.')
+    page['size'] = min(max(size, 1), EXPORT_PAGE_SIZE)
+    sort = as_list(page.get('sort'))
+    fields = sort_fields(sort)
+    if '_id' not in fields:
+        sort = sort + [
+            {field: 'asc'} for field in TIEBREAKERS.get(doc_type, DEFAULT_TIEBREAKERS)
+            if field not in fields
+        ]
+    page['sort'] = sort
+    if cursor is not None:
+        page['search_after'] = decode_cursor(cursor)
+    return page
+
+
+def next_cursor(response: Dict, page_size: int) -> Optional[str]:
+    """Cursor of the page after `response`, `None` if it was the last one."""
+    hits = response.get('hits', {}).get('hits', [])
+    if len(hits) < page_size:
+        return None
+    return encode_cursor(hits[-1]['sort'])
+
+
+def export_lines(response: Dict, page_size: int) -> Iterator[bytes]:
+    """NDJSON lines of an export page."""
+    for hit in response.get('hits', {}).get('hits', []):
+        yield json.dumps(hit, separators=(',', ':')).encode('utf-8') + b'\n'
+    yield json.dumps({'next': next_cursor(response, page_size)}).encode('utf-8') + b'\n'
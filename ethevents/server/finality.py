@@ -0,0 +1,170 @@
+"""Analysis of which blocks a query can match.
+
+Results of queries that only cover blocks older than `INDEXING_REORG_SAFE` blocks can not
+change anymore, so they never need to be recomputed. Queries over ranges of blocks reaching
+up to the chain head can be split into such a finalized part and a small live tail.
+"""
+import copy
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+# Block number fields of the block, tx and log documents.
+BLOCK_FIELDS = ('number', 'number.num', 'blockNumber', 'blockNumber.num')
+TIMESTAMP_FIELD = 'timestamp'
+# Fields range queries can be split on.
+SPLIT_FIELDS = BLOCK_FIELDS + (TIMESTAMP_FIELD, )
+LOWER_BOUND_KEYS = ('gt', 'gte')
+
+
+def as_list(value: Any) -> list:
+    if isinstance(value, list):
+        return value
+    if value is None:
+        return []
+    return [value]
+
+
+def conjunctive_clauses(query: Dict) -> Iterator[Dict]:
+    """All clauses of `query` that each document matching the query must match."""
+    stack = [query]
+    while stack:
+        clause = stack.pop()
+        if not isinstance(clause, dict):
+            continue
+        yield clause
+        if 'bool' in clause and isinstance(clause['bool'], dict):
+            for context in ('must', 'filter'):
+                stack.extend(as_list(clause['bool'].get(context)))
+        elif 'constant_score' in clause and isinstance(clause['constant_score'], dict):
+            stack.extend(as_list(clause['constant_score'].get('filter')))
+
+
+def clause_fields(clause: Dict, clause_type: str) -> Iterator:
+    """(field, spec) pairs of a field level clause like `range` or `term`."""
+    fields = clause.get(clause_type)
+    if isinstance(fields, dict):
+        return iter(fields.items())
+    return iter(())
+
+
+def range_upper_bound(spec: Dict) -> Optional[int]:
+    try:
+        if 'lte' in spec:
+            return int(spec['lte'])
+        if 'lt' in spec:
+            return int(spec['lt']) - 1
+        if spec.get('to') is not None:
+            return int(spec['to']) - (0 if spec.get('include_upper', True) else 1)
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def uses_global(aggs: Any) -> bool:
+    """Whether any of `aggs`, at any depth, is a `global` aggregation, which ignores the
+    query."""
+    if not isinstance(aggs, dict):
+        return False
+    for spec in aggs.values():
+        if not isinstance(spec, dict):
+            continue
+        if 'global' in spec:
+            return True
+        if uses_global(spec.get('aggs', spec.get('aggregations'))):
+            return True
+    return False
+
+
+def block_upper_bound(body: Dict) -> Optional[int]:
+    """The highest block number a search body can match, `None` if it is not bounded."""
+    if not isinstance(body, dict) or not isinstance(body.get('query'), dict):
+        return None
+    if uses_global(body.get('aggs', body.get('aggregations'))):
+        return None
+    bounds = []
+    for clause in conjunctive_clauses(body['query']):
+        for field, spec in clause_fields(clause, 'range'):
+            if field in BLOCK_FIELDS and isinstance(spec, dict):
+                bound = range_upper_bound(spec)
+                if bound is not None:
+                    bounds.append(bound)
+        for field, spec in clause_fields(clause, 'term'):
+            if field in BLOCK_FIELDS:
+                if isinstance(spec, dict):
+                    spec = spec.get('value')
+                try:
+                    bounds.append(int(spec))
+                except (TypeError, ValueError):
+                    pass
+    return min(bounds, default=None)
+
+
+def is_relative(value: Any) -> bool:
+    """Whether a range bound uses date math relative to the current time."""
+    return isinstance(value, str) and 'now' in value
+
+
+def split_range(body: Dict) -> Optional[Tuple[str, Dict]]:
+    """The (field, bounds) of the only range clause on a block number or timestamp field that
+    all results of `body` must match, `None` if there is no such single clause."""
+    if not isinstance(body, dict) or not isinstance(body.get('query'), dict):
+        return None
+    ranges = [
+        (field, spec)
+        for clause in conjunctive_clauses(body['query'])
+        for field, spec in clause_fields(clause, 'range')
+        if field in SPLIT_FIELDS and isinstance(spec, dict)
+    ]
+    if len(ranges) != 1:
+        return None
+    return ranges[0]
+
+
+def range_lower_bound(spec: Dict) -> Optional[int]:
+    try:
+        if 'gte' in spec:
+            return int(spec['gte'])
+        if 'gt' in spec:
+            return int(spec['gt']) + 1
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def restrict(body: Dict, field: str, bounds: Dict) -> Dict:
+    """Copy of `body` whose query additionally filters on the range `bounds` of `field`."""
+    restricted = copy.deepcopy(body)
+    restricted['query'] = {
+        'bool': {
+            'must': [restricted['query']],
+            'filter': [{'range': {field: bounds}}],
+        }
+    }
+    return restricted
+
+
+def split_query(body: Dict, boundary: Any) -> Optional[Tuple[str, Dict, Dict]]:
+    """Split a search body into the part matching only documents up to `boundary` (a block
+    number or block timestamp, depending on the range field) and the part above it.
+
+    Returns the range field and both parts, or `None` if the query can not be split, e.g.
+    because its lower bound is relative to the current time (then the lower part would never
+    be the same twice) or it does not cover blocks on both sides of `boundary`.
+    """
+    found = split_range(body)
+    if found is None:
+        return None
+    field, spec = found
+    if any(is_relative(spec.get(key)) for key in LOWER_BOUND_KEYS + ('from', )):
+        return None
+    if field in BLOCK_FIELDS:
+        upper_bound = range_upper_bound(spec)
+        if upper_bound is not None and upper_bound <= boundary:
+            return None
+        lower_bound = range_lower_bound(spec)
+        if lower_bound is not None and lower_bound > boundary:
+            return None
+    return (
+        field,
+        restrict(body, field, {'lte': boundary}),
+        restrict(body, field, {'gt': boundary})
+    )
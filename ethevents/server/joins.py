@@ -0,0 +1,472 @@
+"""Precomputed joins of logs with their transactions and blocks.
+
+Searches for the transactions or blocks that emitted certain logs (`has_child` joins, e.g.
+`gas_prices_for_event` or `last_blocks_that_logged`) make Elasticsearch collect the parents of
+all matching logs for every search. Most of them join on a single event signature or contract
+address, so for such keys the parents are held in memory: transactions as a sorted array of
+ordinals of their hashes, blocks as a sorted array of block numbers.
+
+Only logs of finalized blocks are held, up to the block a key was last refreshed at. A join in
+filter context is rewritten into an `ids` (transactions) or `terms` (blocks) filter on the held
+parents, or the original join restricted to logs above that block. Both match the same
+documents as the join. If the parents are too many for one filter, the search is split into
+disjoint parts, one per shard of ids plus one for the newer blocks, whose responses are merged.
+
+Keys are loaded in the background when a paid search first joins on them. Until then, and for
+keys of more than `max_size` logs, searches are left as they are. The table of transaction hashes
+is rebuilt without the ones no key refers to anymore when it outgrows `max_transactions`.
+"""
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import gevent
+from elasticsearch.helpers import scan
+
+from ethevents.config import BLOCK, ETH_INDEX, LOG, TX
+from .blocks import BlockTracker
+from .finality import as_list
+from .optimizer import BOOL_CONTEXTS, INHERITING_CLAUSES
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Log fields joins are precomputed for.
+KEY_FIELDS = ('signature', 'address')
+BLOCK_NUMBER_FIELD = 'blockNumber.num'
+# Join parameters that depend on more than whether a matching child exists.
+EXCLUDED_PARAMS = ('min_children', 'max_children', 'inner_hits', '_name')
+# Typecode of the arrays of parents, 4 byte unsigned integers.
+PARENTS_TYPECODE = 'I'
+
+# Parents of the logs with one key, and the number of these logs, up to block `height`.
+JoinSet = namedtuple('JoinSet', ['txs', 'blocks', 'logs', 'height'])
+# A join the index can answer: its parent type and the keys of the logs it matches.
+Join = namedtuple('Join', ['params', 'parent_type', 'keys'])
+Key = Tuple[str, str]
+
+
+def term_keys(query: Any, fields: Iterable[str]) -> Optional[List[Key]]:
+    """The (field, value) keys a document must have one of to match `query`, `None` if it is
+    not a plain term query on one of `fields`."""
+    if not isinstance(query, dict) or len(query) != 1:
+        return None
+    ((clause_type, params), ) = query.items()
+    if clause_type not in ('term', 'terms', 'match') or not isinstance(params, dict):
+        return None
+    if len(params) != 1:
+        return None
+    ((field, value), ) = params.items()
+    if field not in fields:
+        return None
+    if clause_type == 'terms':
+        values = value if isinstance(value, list) else None
+    elif isinstance(value, dict):
+        # Keyword fields match the whole value, like `term`.
+        option = 'value' if clause_type == 'term' else 'query'
+        values = [value[option]] if list(value) == [option] else None
+    else:
+        values = [value]
+    if not values or not all(isinstance(value, str) for value in values):
+        return None
+    return [(field, value) for value in values]
+
+
+def parse_join(params: Dict) -> Optional[Join]:
+    """The `Join` of the parameters of a `has_child` clause, `None` if it is not eligible."""
+    if any(key in params for key in EXCLUDED_PARAMS):
+        return None
+    query = params.get('query')
+    if params.get('type') == LOG:
+        keys = term_keys(query, KEY_FIELDS)
+        return None if keys is None else Join(params, TX, keys)
+    if params.get('type') == TX and isinstance(query, dict) and list(query) == ['has_child']:
+        inner = query['has_child']
+        if isinstance(inner, dict) and inner.get('type') == LOG:
+            join = parse_join(inner)
+            return None if join is None else Join(params, BLOCK, join.keys)
+    return None
+
+
+def restrict_join(params: Dict, height: int) -> Dict:
+    """The `has_child` clause with the parameters `params`, only joining logs above block
+    `height`."""
+    query = params['query']
+    if params['type'] == TX:
+        query = restrict_join(query['has_child'], height)
+    else:
+        query = {'bool': {'filter': [
+            query,
+            {'range': {BLOCK_NUMBER_FIELD: {'gt': height}}},
+        ]}}
+    return {'has_child': dict(params, query=query)}
+
+
+def merge_sorted(values: array, new_values: Iterable[int]) -> array:
+    return array(PARENTS_TYPECODE, sorted(set(values).union(new_values)))
+
+
+def walk(query: Any, replace: Callable, filter_context: bool, conjunctive: bool) -> Any:
+    """`query` with every eligible join in filter context replaced by `replace(join,
+    conjunctive)`, `conjunctive` if all documents matching `query` must match the join."""
+    if not isinstance(query, dict) or len(query) != 1:
+        return query
+    ((clause_type, params), ) = query.items()
+    if not isinstance(params, dict):
+        return query
+    if clause_type == 'has_child' and filter_context:
+        join = parse_join(params)
+        if join is not None:
+            return replace(join, conjunctive)
+    if clause_type == 'bool':
+        params = dict(params)
+        for context in BOOL_CONTEXTS:
+            if context not in params:
+                continue
+            clauses = [
+                walk(
+                    clause,
+                    replace,
+                    filter_context or context in ('filter', 'must_not'),
+                    conjunctive and context in ('must', 'filter')
+                )
+                for clause in as_list(params[context])
+            ]
+            params[context] = clauses if isinstance(params[context], list) else clauses[0]
+        return {clause_type: params}
+    if clause_type == 'constant_score' and 'filter' in params:
+        return {clause_type: dict(
+            params,
+            filter=walk(params['filter'], replace, True, conjunctive)
+        )}
+    if clause_type in INHERITING_CLAUSES:
+        # The sub-queries match other documents (or are only optional).
+        params = dict(params)
+        for key in INHERITING_CLAUSES[clause_type]:
+            if key not in params:
+                continue
+            queries = [walk(q, replace, filter_context, False) for q in as_list(params[key])]
+            params[key] = queries if isinstance(params[key], list) else queries[0]
+        return {clause_type: params}
+    return query
+
+
+class JoinIndex(object):
+    """Parents of the logs with a certain signature or address, loaded on demand and
+    refreshed in the background as blocks become final.
+
+    At most `max_keys` keys are held, the least recently used ones are dropped first, also
+    when their transactions do not fit in `max_transactions`. Parent filters have at most
+    `shard_size` ids, larger sets are only used by searches that can be split. At most
+    `max_pending` keys are loaded at a time, further requests are dropped.
+    """
+
+    def __init__(
+            self,
+            es,
+            block_tracker: BlockTracker,
+            max_keys: int = 1000,
+            max_size: int = 50000,
+            shard_size: int = 10000,
+            refresh_interval: float = 60,
+            max_transactions: int = 500000,
+            max_pending: int = 10
+    ):
+        self.es = es
+        self.block_tracker = block_tracker
+        self.max_keys = max_keys
+        self.max_size = max_size
+        self.max_transactions = max_transactions
+        self.max_pending = max_pending
+        self.shard_size = shard_size
+        self.refresh_interval = refresh_interval
+        # key => JoinSet, `None` for keys of too many logs, least recently used first
+        self.sets = OrderedDict()
+        # keys being loaded
+        self.pending = set()
+        # transaction hash <=> ordinal
+        self.hashes = []
+        self.ordinals = dict()
+        self.refreshed_at = None
+        self.greenlet = None
+
+    def intern(self, tx_hash: str) -> int:
+        ordinal = self.ordinals.get(tx_hash)
+        if ordinal is None:
+            ordinal = self.ordinals[tx_hash] = len(self.hashes)
+            self.hashes.append(tx_hash)
+        return ordinal
+
+    def compact(self):
+        """Rebuild the transaction table with only the transactions of held keys. Ordinals
+        keep their order, so the arrays of parents stay sorted."""
+        used = sorted(set().union(*(
+            join_set.txs for join_set in self.sets.values() if join_set is not None
+        )))
+        renumbered = {ordinal: number for number, ordinal in enumerate(used)}
+        self.hashes = [self.hashes[ordinal] for ordinal in used]
+        self.ordinals = {tx_hash: number for number, tx_hash in enumerate(self.hashes)}
+        for key, join_set in list(self.sets.items()):
+            if join_set is not None:
+                self.sets[key] = join_set._replace(txs=array(
+                    PARENTS_TYPECODE,
+                    (renumbered[ordinal] for ordinal in join_set.txs)
+                ))
+
+    def trim(self):
+        """Keep the transaction table within `max_transactions`."""
+        if len(self.hashes) <= self.max_transactions:
+            return
+        # Leave room for new transactions, so that this is rarely needed.
+        budget = self.max_transactions // 2
+        held = sum(len(join_set.txs) for join_set in self.sets.values() if join_set is not None)
+        while held > budget:
+            _, join_set = self.sets.popitem(last=False)
+            if join_set is not None:
+                held -= len(join_set.txs)
+        self.compact()
+
+    def store(self, key: Key, join_set: Optional[JoinSet]):
+        self.sets[key] = join_set
+        self.sets.move_to_end(key)
+        while len(self.sets) > self.max_keys:
+            self.sets.popitem(last=False)
+        self.trim()
+
+    def fetch(
+            self,
+            field: str,
+            values: List[str],
+            above: Optional[int],
+            height: int
+    ) -> Dict[str, list]:
+        """value => [number of logs, tx hashes, block numbers] of the logs with one of
+        `values` in `field` in the blocks above `above` up to `height`."""
+        bounds = {'lte': height}
+        if above is not None:
+            bounds['gt'] = above
+        body = {
+            'query': {'bool': {'filter': [
+                {'terms': {field: values}},
+                {'range': {BLOCK_NUMBER_FIELD: bounds}},
+            ]}},
+            '_source': [field, 'transactionHash', BLOCK_NUMBER_FIELD],
+        }
+        found = dict()
+        for hit in scan(self.es, query=body, index=ETH_INDEX, doc_type=LOG, size=5000):
+            source = hit['_source']
+            entry = found.setdefault(source[field], [0, set(), set()])
+            entry[0] += 1
+            # Interned once stored, the table may be rebuilt meanwhile.
+            entry[1].add(source['transactionHash'])
+            entry[2].add(int(source['blockNumber']['num']))
+        return found
+
+    def load(self, key: Key):
+        """Load the parents of the logs with `key` in all finalized blocks."""
+        field, value = key
+        height = self.block_tracker.finalized_height
+        if height is None:
+            return
+        count = self.es.count(index=ETH_INDEX, doc_type=LOG, body={'query': {'bool': {
+            'filter': [
+                {'term': {field: value}},
+                {'range': {BLOCK_NUMBER_FIELD: {'lte': height}}},
+            ]
+        }}})['count']
+        if count > self.max_size:
+            log.debug('Not holding the join on {} {}, {} logs.'.format(field, value, count))
+            self.store(key, None)
+            return
+        logs, txs, blocks = self.fetch(field, [value], None, height).get(value, (0, (), ()))
+        self.store(key, JoinSet(
+            txs=merge_sorted(array(PARENTS_TYPECODE), map(self.intern, sorted(txs))),
+            blocks=merge_sorted(array(PARENTS_TYPECODE), blocks),
+            logs=logs,
+            height=height
+        ))
+
+    def run_load(self, key: Key, run: Callable = None):
+        try:
+            if run is None:
+                self.load(key)
+            else:
+                run(self.load, key)
+        except Exception as e:
+            log.warning('Could not load the join on {} {}: {}'.format(key[0], key[1], e))
+        finally:
+            self.pending.discard(key)
+
+    def request(self, key: Key, run: Callable = None):
+        """Load `key` in the background, by `run(load, key)` if given (e.g. through a
+        limiter)."""
+        if key not in self.pending and len(self.pending) < self.max_pending:
+            self.pending.add(key)
+            gevent.spawn(self.run_load, key, run)
+
+    def refresh(self) -> bool:
+        """Add the logs of newly finalized blocks to all held keys, return whether that
+        succeeded."""
+        height = self.block_tracker.finalized_height
+        if height is None:
+            return False
+        # (field, height) => values, usually a single group per field
+        groups = dict()
+        for (field, value), join_set in self.sets.items():
+            if join_set is not None and join_set.height < height:
+                groups.setdefault((field, join_set.height), []).append(value)
+        for (field, above), values in groups.items():
+            try:
+                found = self.fetch(field, values, above, height)
+            except Exception as e:
+                log.warning('Could not refresh the joins on {}: {}'.format(field, e))
+                return False
+            for value in values:
+                key = (field, value)
+                join_set = self.sets.get(key)
+                if join_set is None or join_set.height != above:
+                    # Dropped or reloaded meanwhile.
+                    continue
+                logs, txs, blocks = found.get(value, (0, (), ()))
+                if join_set.logs + logs > self.max_size:
+                    self.sets[key] = None
+                elif logs:
+                    self.sets[key] = JoinSet(
+                        txs=merge_sorted(join_set.txs, map(self.intern, sorted(txs))),
+                        blocks=merge_sorted(join_set.blocks, blocks),
+                        logs=join_set.logs + logs,
+                        height=height
+                    )
+                else:
+                    self.sets[key] = join_set._replace(height=height)
+        self.trim()
+        self.refreshed_at = time.time()
+        return True
+
+    def parents(self, join: Join) -> Optional[Tuple[array, int]]:
+        """The sorted parents matched by `join` up to the returned block height, `None` if
+        not all keys are held."""
+        join_sets = []
+        for key in join.keys:
+            if key in self.sets:
+                self.sets.move_to_end(key)
+                join_sets.append(self.sets[key])
+        if len(join_sets) < len(join.keys) or any(s is None for s in join_sets):
+            return None
+        height = join_sets[0].height
+        if any(join_set.height != height for join_set in join_sets):
+            # Until the next refresh brings all keys to the same block.
+            return None
+        field = 'txs' if join.parent_type == TX else 'blocks'
+        parents = getattr(join_sets[0], field)
+        if len(join_sets) > 1:
+            parents = merge_sorted(parents, (
+                parent for join_set in join_sets[1:] for parent in getattr(join_set, field)
+            ))
+        return parents, height
+
+    def parents_filter(self, parent_type: str, parents: Iterable[int]) -> Dict:
+        if parent_type == TX:
+            return {'ids': {'type': TX, 'values': [self.hashes[ordinal] for ordinal in parents]}}
+        return {'bool': {'filter': [
+            {'type': {'value': BLOCK}},
+            {'terms': {'number.num': list(parents)}},
+        ]}}
+
+    def wanted(self, body: Any) -> List[Key]:
+        """The keys joins of `body` are on which are not held (or being loaded) yet."""
+        if not isinstance(body, dict) or not isinstance(body.get('query'), dict):
+            return []
+        keys = []
+
+        def collect(join: Join, conjunctive: bool) -> Dict:
+            keys.extend(
+                key for key in join.keys
+                if key not in self.sets and key not in self.pending and key not in keys
+            )
+            return {'has_child': join.params}
+
+        walk(body['query'], collect, False, True)
+        return keys
+
+    def rewrite(self, body: Any, shardable: bool = False) -> Optional[List[Dict]]:
+        """The bodies to search instead of `body`: one equivalent body or, if `shardable`,
+        several disjoint parts whose responses are merged. `None` if no join was rewritten.
+        """
+        if not isinstance(body, dict) or not isinstance(body.get('query'), dict):
+            return None
+        joins = []
+
+        def collect(join: Join, conjunctive: bool) -> Dict:
+            joins.append((self.parents(join), conjunctive))
+            return {'has_child': join.params}
+
+        walk(body['query'], collect, False, True)
+        large = [
+            number for number, (found, _) in enumerate(joins)
+            if found is not None and len(found[0]) > self.shard_size
+        ]
+        sharded = None
+        if shardable and len(large) == 1 and joins[large[0]][1]:
+            sharded = large[0]
+        # Other large sets would make the filters too long.
+        resolved = [
+            None if number in large and number != sharded else found
+            for number, (found, _) in enumerate(joins)
+        ]
+        if all(found is None for found in resolved):
+            return None
+
+        def build(part: Optional[int]) -> Dict:
+            """`body` with all joins rewritten, the sharded one into shard `part` of the
+            parents (or its tail, if `None`)."""
+            numbers = iter(range(len(resolved)))
+
+            def replace(join: Join, conjunctive: bool) -> Dict:
+                number = next(numbers)
+                if resolved[number] is None:
+                    return {'has_child': join.params}
+                parents, height = resolved[number]
+                tail = restrict_join(join.params, height)
+                if number == sharded:
+                    if part is None:
+                        return tail
+                    shard = parents[part * self.shard_size:(part + 1) * self.shard_size]
+                    return self.parents_filter(join.parent_type, shard)
+                if not parents:
+                    return tail
+                return {'bool': {
+                    'should': [self.parents_filter(join.parent_type, parents), tail],
+                    'minimum_should_match': 1,
+                }}
+
+            return dict(body, query=walk(body['query'], replace, False, True))
+
+        if sharded is None:
+            return [build(None)]
+        shards = -(-len(resolved[sharded][0]) // self.shard_size)
+        return [build(part) for part in range(shards)] + [build(None)]
+
+    def run(self):
+        while True:
+            gevent.sleep(self.refresh_interval)
+            self.refresh()
+
+    def start(self):
+        assert self.greenlet is None
+        self.greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+
+    def stats(self) -> Dict:
+        return dict(
+            keys=sum(1 for join_set in self.sets.values() if join_set is not None),
+            oversized=sum(1 for join_set in self.sets.values() if join_set is None),
+            transactions=len(self.hashes),
+            refreshed_at=self.refreshed_at,
+        )
@@ -0,0 +1,334 @@
+"""Admission control for Elasticsearch queries.
+
+Backend queries run through a `ConcurrencyLimiter`, which bounds the number of concurrent
+Elasticsearch requests. Further queries wait in a bounded queue. Queries that would not start
+before the queue deadline are rejected right away, so that clients can retry later instead of
+piling up behind a burst of heavy queries.
+
+Waiting queries are scheduled fairly across senders by a `FairQueue`, so that a single client
+can not monopolize Elasticsearch.
+"""
+import heapq
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, Hashable
+
+from gevent import GreenletExit
+from gevent.event import Event
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """The backend is saturated. Retrying after `retry_after` seconds may succeed."""
+
+    def __init__(self, retry_after: float):
+        super(Overloaded, self).__init__(retry_after)
+        self.retry_after = retry_after
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class FifoQueue(object):
+    """Waiting queries in arrival order."""
+
+    def __init__(self):
+        self.waiters = deque()
+
+    def __len__(self) -> int:
+        return len(self.waiters)
+
+    def push(self, waiter: Event, sender: Hashable = None, weight: float = 1.0):
+        self.waiters.append(waiter)
+
+    def pop(self) -> Event:
+        return self.waiters.popleft()
+
+    def remove(self, waiter: Event):
+        self.waiters.remove(waiter)
+
+
+class FairQueue(object):
+    """Weighted fair queue of waiting queries.
+
+    Each query gets a virtual finish time of `1 / weight` after the later of the current
+    virtual time and the finish time of the sender's previous query. Queries are started in
+    order of finish time, so backlogged senders get slots in proportion to their weights,
+    no matter how many queries each of them has queued.
+    """
+
+    def __init__(self):
+        # (finish time, sequence, waiter)
+        self.heap = []
+        self.sequence = 0
+        self.virtual_time = 0.0
+        # sender => finish time of their last queued query
+        self.finish_times = dict()
+        self.removed = set()
+
+    def __len__(self) -> int:
+        return len(self.heap) - len(self.removed)
+
+    def push(self, waiter: Event, sender: Hashable = None, weight: float = 1.0):
+        start = max(self.virtual_time, self.finish_times.get(sender, 0.0))
+        finish = start + 1.0 / weight
+        self.finish_times[sender] = finish
+        self.sequence += 1
+        heapq.heappush(self.heap, (finish, self.sequence, waiter))
+
+    def pop(self) -> Event:
+        while True:
+            finish, _, waiter = heapq.heappop(self.heap)
+            if waiter in self.removed:
+                self.removed.remove(waiter)
+                continue
+            self.virtual_time = finish
+            if not self:
+                # Idle, senders start from scratch.
+                self.finish_times.clear()
+            return waiter
+
+    def remove(self, waiter: Event):
+        self.removed.add(waiter)
+
+
+class ConcurrencyLimiter(object):
+    """Runs at most `max_concurrency` functions at once, with up to `max_queue` more waiting.
+
+    A query is shed with `Overloaded` if the queue is full, if the estimated wait (from the
+    average run time of recent queries) exceeds `queue_deadline`, or if it actually waited that
+    long.
+    """
+
+    # Number of senders whose queue times are kept.
+    MAX_SENDERS = 1024
+
+    def __init__(
+            self,
+            max_concurrency: int = 16,
+            max_queue: int = 128,
+            queue_deadline: float = 10.0,
+            clock: Callable[[], float] = time.time,
+            queue=None
+    ):
+        assert max_concurrency > 0
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_deadline = queue_deadline
+        self.clock = clock
+        self.queue = queue if queue is not None else FairQueue()
+        self.in_flight = 0
+        # exponentially weighted moving average of run times in seconds
+        self.average_run_time = 0.0
+        self.admitted = 0
+        self.shed = 0
+        self.queue_times = deque(maxlen=1000)
+        # sender => [queries, total queue time, max queue time], least recently active first
+        self.sender_waits = OrderedDict()
+
+    @property
+    def limit(self) -> int:
+        return self.max_concurrency
+
+    def estimated_wait(self) -> float:
+        return (len(self.queue) + 1) * self.average_run_time / self.limit
+
+    def acquire(self, sender: Hashable = None, weight: float = 1.0):
+        if self.in_flight < self.limit and not self.queue:
+            self.in_flight += 1
+            self.admitted += 1
+            self.record_wait(sender, 0.0)
+            return
+
+        if len(self.queue) >= self.max_queue or self.estimated_wait() > self.queue_deadline:
+            self.shed += 1
+            raise Overloaded(self.retry_after())
+
+        waiter = Event()
+        queued_at = self.clock()
+        self.queue.push(waiter, sender, weight)
+        try:
+            admitted = waiter.wait(self.queue_deadline)
+        except GreenletExit:
+            # Cancelled while waiting, give back the slot if it was handed over already.
+            if waiter.is_set():
+                self.release()
+            else:
+                self.queue.remove(waiter)
+            raise
+        if not admitted:
+            self.queue.remove(waiter)
+            self.shed += 1
+            raise Overloaded(self.retry_after())
+        # The slot was handed over by `release`.
+        self.admitted += 1
+        self.record_wait(sender, self.clock() - queued_at)
+
+    def record_wait(self, sender: Hashable, wait: float):
+        self.queue_times.append(wait)
+        waits = self.sender_waits.pop(sender, None) or [0, 0.0, 0.0]
+        waits[0] += 1
+        waits[1] += wait
+        waits[2] = max(waits[2], wait)
+        self.sender_waits[sender] = waits
+        if len(self.sender_waits) > self.MAX_SENDERS:
+            self.sender_waits.popitem(last=False)
+
+    def release(self):
+        self.in_flight -= 1
+        # Hand free slots directly to waiters, so that nobody can jump the queue.
+        while self.queue and self.in_flight < self.limit:
+            self.in_flight += 1
+            self.queue.pop().set()
+
+    def completed(self, run_time: float):
+        self.average_run_time += 0.1 * (run_time - self.average_run_time)
+
+    def run(
+            self,
+            func: Callable,
+            *args,
+            sender: Hashable = None,
+            weight: float = 1.0,
+            **kwargs
+    ) -> Any:
+        """Run `func` once a slot is free, queued as a query of `sender` with `weight`."""
+        self.acquire(sender, weight)
+        started_at = self.clock()
+        try:
+            return func(*args, **kwargs)
+        except GreenletExit:
+            # The run time of a cancelled query says nothing about Elasticsearch.
+            started_at = None
+            raise
+        finally:
+            if started_at is not None:
+                self.completed(self.clock() - started_at)
+            self.release()
+
+    def retry_after(self) -> int:
+        return max(int(math.ceil(self.estimated_wait())), 1)
+
+    def stats(self) -> Dict[str, Any]:
+        queue_times = list(self.queue_times)
+        return dict(
+            limit=self.limit,
+            in_flight=self.in_flight,
+            queued=len(self.queue),
+            admitted=self.admitted,
+            shed=self.shed,
+            average_run_time=self.average_run_time,
+            queue_time_p50=percentile(queue_times, 0.5),
+            queue_time_p99=percentile(queue_times, 0.99),
+        )
+
+    def sender_stats(self) -> Dict[Hashable, Dict[str, float]]:
+        """Queue times per sender, `None` for queries without payment headers."""
+        return {
+            sender: dict(
+                queries=queries,
+                average_queue_time=total / queries,
+                max_queue_time=longest,
+            )
+            for sender, (queries, total, longest) in self.sender_waits.items()
+        }
+
+
+class LatencyBaseline(object):
+    """Recent average and no-load baseline of a latency."""
+
+    def __init__(self, smoothing: float = 0.2, drift: float = 0.01):
+        self.smoothing = smoothing
+        self.drift = drift
+        self.baseline = None
+        self.recent = 0.0
+
+    def add(self, latency: float):
+        if self.baseline is None:
+            self.baseline = self.recent = latency
+            return
+        self.recent += self.smoothing * (latency - self.recent)
+        if latency < self.baseline:
+            self.baseline = latency
+        else:
+            # Follow slowly upwards, e.g. when the index grows.
+            self.baseline += self.drift * (latency - self.baseline)
+
+    def exceeds(self, tolerance: float) -> bool:
+        return self.baseline is not None and self.recent > tolerance * max(self.baseline, 1e-3)
+
+
+class AdaptiveLimiter(ConcurrencyLimiter):
+    """Concurrency limiter that adapts its limit to how loaded Elasticsearch is (AIMD).
+
+    Elasticsearch counts as overloaded when recent query latencies, either the wall-clock
+    time of backend queries or the `took` times Elasticsearch reports, exceed `tolerance` times
+    their baseline. The baseline is a decaying minimum, i.e. the latency without load. Then
+    the limit is multiplied by `backoff`, at most once per recent latency. Otherwise, while all
+    slots are in use, it grows by one per `limit` queries.
+    """
+
+    def __init__(
+            self,
+            initial_limit: int = 16,
+            min_limit: int = 2,
+            max_limit: int = 256,
+            tolerance: float = 2.0,
+            backoff: float = 0.9,
+            history_size: int = 1000,
+            **kwargs
+    ):
+        super(AdaptiveLimiter, self).__init__(max_concurrency=max_limit, **kwargs)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.current_limit = float(initial_limit)
+        self.latency = LatencyBaseline()
+        self.took = LatencyBaseline()
+        self.decreased_at = 0.0
+        # (time, limit) whenever the limit changed
+        self.history = deque(maxlen=history_size)
+        self.history.append((self.clock(), self.limit))
+
+    @property
+    def limit(self) -> int:
+        return int(self.current_limit)
+
+    def observe_took(self, took: int):
+        """Called with the `took` (in ms) of every Elasticsearch response."""
+        self.took.add(took / 1000)
+
+    def completed(self, run_time: float):
+        super(AdaptiveLimiter, self).completed(run_time)
+        self.latency.add(run_time)
+        limit = self.limit
+        now = self.clock()
+        if self.latency.exceeds(self.tolerance) or self.took.exceeds(self.tolerance):
+            # Give the decrease time to take effect before decreasing again.
+            if now - self.decreased_at >= self.latency.recent:
+                self.current_limit = max(self.current_limit * self.backoff, self.min_limit)
+                self.decreased_at = now
+        elif self.in_flight >= limit:
+            self.current_limit = min(self.current_limit + 1 / self.current_limit, self.max_limit)
+        if self.limit != limit:
+            self.history.append((now, self.limit))
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super(AdaptiveLimiter, self).stats()
+        stats.update(
+            latency_baseline=self.latency.baseline,
+            recent_latency=self.latency.recent,
+            took_baseline=self.took.baseline,
+            recent_took=self.took.recent,
+            limit_history=list(self.history),
+        )
+        return stats
@@ -0,0 +1,139 @@
+"""Index mappings, held in memory.
+
+Mappings practically never change, so they are loaded once at startup and refreshed every
+`refresh_interval` seconds (or on demand) in a background greenlet. `_mapping` requests are
+answered from memory, with an ETag, so that they never reach Elasticsearch.
+"""
+import glob
+import json
+import os
+import time
+from collections import namedtuple
+from typing import Dict, Iterable, Optional
+
+import gevent
+from elasticsearch.exceptions import NotFoundError
+
+from ethevents.config import ETH_INDEX
+from . import canonical
+from .backend import MAPPING_PRICE, Resource
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# The serialized mapping response and its ETag.
+Mapping = namedtuple('Mapping', ['resource', 'etag'])
+
+
+class MappingStore(object):
+    """Mappings of `indices`, as returned by Elasticsearch, refreshed in the background."""
+
+    def __init__(
+            self,
+            es,
+            indices: Iterable[str] = (ETH_INDEX, 'abi'),
+            refresh_interval: float = 3600
+    ):
+        self.es = es
+        self.indices = tuple(indices)
+        self.refresh_interval = refresh_interval
+        # index name => mapping response, keyed by the concrete index names
+        self.mappings = dict()
+        # (index, doc_type) => Mapping, rendered on demand
+        self.responses = dict()
+        self.refreshed_at = None
+        self.greenlet = None
+
+    def load_directory(self, path: str, index: str = ETH_INDEX):
+        """Use the mapping files in `path` (one per document type, like `docs/mappings`) for
+        `index` until the mappings could be fetched from Elasticsearch."""
+        mapping = dict()
+        for filename in sorted(glob.glob(os.path.join(path, '*.json'))):
+            with open(filename) as f:
+                for name, entry in json.load(f).items():
+                    mapping.setdefault(name, {'mappings': {}})['mappings'].update(
+                        entry.get('mappings', {})
+                    )
+        self.update({index: mapping})
+
+    def update(self, mappings: Dict[str, Dict]):
+        self.mappings.update(mappings)
+        self.responses = dict()
+
+    def refresh(self) -> bool:
+        """Fetch the mappings of all indices, return whether that succeeded."""
+        mappings = dict()
+        for index in self.indices:
+            try:
+                mappings[index] = self.es.indices.get_mapping(index=index)
+            except NotFoundError:
+                log.info('Index {} does not exist, no mapping to hold.'.format(index))
+            except Exception as e:
+                log.warning('Could not fetch the mapping of {}: {}'.format(index, e))
+                return False
+        self.update(mappings)
+        self.refreshed_at = time.time()
+        return True
+
+    def lookup(self, index: str = None, doc_type: str = None) -> Optional[Mapping]:
+        """The `_mapping` response for `index` and `doc_type` (both optional, types may be
+        comma separated), `None` if it is not held."""
+        key = (index, doc_type)
+        if key not in self.responses:
+            response = self.render(index, doc_type)
+            if response is None:
+                return None
+            data = canonical.dump_canonical(response)
+            self.responses[key] = Mapping(
+                resource=Resource(content=data, price=MAPPING_PRICE, expires_at=float('inf')),
+                etag=canonical.digest(b'mapping', data)
+            )
+        return self.responses[key]
+
+    def render(self, index: Optional[str], doc_type: Optional[str]) -> Optional[Dict]:
+        if index is None:
+            if not self.mappings:
+                return None
+            response = dict()
+            for mapping in self.mappings.values():
+                response.update(mapping)
+        elif index in self.mappings:
+            response = self.mappings[index]
+        else:
+            return None
+        if doc_type is None:
+            return response
+        doc_types = doc_type.split(',')
+        response = {
+            name: {'mappings': {
+                type_name: mapping for type_name, mapping in entry.get('mappings', {}).items()
+                if type_name in doc_types
+            }}
+            for name, entry in response.items()
+        }
+        response = {name: entry for name, entry in response.items() if entry['mappings']}
+        # Elasticsearch answers missing types with an error.
+        return response or None
+
+    def run(self):
+        while True:
+            gevent.sleep(self.refresh_interval)
+            self.refresh()
+
+    def start(self):
+        """Load the mappings and keep refreshing them."""
+        assert self.greenlet is None
+        self.refresh()
+        self.greenlet = gevent.spawn(self.run)
+
+    def stop(self):
+        if self.greenlet is not None:
+            self.greenlet.kill()
+            self.greenlet = None
+
+    def stats(self) -> Dict:
+        return dict(
+            indices=sorted(self.mappings),
+            refreshed_at=self.refreshed_at,
+        )
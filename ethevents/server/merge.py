@@ -0,0 +1,235 @@
+"""Merging of search responses over disjoint sets of documents.
+
+Used to combine the results of one query executed in several parts, e.g. over finalized and
+recent blocks. Only aggregations whose results can be combined exactly (or, for `terms`, as
+exactly as Elasticsearch itself does over shards) are supported; `mergeable` tells whether a
+search body only uses those.
+"""
+import math
+from functools import cmp_to_key
+from typing import Any, Dict, List, Optional
+
+# Aggregation types that can be merged. Bucket aggregations are merged bucket by bucket,
+# including their sub-aggregations.
+METRIC_AGGREGATIONS = ('stats', 'extended_stats', 'min', 'max', 'sum', 'value_count')
+BUCKET_AGGREGATIONS = ('histogram', 'date_histogram', 'terms', 'filter')
+
+
+def mergeable_aggregations(aggs: Dict, exact: bool = False) -> bool:
+    if not isinstance(aggs, dict):
+        return False
+    for spec in aggs.values():
+        if not isinstance(spec, dict):
+            return False
+        sub_aggs = spec.get('aggs', spec.get('aggregations', {}))
+        agg_types = [key for key in spec if key not in ('aggs', 'aggregations', 'meta')]
+        if len(agg_types) != 1:
+            return False
+        agg_type = agg_types[0]
+        params = spec[agg_type]
+        if not isinstance(params, dict) or params.get('keyed'):
+            # Keyed buckets are returned as an object instead of a list.
+            return False
+        if agg_type in METRIC_AGGREGATIONS:
+            if 'script' in params:
+                return False
+        elif agg_type in ('histogram', 'date_histogram'):
+            # Buckets below `min_doc_count` in each part might reach it in the sum.
+            if params.get('min_doc_count', 0) > 1 or 'order' in params:
+                return False
+        elif agg_type == 'terms':
+            if exact or 'order' in params or params.get('min_doc_count', 1) > 1:
+                return False
+        elif agg_type not in BUCKET_AGGREGATIONS:
+            return False
+        if sub_aggs and not mergeable_aggregations(sub_aggs, exact):
+            return False
+    return True
+
+
+def sort_directions(sort: Any) -> Optional[List[bool]]:
+    """Whether each sort key is descending, `None` if hits are sorted by score."""
+    directions = []
+    for item in sort if isinstance(sort, list) else [sort]:
+        if isinstance(item, str):
+            field, order = item, 'asc'
+        elif isinstance(item, dict) and len(item) == 1:
+            field, order = next(iter(item.items()))
+            if isinstance(order, dict):
+                order = order.get('order', 'asc')
+        else:
+            return None
+        if field == '_score':
+            return None
+        directions.append(order == 'desc')
+    return directions
+
+
+def mergeable(body: Dict, exact: bool = False) -> bool:
+    """Whether the responses to parts of a search with `body` can be merged, if `exact` only
+    without `terms` aggregations, whose top buckets of a part may not be the top ones of
+    all parts."""
+    if not isinstance(body, dict) or body.get('from', 0):
+        return False
+    if 'collapse' in body or 'search_after' in body or 'suggest' in body:
+        return False
+    aggs = body.get('aggs', body.get('aggregations'))
+    if aggs is not None and not mergeable_aggregations(aggs, exact):
+        return False
+    if body.get('size', 10) != 0 and sort_directions(body.get('sort', '_score')) is None:
+        return False
+    return True
+
+
+def compare_sort_values(directions: List[bool]):
+    def compare(a: Dict, b: Dict) -> int:
+        for descending, x, y in zip(directions, a.get('sort', []), b.get('sort', [])):
+            if x == y:
+                continue
+            # Missing values sort last.
+            if x is None or y is None:
+                return 1 if x is None else -1
+            result = -1 if x < y else 1
+            return -result if descending else result
+        return 0
+    return compare
+
+
+def merge_metric(agg_type: str, results: List[Dict], params: Dict) -> Dict:
+    if agg_type == 'sum':
+        return dict(value=sum(result['value'] or 0 for result in results))
+    if agg_type == 'value_count':
+        return dict(value=sum(result['value'] or 0 for result in results))
+    if agg_type in ('min', 'max'):
+        values = [result['value'] for result in results if result['value'] is not None]
+        if not values:
+            return dict(value=None)
+        return dict(value=min(values) if agg_type == 'min' else max(values))
+
+    # stats and extended_stats
+    parts = [result for result in results if result.get('count')]
+    count = sum(part['count'] for part in parts)
+    if count == 0:
+        return results[0]
+    merged = dict(
+        count=count,
+        min=min(part['min'] for part in parts),
+        max=max(part['max'] for part in parts),
+        sum=sum(part['sum'] for part in parts),
+    )
+    merged['avg'] = merged['sum'] / count
+    if agg_type == 'extended_stats':
+        sum_of_squares = sum(part['sum_of_squares'] for part in parts)
+        variance = max(sum_of_squares / count - merged['avg'] ** 2, 0.0)
+        std_deviation = math.sqrt(variance)
+        sigma = params.get('sigma', 2)
+        merged.update(
+            sum_of_squares=sum_of_squares,
+            variance=variance,
+            std_deviation=std_deviation,
+            std_deviation_bounds=dict(
+                upper=merged['avg'] + sigma * std_deviation,
+                lower=merged['avg'] - sigma * std_deviation,
+            )
+        )
+    return merged
+
+
+def merge_buckets(buckets: List[List[Dict]], sub_aggs: Dict) -> List[Dict]:
+    """Merge buckets with the same key, keeping the order of their first appearance."""
+    by_key = dict()
+    for part in buckets:
+        for bucket in part:
+            by_key.setdefault(bucket['key'], []).append(bucket)
+    merged = []
+    for key, same_buckets in by_key.items():
+        bucket = merge_bucket(same_buckets, sub_aggs)
+        bucket['key'] = key
+        if 'key_as_string' in same_buckets[0]:
+            bucket['key_as_string'] = same_buckets[0]['key_as_string']
+        merged.append(bucket)
+    return merged
+
+
+def merge_bucket(buckets: List[Dict], sub_aggs: Dict) -> Dict:
+    merged = dict(doc_count=sum(bucket['doc_count'] for bucket in buckets))
+    for name, spec in sub_aggs.items():
+        parts = [bucket[name] for bucket in buckets if name in bucket]
+        if parts:
+            merged[name] = merge_aggregation(spec, parts)
+    return merged
+
+
+def merge_aggregation(spec: Dict, results: List[Dict]) -> Dict:
+    sub_aggs = spec.get('aggs', spec.get('aggregations', {}))
+    agg_type = next(key for key in spec if key not in ('aggs', 'aggregations', 'meta'))
+    params = spec[agg_type]
+    if agg_type in METRIC_AGGREGATIONS:
+        merged = merge_metric(agg_type, results, params)
+    elif agg_type == 'filter':
+        merged = merge_bucket(results, sub_aggs)
+    elif agg_type == 'terms':
+        buckets = merge_buckets([result['buckets'] for result in results], sub_aggs)
+        buckets.sort(key=lambda bucket: (-bucket['doc_count'], bucket['key']))
+        size = params.get('size', 10)
+        dropped = sum(bucket['doc_count'] for bucket in buckets[size:])
+        merged = dict(
+            doc_count_error_upper_bound=sum(
+                result.get('doc_count_error_upper_bound', 0) for result in results
+            ),
+            sum_other_doc_count=dropped + sum(
+                result.get('sum_other_doc_count', 0) for result in results
+            ),
+            buckets=buckets[:size],
+        )
+    else:
+        buckets = merge_buckets([result['buckets'] for result in results], sub_aggs)
+        buckets.sort(key=lambda bucket: bucket['key'])
+        merged = dict(buckets=buckets)
+    if 'meta' in results[0]:
+        merged['meta'] = results[0]['meta']
+    return merged
+
+
+def merge_responses(body: Dict, responses: List[Dict]) -> Dict:
+    """Merge `responses` to searches with `body` over disjoint parts of the index."""
+    merged = dict(
+        took=sum(response['took'] for response in responses),
+        timed_out=any(response.get('timed_out') for response in responses),
+    )
+    shards = [response['_shards'] for response in responses if '_shards' in response]
+    if shards:
+        merged['_shards'] = {
+            key: sum(part.get(key, 0) for part in shards)
+            for key in shards[0] if key != 'failures'
+        }
+
+    size = body.get('size', 10)
+    hits = [hit for response in responses for hit in response['hits']['hits']]
+    if hits:
+        directions = sort_directions(body.get('sort', '_score'))
+        hits.sort(key=cmp_to_key(compare_sort_values(directions)))
+    totals = [response['hits']['total'] for response in responses]
+    if totals and isinstance(totals[0], dict):
+        total = dict(value=sum(part['value'] for part in totals), relation='eq')
+        if any(part.get('relation') == 'gte' for part in totals):
+            total['relation'] = 'gte'
+    else:
+        total = sum(totals)
+    merged['hits'] = dict(
+        total=total,
+        max_score=None,
+        hits=hits[:size],
+    )
+
+    aggs = body.get('aggs', body.get('aggregations'))
+    if aggs:
+        merged['aggregations'] = dict()
+        for name, spec in aggs.items():
+            results = [
+                response['aggregations'][name] for response in responses
+                if name in response.get('aggregations', {})
+            ]
+            if results:
+                merged['aggregations'][name] = merge_aggregation(spec, results)
+    return merged
@@ -0,0 +1,84 @@
+"""Incremental reading of NDJSON `_msearch` bodies.
+
+Every line is parsed exactly once, straight from the request bytes. The original bytes of
+each line are kept, so that lines which need no changes are forwarded to Elasticsearch as
+they are instead of being serialized again. Parameters added to a search (e.g. its timeout)
+are spliced into the original bytes.
+"""
+import json
+import re
+from collections import namedtuple
+from typing import Any, Dict, Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# A search of a `_msearch`: its parsed header and body, and the original lines (`None` for
+# searches that were not read from a request).
+MsearchItem = namedtuple('MsearchItem', ['header', 'body', 'header_line', 'body_line'])
+MsearchItem.__new__.__defaults__ = (None, None)
+# Integers which may not fit 64 bits (wei amounts), orjson would turn them into floats.
+LONG_NUMBER = re.compile(rb'\d{19}')
+
+
+def loads(data: bytes) -> Any:
+    if orjson is not None and not LONG_NUMBER.search(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson is stricter, e.g. on NaN.
+            pass
+    return json.loads(data.decode('utf-8'))
+
+
+def dumps(value: Any) -> bytes:
+    if orjson is not None:
+        try:
+            return orjson.dumps(value)
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def iter_lines(data: bytes) -> Iterator[bytes]:
+    """Non-blank lines of `data`, without their surrounding whitespace."""
+    start = 0
+    while start < len(data):
+        end = data.find(b'\n', start)
+        if end < 0:
+            end = len(data)
+        line = data[start:end].strip()
+        if line:
+            yield line
+        start = end + 1
+
+
+def read_msearch(data: bytes) -> Iterator[MsearchItem]:
+    """The searches of a NDJSON `_msearch` body. `ValueError` if a line is not a JSON object
+    or a header has no body."""
+    lines = iter_lines(data)
+    for header_line in lines:
+        body_line = next(lines, None)
+        if body_line is None:
+            raise ValueError('Header without search body.')
+        header = loads(header_line)
+        body = loads(body_line)
+        if not isinstance(header, dict) or not isinstance(body, dict):
+            raise ValueError('Header and search body must be JSON objects.')
+        yield MsearchItem(header, body, header_line, body_line)
+
+
+def splice(line: bytes, value: Dict, fields: Dict[str, Any]) -> bytes:
+    """The serialized JSON object `line` (parsed: `value`) with `fields` set as well."""
+    if not fields:
+        return line
+    if any(key in value for key in fields):
+        # Elasticsearch rejects duplicate keys.
+        return dumps(dict(value, **fields))
+    added = dumps(fields)
+    if not value:
+        return added
+    # Insert the fields right after the opening brace.
+    return b''.join((added[:-1], b',', line[line.index(b'{') + 1:]))
@@ -0,0 +1,215 @@
+"""Rewriting of search bodies into cheaper equivalents.
+
+Clients often put clauses that only restrict the hits into `must`, or sort hits they never
+ask for. When scores can not influence the response, such clauses are moved into `filter`
+context, where Elasticsearch skips scoring and can cache them. Redundant `bool` wrappers
+(e.g. the ones `filtered_query` builds) are unwrapped, and the `sort` of searches without
+hits is dropped.
+
+Every rewrite keeps the response identical. Two subtleties of Elasticsearch 6 are kept in
+mind:
+
+- Clauses in filter context get no score (0 instead of their score), so `filter` is only
+  used where scores are never read: hits sorted by fields only, or no hits at all, and no
+  `top_hits`, `inner_hits`, `min_score` or score tracking.
+- A `bool` in filter context requires one of its `should` clauses to match, even when it has
+  `must` clauses. Clauses are only moved into or out of filter context if that can not
+  change any such `bool`.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+
+from .finality import as_list
+from .merge import sort_directions
+
+BOOL_CONTEXTS = ('must', 'filter', 'should', 'must_not')
+# Compound clause => parameters holding sub-queries in the same context.
+INHERITING_CLAUSES = {
+    'dis_max': ('queries', ),
+    'boosting': ('positive', 'negative'),
+    'nested': ('query', ),
+    'has_child': ('query', ),
+    'has_parent': ('query', ),
+}
+# Search parameters which make Elasticsearch compute or return scores.
+SCORING_PARAMS = ('min_score', 'track_scores', 'explain', 'rescore')
+
+# Names of the rewrites, as reported to clients.
+FILTER_CONTEXT = 'filter_context'
+FLATTEN_BOOL = 'flatten_bool'
+UNWRAP_BOOL = 'unwrap_bool'
+DROP_EMPTY_CLAUSES = 'drop_empty_clauses'
+DROP_SORT = 'drop_sort'
+
+
+def has_top_hits(aggs: Any) -> bool:
+    if not isinstance(aggs, dict):
+        return False
+    for spec in aggs.values():
+        if not isinstance(spec, dict):
+            continue
+        if 'top_hits' in spec or has_top_hits(spec.get('aggs', spec.get('aggregations'))):
+            return True
+    return False
+
+
+def hits_size(body: Dict, params: Dict) -> Optional[int]:
+    """Number of hits requested, URL parameters take precedence."""
+    size = params.get('size', body.get('size'))
+    try:
+        return None if size is None else int(size)
+    except (TypeError, ValueError):
+        return None
+
+
+def scores_used(body: Dict, params: Dict) -> bool:
+    """Whether the scores of the query can influence the response."""
+    if any(key in body for key in SCORING_PARAMS):
+        return True
+    if has_top_hits(body.get('aggs', body.get('aggregations'))):
+        return True
+    if hits_size(body, params) == 0:
+        return False
+    # Hits are sorted by score unless a sort without `_score` is given.
+    return 'sort' not in body or sort_directions(body['sort']) is None
+
+
+def should_sensitive(query: Any) -> bool:
+    """Whether moving `query` from query into filter context (or back) can change its
+    matches, i.e. whether it contains a `bool` with implicitly optional `should` clauses
+    outside of filter context."""
+    stack = [query]
+    while stack:
+        clause = stack.pop()
+        if not isinstance(clause, dict) or len(clause) != 1:
+            continue
+        ((clause_type, params), ) = clause.items()
+        if not isinstance(params, dict):
+            continue
+        if clause_type == 'bool':
+            if params.get('should') and 'minimum_should_match' not in params:
+                return True
+            for context in ('must', 'should'):
+                stack.extend(as_list(params.get(context)))
+        elif clause_type in INHERITING_CLAUSES:
+            for key in INHERITING_CLAUSES[clause_type]:
+                stack.extend(as_list(params.get(key)))
+    return False
+
+
+class Optimizer(object):
+    """Rewrites one search body, collecting the names of the rewrites applied."""
+
+    def __init__(self):
+        self.rewrites = set()
+
+    def query(self, query: Any, scoring: bool, filter_context: bool) -> Any:
+        """`query` rewritten, `scoring` if its scores can be read, `filter_context` if
+        Elasticsearch evaluates it in filter context."""
+        if not isinstance(query, dict) or len(query) != 1:
+            return query
+        ((clause_type, params), ) = query.items()
+        if not isinstance(params, dict):
+            return query
+        if clause_type == 'bool':
+            return self.bool_query(params, scoring, filter_context)
+        if clause_type == 'constant_score':
+            if 'filter' not in params:
+                return query
+            return {clause_type: dict(params, filter=self.query(params['filter'], False, True))}
+        if clause_type in INHERITING_CLAUSES:
+            # Inner hits are sorted by score.
+            scoring = scoring or 'inner_hits' in params
+            params = dict(params)
+            for key in INHERITING_CLAUSES[clause_type]:
+                if key not in params:
+                    continue
+                if isinstance(params[key], list):
+                    params[key] = [self.query(q, scoring, filter_context) for q in params[key]]
+                else:
+                    params[key] = self.query(params[key], scoring, filter_context)
+            return {clause_type: params}
+        return query
+
+    def bool_query(self, params: Dict, scoring: bool, filter_context: bool) -> Dict:
+        contexts = dict()
+        for context in BOOL_CONTEXTS:
+            clauses = as_list(params.get(context))
+            if any(clause == {} for clause in clauses):
+                self.rewrites.add(DROP_EMPTY_CLAUSES)
+                clauses = [clause for clause in clauses if clause != {}]
+            if context in ('filter', 'must_not'):
+                contexts[context] = [self.query(clause, False, True) for clause in clauses]
+            else:
+                contexts[context] = [
+                    self.query(clause, scoring, filter_context) for clause in clauses
+                ]
+        others = {key: value for key, value in params.items() if key not in BOOL_CONTEXTS}
+
+        if not scoring and contexts['must']:
+            kept, moved = [], []
+            for clause in contexts['must']:
+                if filter_context or not should_sensitive(clause):
+                    moved.append(clause)
+                else:
+                    kept.append(clause)
+            if moved:
+                self.rewrites.add(FILTER_CONTEXT)
+                contexts['must'] = kept
+                contexts['filter'] = contexts['filter'] + moved
+
+        if not contexts['should']:
+            # Conjunctions in filter context are part of this conjunction.
+            flattened = []
+            for clause in contexts['filter']:
+                inner = clause.get('bool') if isinstance(clause, dict) else None
+                if isinstance(inner, dict) and len(clause) == 1 and inner and set(inner) <= {
+                    'filter', 'must_not'
+                }:
+                    self.rewrites.add(FLATTEN_BOOL)
+                    flattened.extend(as_list(inner.get('filter')))
+                    contexts['must_not'] = contexts['must_not'] + as_list(inner.get('must_not'))
+                else:
+                    flattened.append(clause)
+            contexts['filter'] = flattened
+
+        present = {context: clauses for context, clauses in contexts.items() if clauses}
+        if not others:
+            if not present:
+                # An empty `bool` matches all documents.
+                self.rewrites.add(UNWRAP_BOOL)
+                return {'match_all': {}}
+            if list(present) == ['must'] and len(present['must']) == 1:
+                self.rewrites.add(UNWRAP_BOOL)
+                return present['must'][0]
+            if filter_context and list(present) == ['filter'] and len(present['filter']) == 1:
+                self.rewrites.add(UNWRAP_BOOL)
+                return present['filter'][0]
+        result = dict(others)
+        result.update(present)
+        return {'bool': result}
+
+    def body(self, body: Dict, params: Dict) -> Dict:
+        body = dict(body)
+        scoring = scores_used(body, params)
+        if 'query' in body:
+            body['query'] = self.query(body['query'], scoring, False)
+        if 'post_filter' in body:
+            # Not scored, but not in filter context either.
+            body['post_filter'] = self.query(body['post_filter'], False, False)
+        if hits_size(body, params) == 0 and 'sort' in body and 'search_after' not in body:
+            self.rewrites.add(DROP_SORT)
+            del body['sort']
+        return body
+
+
+def optimize(body: Any, params: Dict = None) -> Tuple[Any, List[str]]:
+    """A search body equivalent to `body` (with the URL parameters `params`) which is
+    cheaper to execute, and the names of the rewrites applied. `body` itself is returned if
+    nothing could be improved, it is never modified."""
+    if not isinstance(body, dict):
+        return body, []
+    optimizer = Optimizer()
+    optimized = optimizer.body(body, params or {})
+    if not optimizer.rewrites:
+        return body, []
+    return optimized, sorted(optimizer.rewrites)
@@ -0,0 +1,454 @@
+"""Result caches that are shared between several `ethevents.server` processes or persist
+across restarts.
+
+A resource is serialized exactly once when it is stored, as a fixed size header followed by
+its content.
+"""
+import json
+import sqlite3
+import struct
+import time
+from collections import Counter
+from typing import Callable, Dict, Hashable, List, Optional
+
+from gevent.threading import Lock
+
+from .backend import Resource, content_bytes, is_error
+from .cache import CacheBackend, DEFAULT_CACHE_SIZE, compress_resource
+from .compression import Codec, CompressedContent, codec_by_id
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# expires_at, price, block_height (-1: none), finalized, whether the content is a raw response
+# body, codec id (0: uncompressed)
+HEADER = struct.Struct('!dqq??B')
+
+
+def serialize_resource(resource: Resource, codec: Codec = None) -> bytes:
+    content = compress_resource(resource, codec).content
+    if isinstance(content, CompressedContent):
+        raw, codec_id, data = content.raw, content.codec.codec_id, content.data
+    else:
+        raw, codec_id, data = isinstance(content, bytes), 0, content_bytes(content)
+    header = HEADER.pack(
+        resource.expires_at,
+        resource.price,
+        -1 if resource.block_height is None else resource.block_height,
+        resource.finalized,
+        raw,
+        codec_id
+    )
+    return header + data
+
+
+def deserialize_resource(data: bytes) -> Resource:
+    """Compressed contents stay compressed until they are delivered."""
+    expires_at, price, block_height, finalized, raw, codec_id = HEADER.unpack_from(data)
+    content = memoryview(data)[HEADER.size:]
+    if codec_id:
+        content = CompressedContent(bytes(content), codec_by_id(codec_id), raw)
+    elif raw:
+        content = bytes(content)
+    else:
+        content = json.loads(str(content, 'utf-8'))
+    return Resource(
+        content=content,
+        price=price,
+        expires_at=expires_at,
+        block_height=None if block_height < 0 else block_height,
+        finalized=finalized
+    )
+
+
+class SqliteCache(CacheBackend):
+    """Byte-budgeted cache in a sqlite database, which can be shared by all workers on a host.
+
+    Reads go through sqlite's memory mapped I/O and never write: the access times of hits are
+    only written along with the next change. When the budget is exceeded, the least recently
+    used entries are evicted. Expired entries are kept for another `stale_ttl` seconds, only
+    for `ignore_expiry` lookups.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS resources (
+            key TEXT PRIMARY KEY,
+            expires_at REAL NOT NULL,
+            last_access REAL NOT NULL,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS resources_expires_at ON resources (expires_at);
+        CREATE INDEX IF NOT EXISTS resources_last_access ON resources (last_access);
+        CREATE TABLE IF NOT EXISTS total_size (size INTEGER NOT NULL);
+        INSERT INTO total_size SELECT 0 WHERE NOT EXISTS (SELECT * FROM total_size);
+        CREATE TRIGGER IF NOT EXISTS resources_insert AFTER INSERT ON resources BEGIN
+            UPDATE total_size SET size = size + NEW.size;
+        END;
+        CREATE TRIGGER IF NOT EXISTS resources_delete AFTER DELETE ON resources BEGIN
+            UPDATE total_size SET size = size - OLD.size;
+        END;
+        CREATE TABLE IF NOT EXISTS access_counts (
+            key TEXT PRIMARY KEY,
+            count INTEGER NOT NULL
+        );
+    """
+
+    def __init__(
+            self,
+            path: str,
+            max_bytes: int = DEFAULT_CACHE_SIZE,
+            mmap_size: int = DEFAULT_CACHE_SIZE,
+            clock: Callable[[], float] = time.time,
+            codec: Codec = None,
+            stale_ttl: float = 0
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.codec = codec
+        self.stale_ttl = stale_ttl
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, timeout=10, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('PRAGMA mmap_size={:d}'.format(mmap_size))
+        with self.lock:
+            self.db.executescript(self.SCHEMA)
+        # key => time of the latest hit, not written yet
+        self.accessed = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM resources').fetchone()[0]
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self.lock:
+            row = self.db.execute('SELECT 1 FROM resources WHERE key = ?', (key, )).fetchone()
+        return row is not None
+
+    @property
+    def size(self) -> int:
+        with self.lock:
+            return self.db.execute('SELECT size FROM total_size').fetchone()[0]
+
+    def get(self, key: Hashable, ignore_expiry: bool = False) -> Optional[Resource]:
+        now = self.clock()
+        with self.lock:
+            row = self.db.execute(
+                'SELECT expires_at, data FROM resources WHERE key = ?',
+                (key, )
+            ).fetchone()
+            if row is not None and not ignore_expiry and row[0] < now:
+                if row[0] + self.stale_ttl < now:
+                    self.db.execute('DELETE FROM resources WHERE key = ?', (key, ))
+                    self.expirations += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.accessed[key] = now
+            self.hits += 1
+        return deserialize_resource(row[1])
+
+    def put(self, key: Hashable, resource: Resource):
+        assert isinstance(resource, Resource)
+        data = serialize_resource(resource, self.codec)
+        now = self.clock()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                # Delete first, so that the triggers keep the total size right.
+                self.db.execute('DELETE FROM resources WHERE key = ?', (key, ))
+                self._write_accesses()
+                self.db.execute(
+                    'INSERT INTO resources (key, expires_at, last_access, size, data) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    (key, resource.expires_at, now, len(data), data)
+                )
+                self._expire(now)
+                self._evict(key)
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def pop(self, key: Hashable, default: Resource = None) -> Optional[Resource]:
+        with self.lock:
+            row = self.db.execute('SELECT data FROM resources WHERE key = ?', (key, )).fetchone()
+            if row is None:
+                return default
+            self.db.execute('DELETE FROM resources WHERE key = ?', (key, ))
+        return deserialize_resource(row[0])
+
+    def clear(self):
+        with self.lock:
+            self.db.execute('DELETE FROM resources')
+            self.db.execute('DELETE FROM access_counts')
+
+    def expire(self):
+        with self.lock:
+            self._write_accesses()
+            self._expire(self.clock())
+
+    def record_accesses(self, counts: Dict[Hashable, int]):
+        """Add to the persistent access counts of keys."""
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.executemany(
+                    'INSERT INTO access_counts (key, count) VALUES (?, ?) '
+                    'ON CONFLICT (key) DO UPDATE SET count = count + excluded.count',
+                    counts.items()
+                )
+                # Forget the counts of evicted entries.
+                self.db.execute(
+                    'DELETE FROM access_counts WHERE key NOT IN (SELECT key FROM resources)'
+                )
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def most_accessed(self, limit: int) -> List[str]:
+        """Keys of the cached entries with the highest access counts."""
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT resources.key FROM resources '
+                'JOIN access_counts ON access_counts.key = resources.key '
+                'ORDER BY access_counts.count DESC LIMIT ?',
+                (limit, )
+            ).fetchall()
+        return [key for key, in rows]
+
+    def stats(self) -> Dict[str, int]:
+        return dict(
+            entries=len(self),
+            size=self.size,
+            max_bytes=self.max_bytes,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            expirations=self.expirations,
+        )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _write_accesses(self):
+        if self.accessed:
+            accessed, self.accessed = self.accessed, dict()
+            self.db.executemany(
+                'UPDATE resources SET last_access = ? WHERE key = ?',
+                ((now, key) for key, now in accessed.items())
+            )
+
+    def _expire(self, now: float):
+        cursor = self.db.execute(
+            'DELETE FROM resources WHERE expires_at < ?',
+            (now - self.stale_ttl, )
+        )
+        self.expirations += max(cursor.rowcount, 0)
+
+    def _evict(self, keep: Hashable):
+        while True:
+            size = self.db.execute('SELECT size FROM total_size').fetchone()[0]
+            if size <= self.max_bytes:
+                return
+            row = self.db.execute(
+                'SELECT key FROM resources WHERE key != ? ORDER BY last_access LIMIT 1',
+                (keep, )
+            ).fetchone()
+            if row is None:
+                return
+            self.db.execute('DELETE FROM resources WHERE key = ?', row)
+            self.evictions += 1
+
+
+class RedisCache(CacheBackend):
+    """Cache in any server speaking the Redis protocol.
+
+    Expiry is left to the server (via `PEXPIREAT`, `stale_ttl` seconds after the resource
+    expires), so is the byte budget (`maxmemory` with an LRU `maxmemory-policy`).
+    """
+
+    def __init__(
+            self,
+            url: str = 'redis://localhost:6379/0',
+            client=None,
+            prefix: str = 'ethevents:resource:',
+            clock: Callable[[], float] = time.time,
+            codec: Codec = None,
+            stale_ttl: float = 0
+    ):
+        if client is None:
+            if redis is None:
+                raise RuntimeError('The redis cache backend requires the `redis` package.')
+            client = redis.StrictRedis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.clock = clock
+        self.codec = codec
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.client.scan_iter(match=self.prefix + '*'))
+
+    def __contains__(self, key: Hashable) -> bool:
+        return bool(self.client.exists(self.prefix + key))
+
+    def get(self, key: Hashable, ignore_expiry: bool = False) -> Optional[Resource]:
+        data = self.client.get(self.prefix + key)
+        if data is not None:
+            resource = deserialize_resource(data)
+            if ignore_expiry or resource.expires_at >= self.clock():
+                self.hits += 1
+                return resource
+        self.misses += 1
+        return None
+
+    def put(self, key: Hashable, resource: Resource):
+        assert isinstance(resource, Resource)
+        name = self.prefix + key
+        pipeline = self.client.pipeline()
+        pipeline.set(name, serialize_resource(resource, self.codec))
+        if resource.expires_at != float('inf'):
+            pipeline.pexpireat(name, int((resource.expires_at + self.stale_ttl) * 1000))
+        pipeline.execute()
+
+    def pop(self, key: Hashable, default: Resource = None) -> Optional[Resource]:
+        name = self.prefix + key
+        pipeline = self.client.pipeline()
+        pipeline.get(name)
+        pipeline.delete(name)
+        data, _ = pipeline.execute()
+        if data is None:
+            return default
+        return deserialize_resource(data)
+
+    def clear(self):
+        for name in self.client.scan_iter(match=self.prefix + '*'):
+            self.client.delete(name)
+
+    def expire(self):
+        pass
+
+    def stats(self) -> Dict[str, int]:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+        )
+
+
+class TieredCache(CacheBackend):
+    """In-memory cache with a persistent sqlite tier behind it.
+
+    Finalized results never change, so they are also written to the disk tier, where they
+    survive restarts and deploys. Entries are only read from disk on a miss in memory and then
+    promoted to memory. Accesses of entries on disk are counted and persisted every
+    `flush_interval` seconds, so that `warm_up` can preload the most requested ones after a
+    restart.
+    """
+
+    def __init__(
+            self,
+            memory: CacheBackend,
+            disk: SqliteCache,
+            flush_interval: float = 60,
+            clock: Callable[[], float] = time.time
+    ):
+        self.memory = memory
+        self.disk = disk
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.access_counts = Counter()
+        self.flushed_at = clock()
+        self.disk_hits = 0
+
+    def __len__(self) -> int:
+        return len(self.memory)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.memory or key in self.disk
+
+    def get(self, key: Hashable, ignore_expiry: bool = False) -> Optional[Resource]:
+        resource = self.memory.get(key, ignore_expiry=ignore_expiry)
+        if resource is None:
+            resource = self.disk.get(key, ignore_expiry=ignore_expiry)
+            if resource is None:
+                return None
+            self.disk_hits += 1
+            self.memory.put(key, resource)
+        if resource.finalized:
+            self.access_counts[key] += 1
+        return resource
+
+    def put(self, key: Hashable, resource: Resource):
+        self.memory.put(key, resource)
+        if resource.finalized and not is_error(resource.content):
+            self.disk.put(key, resource)
+
+    def promote(self, key: Hashable, resource: Resource):
+        self.memory.promote(key, resource)
+
+    def pop(self, key: Hashable, default: Resource = None) -> Optional[Resource]:
+        resource = self.memory.pop(key)
+        on_disk = self.disk.pop(key)
+        if resource is None:
+            resource = on_disk
+        return default if resource is None else resource
+
+    def clear(self):
+        self.memory.clear()
+        self.disk.clear()
+        self.access_counts.clear()
+
+    def expire(self):
+        self.memory.expire()
+        if self.clock() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Persist the access counts collected since the last flush."""
+        counts, self.access_counts = self.access_counts, Counter()
+        self.flushed_at = self.clock()
+        if counts:
+            self.disk.record_accesses(counts)
+
+    def warm_up(self, limit: int) -> int:
+        """Load up to `limit` of the most accessed entries on disk into memory.
+
+        Returns the number of loaded entries.
+        """
+        loaded = 0
+        for key in self.disk.most_accessed(limit):
+            resource = self.disk.get(key)
+            if resource is not None:
+                self.memory.put(key, resource)
+                loaded += 1
+        log.info('Loaded {} cached results from disk.'.format(loaded))
+        return loaded
+
+    def close(self):
+        self.flush()
+        self.disk.close()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return dict(
+            memory=self.memory.stats(),
+            disk=self.disk.stats(),
+            disk_hits=self.disk_hits,
+        )
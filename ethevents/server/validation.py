@@ -0,0 +1,309 @@
+"""Structural validation of search bodies.
+
+Search bodies are walked once before they reach Elasticsearch, stopping at the first
+violation. Only known query clauses, aggregations and search parameters are accepted; scripts
+are refused wherever they can appear. Queries that are expensive no matter how much data they
+match are refused as well: deep nesting, large result windows, aggregations with too many
+buckets and chains of `has_child`/`has_parent` joins.
+
+Only the structure is walked. Field values are never inspected, so a term value may well
+mention `script`.
+"""
+from typing import Any, Dict, Optional
+
+from .finality import as_list
+
+# Nested query clauses plus aggregation levels.
+MAX_DEPTH = 32
+# `from` + `size`, Elasticsearch's default `index.max_result_window`.
+MAX_RESULT_WINDOW = 10000
+# Upper bound of the buckets all aggregations of a search may create.
+MAX_BUCKETS = 10000
+# Hits per `top_hits` bucket, Elasticsearch's default `index.max_inner_result_window`.
+MAX_TOP_HITS = 100
+# Joins in a query, e.g. block > tx > log is two.
+MAX_JOIN_DEPTH = 2
+DEFAULT_BUCKET_SIZE = 10
+
+SEARCH_PARAMS = frozenset([
+    'query', 'post_filter', 'aggs', 'aggregations', 'size', 'from', 'sort', 'search_after',
+    'collapse', '_source', 'stored_fields', 'docvalue_fields', 'track_scores',
+    'track_total_hits', 'version', 'seq_no_primary_term', 'explain', 'min_score', 'timeout',
+    'terminate_after', 'highlight', 'rescore',
+])
+COLLAPSE_PARAMS = frozenset(['field'])
+RESCORE_PARAMS = frozenset(['window_size', 'query'])
+RESCORE_QUERY_PARAMS = frozenset([
+    'rescore_query', 'query_weight', 'rescore_query_weight', 'score_mode',
+])
+
+# Compound clause => parameters holding sub-queries (one or a list).
+COMPOUND_CLAUSES = {
+    'bool': ('must', 'filter', 'should', 'must_not'),
+    'constant_score': ('filter', ),
+    'dis_max': ('queries', ),
+    'boosting': ('positive', 'negative'),
+    'nested': ('query', ),
+    'has_child': ('query', ),
+    'has_parent': ('query', ),
+}
+# Compound clause => its other parameters.
+COMPOUND_PARAMS = {
+    'bool': ('minimum_should_match', 'adjust_pure_negative', 'disable_coord'),
+    'constant_score': (),
+    'dis_max': ('tie_breaker', ),
+    'boosting': ('negative_boost', ),
+    'nested': ('path', 'score_mode', 'ignore_unmapped', 'inner_hits'),
+    'has_child': (
+        'type', 'score_mode', 'min_children', 'max_children', 'ignore_unmapped', 'inner_hits'
+    ),
+    'has_parent': ('parent_type', 'type', 'score', 'ignore_unmapped', 'inner_hits'),
+}
+COMMON_PARAMS = ('boost', '_name')
+JOIN_CLAUSES = ('has_child', 'has_parent')
+# Clauses on the terms of a single field (or a few). Regular expressions, wildcards, fuzzy
+# and query string queries can expand to huge numbers of terms and are left out.
+LEAF_CLAUSES = frozenset([
+    'match_all', 'match_none', 'match', 'match_phrase', 'match_phrase_prefix', 'multi_match',
+    'term', 'terms', 'range', 'exists', 'prefix', 'ids', 'type',
+])
+SCRIPT_CLAUSES = frozenset(['script', 'script_score', 'function_score'])
+
+# Bucket aggregations and the number of buckets they create at most, `None` if that depends
+# on the data (Elasticsearch's `search.max_buckets` still applies).
+BUCKET_AGGREGATIONS = frozenset([
+    'terms', 'significant_terms', 'composite', 'histogram', 'date_histogram', 'range',
+    'date_range', 'filter', 'filters', 'missing', 'global', 'children',
+])
+METRIC_AGGREGATIONS = frozenset([
+    'avg', 'sum', 'min', 'max', 'stats', 'extended_stats', 'value_count', 'cardinality',
+    'percentiles', 'percentile_ranks', 'top_hits',
+])
+PIPELINE_AGGREGATIONS = frozenset([
+    'avg_bucket', 'sum_bucket', 'min_bucket', 'max_bucket', 'stats_bucket',
+    'extended_stats_bucket', 'percentiles_bucket', 'derivative', 'cumulative_sum',
+    'serial_diff',
+])
+SCRIPT_AGGREGATIONS = frozenset([
+    'scripted_metric', 'bucket_script', 'bucket_selector',
+])
+AGGREGATION_KEYS = ('aggs', 'aggregations', 'meta')
+
+
+class InvalidQuery(ValueError):
+    """A search that is not accepted."""
+
+
+class ScriptRejected(InvalidQuery):
+    """A search with a script."""
+
+
+def as_count(value: Any, name: str) -> int:
+    try:
+        count = int(value)
+    except (TypeError, ValueError):
+        raise InvalidQuery('Invalid {}: {!r}'.format(name, value))
+    if count < 0:
+        raise InvalidQuery('Invalid {}: {!r}'.format(name, value))
+    return count
+
+
+def validate_window(from_: Any, size: Any):
+    total = 0
+    if from_ is not None:
+        total += as_count(from_, 'from')
+    if size is not None:
+        total += as_count(size, 'size')
+    if total > MAX_RESULT_WINDOW:
+        raise InvalidQuery('from + size may not exceed {}.'.format(MAX_RESULT_WINDOW))
+
+
+def validate_sort(sort: Any):
+    for item in as_list(sort):
+        if isinstance(item, dict) and '_script' in item:
+            raise ScriptRejected('Script based sorting is not allowed.')
+
+
+def validate_hits(params: Any, name: str):
+    """Parameters of hits returned per bucket or per joined document."""
+    if not isinstance(params, dict):
+        raise InvalidQuery('Invalid {}.'.format(name))
+    if 'script_fields' in params:
+        raise ScriptRejected('Script fields are not allowed.')
+    if as_count(params.get('size', 3), name + ' size') > MAX_TOP_HITS:
+        raise InvalidQuery('{} may not return more than {} hits.'.format(name, MAX_TOP_HITS))
+    validate_sort(params.get('sort'))
+
+
+def validate_query(query: Any, depth: int = 0, joins: int = 0):
+    if depth > MAX_DEPTH:
+        raise InvalidQuery('Queries may not be nested deeper than {}.'.format(MAX_DEPTH))
+    if query == {}:
+        # Empty clauses are ignored, e.g. the ones of `filtered_query`.
+        return
+    if not isinstance(query, dict) or len(query) != 1:
+        raise InvalidQuery('A query clause must be an object with a single clause type.')
+    ((clause_type, params), ) = query.items()
+    if clause_type in LEAF_CLAUSES:
+        return
+    if clause_type in SCRIPT_CLAUSES:
+        raise ScriptRejected('Script queries are not allowed.')
+    if clause_type not in COMPOUND_CLAUSES:
+        raise InvalidQuery('Query clause [{}] is not allowed.'.format(clause_type))
+    if not isinstance(params, dict):
+        raise InvalidQuery('Invalid [{}] clause.'.format(clause_type))
+    if clause_type in JOIN_CLAUSES:
+        joins += 1
+        if joins > MAX_JOIN_DEPTH:
+            raise InvalidQuery('At most {} nested joins are allowed.'.format(MAX_JOIN_DEPTH))
+    sub_query_params = COMPOUND_CLAUSES[clause_type]
+    for key, value in params.items():
+        if key in sub_query_params:
+            for sub_query in as_list(value):
+                validate_query(sub_query, depth + 1, joins)
+        elif key not in COMPOUND_PARAMS[clause_type] and key not in COMMON_PARAMS:
+            raise InvalidQuery('Parameter [{}] of [{}] is not allowed.'.format(
+                key,
+                clause_type
+            ))
+        elif key == 'inner_hits':
+            validate_hits(value, 'inner_hits')
+
+
+def validate_highlight(params: Any):
+    """Highlighting options, globally or per field, may have their own `highlight_query`."""
+    if not isinstance(params, dict):
+        raise InvalidQuery('Invalid highlight.')
+    if any('script' in key for key in params):
+        raise ScriptRejected('Scripts in highlights are not allowed.')
+    if 'highlight_query' in params:
+        validate_query(params['highlight_query'])
+    fields = params.get('fields', {})
+    if isinstance(fields, dict):
+        fields = [fields]
+    if not isinstance(fields, list):
+        raise InvalidQuery('Invalid highlight fields.')
+    for field_options in fields:
+        if not isinstance(field_options, dict):
+            raise InvalidQuery('Invalid highlight fields.')
+        for options in field_options.values():
+            validate_highlight(options)
+
+
+def validate_rescore(rescore: Any):
+    for params in as_list(rescore):
+        if not isinstance(params, dict) or not RESCORE_PARAMS.issuperset(params):
+            raise InvalidQuery('Only query rescorers are allowed.')
+        if 'window_size' in params:
+            validate_window(None, params['window_size'])
+        query = params.get('query')
+        if not isinstance(query, dict) or not RESCORE_QUERY_PARAMS.issuperset(query):
+            raise InvalidQuery('Invalid rescore query.')
+        validate_query(query.get('rescore_query'))
+
+
+def bucket_count(agg_type: str, params: Dict) -> Optional[int]:
+    if agg_type in ('terms', 'significant_terms', 'composite'):
+        return as_count(params.get('size', DEFAULT_BUCKET_SIZE), 'aggregation size')
+    if agg_type in ('range', 'date_range'):
+        return len(as_list(params.get('ranges')))
+    if agg_type == 'filters':
+        filters = params.get('filters')
+        if not isinstance(filters, (dict, list)):
+            raise InvalidQuery('Invalid filters aggregation.')
+        return len(filters) + int(bool(params.get('other_bucket')))
+    if agg_type == 'histogram':
+        bounds = params.get('extended_bounds')
+        if isinstance(bounds, dict) and params.get('min_doc_count') == 0:
+            # Empty buckets are created over the whole bounds.
+            try:
+                return int((bounds['max'] - bounds['min']) / params['interval']) + 1
+            except (KeyError, TypeError, ValueError, ZeroDivisionError):
+                raise InvalidQuery('Invalid histogram bounds.')
+        return None
+    if agg_type == 'date_histogram':
+        return None
+    return 1
+
+
+def validate_aggregation_queries(agg_type: str, params: Dict, depth: int):
+    if agg_type == 'filter':
+        validate_query(params, depth + 1)
+    elif agg_type == 'filters':
+        filters = params['filters']
+        for query in filters.values() if isinstance(filters, dict) else filters:
+            validate_query(query, depth + 1)
+    elif agg_type == 'top_hits':
+        validate_hits(params, 'top_hits')
+
+
+def validate_aggregations(aggs: Any, depth: int = 0) -> int:
+    """The number of buckets `aggs` create at most."""
+    if depth > MAX_DEPTH:
+        raise InvalidQuery('Aggregations may not be nested deeper than {}.'.format(MAX_DEPTH))
+    if not isinstance(aggs, dict):
+        raise InvalidQuery('Aggregations must be an object.')
+    buckets = 0
+    for spec in aggs.values():
+        if not isinstance(spec, dict):
+            raise InvalidQuery('An aggregation must be an object.')
+        agg_types = [key for key in spec if key not in AGGREGATION_KEYS]
+        if len(agg_types) != 1:
+            raise InvalidQuery('An aggregation must have a single aggregation type.')
+        agg_type = agg_types[0]
+        params = spec[agg_type]
+        if agg_type in SCRIPT_AGGREGATIONS:
+            raise ScriptRejected('Script aggregations are not allowed.')
+        if not isinstance(params, dict):
+            raise InvalidQuery('Invalid [{}] aggregation.'.format(agg_type))
+        if any('script' in key for key in params):
+            raise ScriptRejected('Scripts in aggregations are not allowed.')
+        sub_aggs = spec.get('aggs', spec.get('aggregations'))
+        if agg_type in BUCKET_AGGREGATIONS:
+            count = bucket_count(agg_type, params)
+            sub_buckets = 0 if sub_aggs is None else validate_aggregations(sub_aggs, depth + 1)
+            if count is not None:
+                buckets += count * (1 + sub_buckets)
+            else:
+                buckets += 1 + sub_buckets
+        elif agg_type in METRIC_AGGREGATIONS or agg_type in PIPELINE_AGGREGATIONS:
+            if sub_aggs is not None:
+                raise InvalidQuery('[{}] aggregations can not have sub-aggregations.'.format(
+                    agg_type
+                ))
+        else:
+            raise InvalidQuery('Aggregation [{}] is not allowed.'.format(agg_type))
+        validate_aggregation_queries(agg_type, params, depth)
+        if buckets > MAX_BUCKETS:
+            raise InvalidQuery('Aggregations may create at most {} buckets.'.format(MAX_BUCKETS))
+    return buckets
+
+
+def validate_search(body: Any, params: Dict = None):
+    """Raise `InvalidQuery` (`ScriptRejected` for scripts) if a search with `body` and the
+    URL parameters `params` is not accepted."""
+    params = params or {}
+    if body is None:
+        body = {}
+    if not isinstance(body, dict):
+        raise InvalidQuery('The search body must be an object.')
+    for key, value in body.items():
+        if key not in SEARCH_PARAMS:
+            if 'script' in key:
+                raise ScriptRejected('Scripts are not allowed.')
+            raise InvalidQuery('Search parameter [{}] is not allowed.'.format(key))
+        if key in ('query', 'post_filter'):
+            validate_query(value)
+        elif key in ('aggs', 'aggregations'):
+            validate_aggregations(value)
+        elif key == 'sort':
+            validate_sort(value)
+        elif key == 'highlight':
+            validate_highlight(value)
+        elif key == 'rescore':
+            validate_rescore(value)
+        elif key == 'collapse':
+            if not isinstance(value, dict) or not COLLAPSE_PARAMS.issuperset(value):
+                raise InvalidQuery('Only the field of a collapse can be given.')
+    # URL parameters take precedence.
+    validate_window(params.get('from', body.get('from')), params.get('size', body.get('size')))
@@ -0,0 +1,213 @@
+import json
+import os
+import random
+
+import gevent
+import mock
+
+from ethevents.examples import queries
+from ethevents.server import addresses
+from ethevents.server.addresses import FROM, TO, Activity, AddressIndex, address_query
+from ethevents.server.backend import ElasticsearchBackend
+from ethevents.server.blocks import BlockTracker
+from ethevents.server.finality import as_list
+
+ADDRESS = '0x00000000000000000000000000000000000000aa'
+OTHER = '0x00000000000000000000000000000000000000bb'
+EXAMPLES_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'docs', 'example-queries')
+
+
+def tx_hash(number: int) -> str:
+    return '0x{:064x}'.format(number)
+
+
+def make_txs(rng: random.Random):
+    """Transactions in blocks 100 to 129, several per block, in index order."""
+    txs = []
+    for number in range(120):
+        parties = rng.choice([ADDRESS, OTHER]), rng.choice([ADDRESS, OTHER])
+        txs.append({
+            'hash': tx_hash(number),
+            'from': parties[0],
+            'to': parties[1],
+            'blockNumber': {'num': 100 + rng.randint(0, 29)},
+        })
+    return txs
+
+
+def matches(query, tx) -> bool:
+    """Whether `tx` matches `query`, for the query clauses used here."""
+    ((clause_type, params), ) = query.items()
+    if clause_type == 'ids':
+        return tx['hash'] in params['values']
+    if clause_type == 'range':
+        bounds = params['blockNumber.num']
+        number = tx['blockNumber']['num']
+        return bounds.get('gt', -1) < number <= bounds.get('lte', number)
+    if clause_type in ('term', 'match'):
+        ((field, value), ) = params.items()
+        return tx[field] == value
+    if clause_type == 'multi_match':
+        return any(tx[field] == params['query'] for field in params['fields'])
+    assert clause_type == 'bool'
+    required = as_list(params.get('must')) + as_list(params.get('filter'))
+    should = as_list(params.get('should'))
+    return all(matches(clause, tx) for clause in required) and (
+        not should or any(matches(clause, tx) for clause in should)
+    )
+
+
+def search(txs, body, size=None, **kwargs):
+    """What Elasticsearch would answer, ties in index order."""
+    found = [tx for tx in txs if matches(body['query'], tx)]
+    if 'aggs' in body:
+        aggs = {
+            name: {'doc_count': sum(1 for tx in found if matches(spec['filter'], tx))}
+            for name, spec in body['aggs'].items()
+        }
+    found.sort(key=lambda tx: -tx['blockNumber']['num'])
+    start = body.get('from', 0)
+    end = start + int(size if size is not None else body.get('size', 10))
+    response = {'took': 1, 'hits': {'total': len(found), 'hits': [
+        {'_id': tx['hash'], '_source': tx} for tx in found[start:end]
+    ]}}
+    if 'aggs' in body:
+        response['aggregations'] = aggs
+    return response
+
+
+def test_address_query():
+    assert address_query(queries.last_transactions_to(ADDRESS)['query']) == (ADDRESS, TO)
+    with open(os.path.join(EXAMPLES_DIR, 'tx', 'by_from_or_to_address.json')) as f:
+        query = json.load(f)['query']
+    assert address_query(query) == (query['bool']['should'][0]['term']['from'], FROM | TO)
+    assert address_query({'multi_match': {'query': ADDRESS, 'fields': ['from']}}) == (
+        ADDRESS,
+        FROM,
+    )
+    assert address_query({'bool': {'filter': [{'term': {'from': ADDRESS}}]}}) == (ADDRESS, FROM)
+
+    with open(os.path.join(EXAMPLES_DIR, 'find_entity_by_hash.json')) as f:
+        query = json.load(f)['query']
+    for query in (
+            # Also blocks or transactions with the hash.
+            query,
+            {'bool': {'should': [{'term': {'from': ADDRESS}}, {'term': {'to': OTHER}}]}},
+            {'bool': {'should': [{'term': {'from': ADDRESS}}], 'minimum_should_match': 2}},
+            {'term': {'hash': ADDRESS}},
+    ):
+        assert address_query(query) is None
+
+
+def test_activity():
+    activity = Activity(3, 10)
+    for number, block, sides in ((1, 5, FROM), (2, 6, TO), (3, 7, FROM), (4, 7, TO)):
+        activity.add(tx_hash(number), block, sides)
+    assert len(activity) == 3
+    assert activity.counts[FROM] == activity.counts[TO] == 2
+    assert [block for _, block in activity.latest()] == [7, 7, 6]
+
+    # Both transactions of block 7 can be the latest one.
+    assert activity.candidates(FROM | TO, 1) == [tx_hash(4), tx_hash(3)]
+    assert activity.candidates(TO, 1) == [tx_hash(4)]
+    # Transactions of block 5 are gone, block 6 may have had more.
+    assert activity.candidates(TO, 2) is None
+    assert activity.candidates(FROM, 2) is None
+    assert activity.candidates(FROM | TO, 3) is None
+
+
+def test_pending_loads():
+    tracker = BlockTracker(None, reorg_safe=5)
+    tracker.update(120)
+    es = mock.Mock()
+    es.search.side_effect = Exception('unavailable')
+    index = AddressIndex(es, tracker, max_pending=1)
+    runs = []
+
+    def run(load, *args):
+        runs.append(args)
+        return load(*args)
+
+    index.request(ADDRESS, run)
+    index.request(OTHER, run)
+    gevent.sleep(0)
+    # Beyond `max_pending`, addresses are requested again by a later search, failed loads
+    # are dropped.
+    assert runs == [(ADDRESS, )]
+    assert not index.activities
+    assert not index.pending
+
+
+def test_address_search(monkeypatch):
+    txs = make_txs(random.Random(0))
+    tracker = BlockTracker(None, reorg_safe=5)
+    tracker.update(120)
+    es = mock.Mock()
+    es.search.side_effect = lambda body, **kwargs: search(txs, body, **kwargs)
+    monkeypatch.setattr(addresses, 'scan', lambda es, query, **kwargs: (
+        {'_source': tx} for tx in txs if matches(query['query'], tx)
+    ))
+    index = AddressIndex(es, tracker, history=20)
+    index.start()
+    backend = ElasticsearchBackend(es, address_index=index)
+
+    bodies = [
+        dict(queries.last_transactions_to(ADDRESS), size=size) for size in (0, 1, 3, 10, 20)
+    ] + [
+        {'query': {'bool': {'should': [{'term': {'from': ADDRESS}}, {'term': {'to': ADDRESS}}]}},
+         'sort': [{'blockNumber.num': {'order': 'desc'}}], 'from': 2, 'size': 3},
+        {'query': {'multi_match': {'query': ADDRESS, 'fields': ['from']}}, 'size': 0},
+    ]
+    # Searching does not load anything, paid searches load their address.
+    backend.search(index='ethereum', doc_type='tx', body=bodies[0])
+    gevent.sleep(0)
+    assert not index.activities
+    assert index.wanted(bodies[0]) == [ADDRESS]
+    backend.load_indexes('_search', bodies[0], {}, doc_type='log')
+    backend.load_indexes('_msearch', bodies[0], {}, doc_type='tx')
+    assert not index.pending
+    backend.load_indexes('_search', bodies[0], {}, doc_type='tx')
+    assert index.wanted(bodies[0]) == []
+    gevent.sleep(0)
+    assert ADDRESS in index.activities
+    assert not index.pending
+
+    def check():
+        rewritten = 0
+        for body in bodies:
+            for params in ({}, {'size': '5'}):
+                rewritten += index.rewrite(body, params) is not None
+                es.search.reset_mock()
+                resource = backend.search(index='ethereum', doc_type='tx', body=body, **params)
+                assert resource.content == search(txs, body, **params), body
+                assert es.search.call_count == 1
+        return rewritten
+
+    assert check() >= 10
+    # Counting only counts the transactions of unfinalized blocks.
+    backend.search(index='ethereum', doc_type='tx', body=bodies[0])
+    _, kwargs = es.search.call_args
+    assert search(txs, kwargs['body'])['hits']['total'] == sum(
+        1 for tx in txs if tx['to'] == ADDRESS and tx['blockNumber']['num'] > 115
+    )
+    # Searches reaching beyond the held transactions are left as they are.
+    assert index.rewrite(bodies[4]) is None
+    # Hits sorted by score can not be told from the held transactions, their number can.
+    with open(os.path.join(EXAMPLES_DIR, 'tx', 'by_from_or_to_address.json')) as f:
+        documented = json.load(f)
+    address = documented['query']['bool']['should'][0]['term']['from']
+    documented = json.loads(json.dumps(documented).replace(address, ADDRESS))
+    assert index.rewrite(documented) is None
+    resource = backend.search(index='ethereum', doc_type='tx', body=dict(documented, size=0))
+    assert index.rewrite(dict(documented, size=0)) is not None
+    assert resource.content['hits']['total'] == sum(
+        1 for tx in txs if ADDRESS in (tx['from'], tx['to'])
+    )
+
+    # New blocks are added.
+    tracker.update(134)
+    gevent.sleep(0)
+    assert index.activities[ADDRESS].height == 129
+    assert check() >= 10
+    assert backend.search(index='ethereum', doc_type='log', body=bodies[1]).price == 1
+    assert index.stats()['transactions'] == 20
@@ -8,15 +8,30 @@ import time
 
 from _pytest.monkeypatch import MonkeyPatch
 from eth_utils import encode_hex
-from flask import Request
+from flask import Flask, Request
 from munch import Munch
 from web3 import Web3
 
 from ethevents.server.backend import ElasticsearchBackend, Resource
+from ethevents.server.blocks import BlockTracker
 from microraiden import HTTPHeaders, Client, Session as uSession
 from microraiden.proxy.paywalled_proxy import PaywalledProxy
 import microraiden.requests
-from ethevents.server.api_server import APIServer, ExpensiveElasticsearch
+from ethevents.server import canonical
+from ethevents.server.api_server import (
+    APIServer,
+    ExpensiveElasticsearch,
+    StatsAdmin,
+    exists_cached,
+    make_content_response,
+    msearch_cached,
+)
+from ethevents.server.cache import AdmissionCache, ResourceCache
+from ethevents.server.compression import CompressedContent, GzipCodec
+from ethevents.server.es_pool import connect
+from ethevents.server.limiter import AdaptiveLimiter
+from ethevents.server.mappings import MappingStore
+from ethevents.server.shared_cache import SqliteCache, TieredCache
 
 
 def test_get(
@@ -157,7 +172,7 @@ def test_get_expired(
         content='success',
         expires_at=time.time() + 0.05
     ))
-    APIServer(empty_proxy, es=es_mock)
+    APIServer(empty_proxy, es=es_mock, stale_ttl=0)
     api_path = 'http://' + api_endpoint_address
 
     # Request price (and cache resource).
@@ -235,6 +250,41 @@ def test_request_hashing():
     assert post_key == post2_key
 
 
+def test_request_hashing_canonical():
+    def key(data: bytes, path: str = '/ethereum/tx/_search', query_string: str = ''):
+        return ExpensiveElasticsearch.get_request_key(Request.from_values(
+            method='POST',
+            path=path,
+            query_string=query_string,
+            content_type='application/json',
+            data=data
+        ))
+
+    reference = key(b'{"size": 1, "query": {"term": {"to": "0x1"}}}')
+    assert len(reference) == 32
+    assert key(b'{"query":{"term":{"to":"0x1"}},"size":1}') == reference
+    assert key(b'{\n  "query": {"term": {"to": "0x1"}},\n  "size": 1.0\n}') == reference
+    assert key(b'{"query": {"term": {"to": "0x2"}}, "size": 1}') != reference
+    assert key(b'{"size": 1, "query": {"term": {"to": "0x1"}}}', path='/ethereum/_search') != \
+        reference
+
+    assert key(b'{}', query_string='size=1&from=2') == key(b'{}', query_string='from=2&size=1')
+    assert key(b'{}', query_string='size=1') != key(b'{}', query_string='size=2')
+
+    msearch = key(b'{"index": "ethereum"}\n{"size": 0, "query": {}}\n', path='/_msearch')
+    assert key(b'{"index":"ethereum"}\n\n{"query":{},"size":0}', path='/_msearch') == msearch
+    assert key(b'{"query":{},"size":0}\n{"index":"ethereum"}', path='/_msearch') != msearch
+
+    # Not JSON at all, still hashed consistently.
+    assert key(b'not json') == key(b'not json')
+
+    # Lone surrogates are valid JSON.
+    surrogate = key(b'{"query": {"term": {"to": "\\ud800"}}}')
+    assert surrogate == key(b'{"query":{"term":{"to":"\\ud800"}}}')
+    assert surrogate != key(b'{"query": {"term": {"to": "\\ud801"}}}')
+    assert canonical.msearch_item_key('/_msearch', [], {}, {'query': '\ud800'})
+
+
 def test_cache_cleanup(
         empty_proxy: PaywalledProxy,
         usession: uSession,
@@ -288,8 +338,298 @@ def test_cache_cleanup(
         ExpensiveElasticsearch.get_request_key(requests[1]): resources[1],
         ExpensiveElasticsearch.get_request_key(requests[2]): resources[2]
     })
-    assert len(server.resource_cache) == 3
+    # Expired entries are dropped as soon as the cache is written to.
+    assert len(server.resource_cache) == 1
+    assert server.resource_cache.stats()['expirations'] == 2
 
     response = usession.get(url, json=bodies[1])
     assert response.json() == 'success2'
     assert len(server.resource_cache) == 1
+
+
+def test_msearch_cached():
+    es = mock.Mock()
+    es.msearch = mock.Mock(return_value={'responses': [
+        {'took': 2, 'hits': 'b'},
+        {'took': 3, 'hits': 'c'},
+    ]})
+    backend = ElasticsearchBackend(es)
+    cache = ResourceCache()
+
+    searches = [({'index': 'ethereum'}, {'query': {'term': {'x': value}}}) for value in 'abcb']
+    item_keys = [
+        canonical.msearch_item_key('/_msearch', [], header, body) for header, body in searches
+    ]
+    cache.put(item_keys[0], Resource(
+        content={'took': 1, 'hits': 'a'},
+        price=1,
+        expires_at=time.time() + 30
+    ))
+
+    resource = msearch_cached(cache, backend, searches, item_keys)
+
+    # Only the misses are forwarded, duplicates only once.
+    (call, ) = es.msearch.call_args_list
+    # Each search gets the time budget of the `_msearch`.
+    assert [json.loads(line) for line in call[1]['body']] == [
+        {'index': 'ethereum'}, {'query': {'term': {'x': 'b'}}, 'timeout': '60000ms'},
+        {'index': 'ethereum'}, {'query': {'term': {'x': 'c'}}, 'timeout': '60000ms'},
+    ]
+    assert [response['hits'] for response in resource.content['responses']] == list('abcb')
+    assert resource.price == 1 + 2 + 3 + 2
+    assert len(cache) == 3
+
+    # Everything is cached now.
+    resource = msearch_cached(cache, backend, searches, item_keys)
+    assert es.msearch.call_count == 1
+    assert resource.price == 8
+
+
+def test_exists_cached():
+    es = mock.Mock()
+    es.msearch = mock.Mock(return_value={'responses': [
+        {'took': 2, 'hits': {'total': 0}},
+    ]})
+    backend = ElasticsearchBackend(es)
+    cache = ResourceCache(codec=GzipCodec())
+
+    queries = [{'term': {'x': value}} for value in 'aba']
+    item_keys = [
+        canonical.msearch_item_key('/_exists', [], {}, query) for query in queries
+    ]
+    cache.put(item_keys[0], Resource(content=1, price=1, expires_at=time.time() + 30))
+
+    resource = exists_cached(cache, backend, queries, item_keys)
+    assert len(es.msearch.call_args[1]['body']) == 2
+    assert resource.content == [1, 0, 1]
+    assert resource.price == 1 + 2 + 1
+    # Kept as plain numbers.
+    assert cache.get(item_keys[1]).content == 0
+
+
+def test_compressed_delivery():
+    app = Flask(__name__)
+    content = CompressedContent.compress({'took': 1}, GzipCodec())
+    resource = Resource(content=content, price=1, expires_at=time.time() + 30)
+
+    with app.test_request_context(headers={'Accept-Encoding': 'gzip, deflate'}):
+        response = make_content_response(resource)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.get_data() == content.data
+
+    with app.test_request_context():
+        response = make_content_response(resource)
+    assert 'Content-Encoding' not in response.headers
+    assert json.loads(response.get_data().decode('utf-8')) == {'took': 1}
+
+
+def test_stale_while_revalidate(
+        empty_proxy: PaywalledProxy,
+        usession: uSession,
+        api_endpoint_address: str
+):
+    def slow_search(**kwargs):
+        gevent.sleep(0.2)
+        return Resource(price=3, content='fresh', expires_at=time.time() + 30)
+
+    es_mock = ElasticsearchBackend(None)
+    es_mock.search = mock.Mock(side_effect=slow_search)
+    server = APIServer(empty_proxy, es=es_mock, stale_ttl=60)
+
+    api_path = 'http://' + api_endpoint_address
+    resource_url = '/some_index/some_type/_search'
+    body = {'query': 'query something'}
+    request_key = ExpensiveElasticsearch.get_request_key(Request.from_values(
+        method='GET',
+        base_url=api_path,
+        path=resource_url,
+        content_type='application/json',
+        data=json.dumps(body)
+    ))
+    server.resource_cache.put(
+        request_key,
+        Resource(price=3, content='stale', expires_at=time.time() - 1)
+    )
+
+    # Served right away, while it is refreshed in the background.
+    response = usession.get(api_path + resource_url, json=body)
+    assert response.json() == 'stale'
+    assert response.headers['Warning'] == '110 - "Response is Stale"'
+
+    gevent.sleep(0.3)
+    response = usession.get(api_path + resource_url, json=body)
+    assert response.json() == 'fresh'
+    assert 'Warning' not in response.headers
+    assert es_mock.search.call_count == 1
+
+
+def test_stale_after_new_block(
+        empty_proxy: PaywalledProxy,
+        usession: uSession,
+        api_endpoint_address: str
+):
+    tracker = BlockTracker(None)
+    tracker.update(100)
+    es_mock = ElasticsearchBackend(None, block_tracker=tracker)
+    es_mock.search = mock.Mock(return_value=Resource(
+        price=3,
+        content='fresh',
+        expires_at=time.time() + 30,
+        block_height=101
+    ))
+    server = APIServer(empty_proxy, es=es_mock)
+
+    api_path = 'http://' + api_endpoint_address
+    resource_url = '/some_index/some_type/_search'
+    body = {'query': 'query something'}
+    request_key = ExpensiveElasticsearch.get_request_key(Request.from_values(
+        method='GET',
+        base_url=api_path,
+        path=resource_url,
+        content_type='application/json',
+        data=json.dumps(body)
+    ))
+    server.resource_cache.put(request_key, Resource(
+        price=3,
+        content='outdated',
+        expires_at=time.time() - 1,
+        block_height=100
+    ))
+    tracker.update(101)
+
+    # Only expired results are served stale, not ones a new block made outdated.
+    response = usession.get(api_path + resource_url, json=body)
+    assert response.json() == 'fresh'
+    assert 'Warning' not in response.headers
+    assert es_mock.search.call_count == 1
+
+
+def test_msearch_cached_by_item(
+        empty_proxy: PaywalledProxy,
+        usession: uSession,
+        api_endpoint_address: str
+):
+    es = mock.Mock()
+    es.msearch = mock.Mock(return_value={'responses': [
+        {'took': 2, 'hits': 'a'},
+        {'took': 3, 'hits': 'b'},
+    ]})
+    server = APIServer(empty_proxy, es=ElasticsearchBackend(es))
+    url = 'http://' + api_endpoint_address + '/ethereum/_msearch'
+    data = '{}\n{"query": {"term": {"x": "a"}}}\n{}\n{"query": {"term": {"x": "b"}}}\n'
+
+    response = usession.post(url, data=data)
+    assert [item['hits'] for item in response.json()['responses']] == ['a', 'b']
+    # Only the items are cached, the whole response is combined from them.
+    assert len(server.resource_cache) == 2
+    response = usession.post(url, data=data)
+    assert [item['hits'] for item in response.json()['responses']] == ['a', 'b']
+    assert len(server.resource_cache) == 2
+    assert es.msearch.call_count == 1
+
+
+def test_export_paid(
+        empty_proxy: PaywalledProxy,
+        usession: uSession,
+        api_endpoint_address: str
+):
+    es_mock = ElasticsearchBackend(None)
+    es_mock.export_page = mock.Mock(return_value=Resource(
+        price=4,
+        content={'took': 4, 'hits': {'hits': [{'_id': 'a', 'sort': [1]}]}},
+        expires_at=time.time() + 30
+    ))
+    server = APIServer(empty_proxy, es=es_mock)
+    url = 'http://' + api_endpoint_address + '/ethereum/log/_export'
+    body = {'query': {'match_all': {}}, 'size': 1}
+
+    # Priced by the 402, delivered on the paid retry without querying again.
+    response = usession.post(url, json=body)
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines[0] == {'_id': 'a', 'sort': [1]}
+    assert lines[-1]['next'] is not None
+    assert len(server.resource_cache) == 1
+    es_mock.export_page.assert_called_once_with(
+        index='ethereum',
+        doc_type='log',
+        body=body,
+        cursor=None
+    )
+
+
+def test_indexes_loaded_when_paid(
+        empty_proxy: PaywalledProxy,
+        usession: uSession,
+        api_endpoint_address: str
+):
+    es_mock = ElasticsearchBackend(None)
+    es_mock.search = mock.Mock(return_value=Resource(
+        price=3,
+        content='success',
+        expires_at=time.time() + 30
+    ))
+    es_mock.load_indexes = mock.Mock()
+    APIServer(empty_proxy, es=es_mock)
+    url = 'http://' + api_endpoint_address + '/ethereum/log/_search'
+    body = {'query': 'query something'}
+
+    # Price probes cost nothing, so they must not make the server do any extra work.
+    response = requests.get(url, json=body)
+    assert response.status_code == 402
+    assert not es_mock.load_indexes.called
+
+    response = usession.get(url, json=body)
+    assert response.json() == 'success'
+    (call, ) = es_mock.load_indexes.call_args_list
+    assert call[0][:2] == ('_search', body)
+
+
+def test_admin_stats(tmpdir):
+    proxy = mock.Mock()
+    limiter = AdaptiveLimiter()
+    es = connect(['localhost:9200'])
+    cache = TieredCache(AdmissionCache(), SqliteCache(str(tmpdir.join('cache.db'))))
+    APIServer(proxy, es=ElasticsearchBackend(es), limiter=limiter, cache=cache)
+    limiter.run(lambda: None, sender='0xa')
+
+    (resource_class, path), kwargs = proxy.api.add_resource.call_args
+    assert resource_class is StatsAdmin
+    assert path.endswith('/admin/stats')
+    stats = kwargs['resource_class_kwargs']['stats']()
+    assert stats['limiter']['admitted'] == 1
+    assert stats['limiter']['limit_history']
+    assert stats['senders']['0xa']['queries'] == 1
+    assert stats['in_flight']['coalesced'] == 0
+    assert stats['in_flight']['time_saved'] == 0
+    assert stats['breaker']['state'] == 'closed'
+    assert stats['transport']['hedged'] == 0
+    assert stats['transport']['nodes'] == {'http://localhost:9200': 0}
+    assert stats['disconnects'] == 0
+    assert stats['cache']['memory']['admissions'] == stats['cache']['memory']['rejections'] == 0
+    assert stats['cache']['disk']['evictions'] == 0
+    json.dumps(stats)
+
+
+def test_mapping_revalidation(
+        empty_proxy: PaywalledProxy,
+        usession: uSession,
+        api_endpoint_address: str
+):
+    mappings = MappingStore(None)
+    mappings.update({'ethereum': {'ethereum': {'mappings': {'tx': {'properties': {}}}}}})
+    es_mock = ElasticsearchBackend(None)
+    es_mock.get_mapping = mock.Mock()
+    APIServer(empty_proxy, es=es_mock, mappings=mappings)
+    url = 'http://' + api_endpoint_address + '/ethereum/_mapping'
+
+    # Priced like a mapping from Elasticsearch, revalidations included.
+    response = requests.get(url)
+    assert response.status_code == 402
+    assert int(HTTPHeaders.deserialize(response.headers).price) == 5
+
+    response = usession.get(url)
+    assert response.status_code == 200
+    response = usession.get(url, headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+    assert not es_mock.get_mapping.called
@@ -0,0 +1,322 @@
+import json
+import time
+
+import mock
+import pytest
+from elasticsearch import Elasticsearch
+from elasticsearch.connection import Connection
+from elasticsearch.exceptions import ConnectionError
+
+from ethevents.server.blocks import BlockTracker
+from ethevents.server.cache import ResourceCache
+from ethevents.server.cancellation import DeadlineExceeded, query_context
+from ethevents.server.finality import block_upper_bound, split_query
+from ethevents.server.backend import (
+    ElasticsearchBackend,
+    Resource,
+    combine_msearch,
+    parse_took,
+    split_msearch_response,
+)
+
+
+def raw_backend(*responses: str) -> ElasticsearchBackend:
+    es = mock.Mock()
+    es.transport.perform_request.side_effect = list(responses)
+    return ElasticsearchBackend(es, raw_responses=True)
+
+
+def test_parse_took():
+    assert parse_took(b'{"took":12,"timed_out":false}') == {'took': 12}
+    assert parse_took(b' {\n  "took" : 3, "hits": {}}') == {'took': 3}
+    assert parse_took(b'{"timed_out":false,"took":4}')['took'] == 4
+
+
+def test_raw_search():
+    response = '{"took":17,"timed_out":false,"hits":{"total":0,"hits":[]}}'
+    backend = raw_backend(response)
+
+    resource = backend.search(index='ethereum', doc_type='tx', body={'size': 0}, size='0')
+
+    assert resource.content == response.encode('utf-8')
+    assert resource.price == 17
+    backend.es.transport.perform_request.assert_called_once_with(
+        'POST',
+        '/ethereum/tx/_search',
+        headers=None,
+        params={'size': '0', 'timeout': '30000ms', 'request_timeout': 31.0},
+        body=b'{"size":0}'
+    )
+
+
+def test_raw_search_retries():
+    class FlakyConnection(Connection):
+        responses = [ConnectionError('N/A', 'down', None), '{"took":3,"hits":{"hits":[]}}']
+
+        def perform_request(self, method, url, params=None, body=None, **kwargs):
+            response = self.responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return 200, {'content-type': 'application/json'}, response
+
+    es = Elasticsearch(['node-a', 'node-b'], connection_class=FlakyConnection)
+    backend = ElasticsearchBackend(es, raw_responses=True)
+
+    resource = backend.search(index='ethereum', body={'size': 0})
+
+    # The dead node was given up on and the response stays undecoded.
+    assert resource.content == b'{"took":3,"hits":{"hits":[]}}'
+    assert len(es.transport.connection_pool.dead) == 1
+    assert es.transport.deserializer.loads('{}', 'application/json') == {}
+
+
+def test_search_deadline():
+    response = '{"took":5000,"timed_out":true,"hits":{"total":3,"hits":[]}}'
+    backend = raw_backend(response)
+
+    query_context.deadline = time.time() + 2
+    query_context.opaque_id = 'query'
+    try:
+        resource = backend.search(index='ethereum', body={'size': 0})
+        # Partial results are delivered, but not kept.
+        assert resource.content == response.encode('utf-8')
+        assert resource.expires_at <= time.time()
+
+        _, kwargs = backend.es.transport.perform_request.call_args
+        assert 1000 < int(kwargs['params']['timeout'].rstrip('ms')) <= 2000
+        assert kwargs['params']['request_timeout'] <= 3
+        assert kwargs['headers'] == {'X-Opaque-Id': 'query'}
+
+        query_context.deadline = time.time() - 1
+        with pytest.raises(DeadlineExceeded):
+            backend.search(index='ethereum', body={'size': 0})
+    finally:
+        query_context.deadline = query_context.opaque_id = None
+
+
+def test_raw_msearch():
+    items = [
+        '{"took":2,"hits":{"hits":[{"_id":"a,]"}]}}',
+        '{"took" : 5, "hits": {"hits": []}}',
+    ]
+    response = '{"responses": [\n' + ',\n'.join(items) + ']}'
+    assert split_msearch_response(response.encode('utf-8')) == [
+        item.encode('utf-8') for item in items
+    ]
+
+    backend = raw_backend(response)
+    resources = backend.msearch_items(
+        [({'index': 'ethereum'}, {'size': 1}), ({}, {'size': 0})],
+        index='ethereum'
+    )
+    assert [resource.price for resource in resources] == [2, 5]
+
+    combined = combine_msearch(resources + [Resource(
+        content={'took': 1},
+        price=1,
+        expires_at=0
+    )])
+    assert combined.price == 8
+    assert json.loads(combined.content.decode('utf-8'))['responses'] == [
+        json.loads(item) for item in items
+    ] + [{'took': 1}]
+
+
+def test_block_upper_bound():
+    assert block_upper_bound({}) is None
+    assert block_upper_bound({'query': {'match_all': {}}}) is None
+    assert block_upper_bound({'query': {'range': {'blockNumber.num': {'lt': 100}}}}) == 99
+    assert block_upper_bound({'query': {'bool': {
+        'filter': [
+            {'range': {'number.num': {'gte': 10, 'lte': 200}}},
+            {'term': {'number.num': 150}},
+        ]
+    }}}) == 150
+    # Alternatives do not bound the result.
+    assert block_upper_bound({'query': {'bool': {
+        'should': [{'range': {'blockNumber.num': {'lte': 100}}}]
+    }}}) is None
+    assert block_upper_bound({'query': {'range': {'timestamp': {'lte': 100}}}}) is None
+    # Global aggregations see all documents, at any depth.
+    bounded = {'query': {'range': {'blockNumber.num': {'lte': 100}}}}
+    assert block_upper_bound(dict(bounded, aggs={'all': {'global': {}}})) is None
+    assert block_upper_bound(dict(bounded, aggregations={'by_address': {
+        'terms': {'field': 'address'},
+        'aggs': {'all': {'global': {}, 'aggs': {'gas': {'sum': {'field': 'gas'}}}}},
+    }})) is None
+    assert block_upper_bound(dict(bounded, aggs={'gas': {'sum': {'field': 'gas'}}})) == 100
+
+
+def test_block_height_validity():
+    tracker = BlockTracker(None, reorg_safe=6)
+    backend = ElasticsearchBackend(None, block_tracker=tracker)
+    old_blocks = {'query': {'range': {'blockNumber.num': {'lte': 94}}}}
+    recent_blocks = {'query': {'range': {'blockNumber.num': {'lte': 95}}}}
+
+    # Nothing known about the chain yet.
+    assert backend.validity(old_blocks)['expires_at'] < float('inf')
+
+    new_blocks = []
+    tracker.listeners.append(new_blocks.append)
+    tracker.update(100)
+    tracker.update(99)
+    assert new_blocks == [100]
+
+    finalized = Resource(content=None, price=1, **backend.validity(old_blocks))
+    assert finalized.finalized
+    assert finalized.expires_at == float('inf')
+    head = Resource(content=None, price=1, **backend.validity(recent_blocks))
+    assert not head.finalized
+    assert head.block_height == 100
+    assert backend.is_current(head)
+
+    tracker.update(101)
+    assert backend.is_current(finalized)
+    assert not backend.is_current(head)
+    assert backend.is_current(Resource(content=None, price=1, expires_at=0))
+    # Until the grace after the first newer block is over.
+    assert backend.is_current(head, grace=30)
+    tracker.history[1] = (101, time.time() - 31)
+    assert not backend.is_current(head, grace=30)
+
+
+def test_split_query():
+    body = {'query': {'range': {'blockNumber.num': {'gte': 100}}}, 'size': 0}
+    field, historic, tail = split_query(body, 999)
+    assert field == 'blockNumber.num'
+    assert historic['query']['bool']['must'] == [body['query']]
+    assert historic['query']['bool']['filter'] == [{'range': {'blockNumber.num': {'lte': 999}}}]
+    assert tail['query']['bool']['filter'] == [{'range': {'blockNumber.num': {'gt': 999}}}]
+    assert block_upper_bound(historic) == 999
+
+    # Entirely on one side of the boundary.
+    assert split_query({'query': {'range': {'blockNumber.num': {'lt': 999}}}}, 999) is None
+    assert split_query({'query': {'range': {'blockNumber.num': {'gt': 999}}}}, 999) is None
+    # Relative lower bounds would make the historic part different every time.
+    assert split_query({'query': {'range': {'timestamp': {'gt': 'now-7d'}}}}, 't') is None
+    assert split_query({'query': {'range': {'timestamp': {'gt': 0}}}}, 't')[0] == 'timestamp'
+
+
+def test_finality_split_search():
+    def search(index, doc_type, body, **kwargs):
+        filters = body['query']['bool']['filter'][0]['range']['blockNumber.num']
+        historic = 'lte' in filters
+        return {
+            'took': 100 if historic else 2,
+            'hits': {'total': 10 if historic else 1, 'max_score': None, 'hits': []},
+            'aggregations': {'gas': {'value': 5 if historic else 7}},
+        }
+
+    es = mock.Mock()
+    es.search = mock.Mock(side_effect=search)
+    tracker = BlockTracker(None, reorg_safe=6)
+    tracker.update(2500)
+    backend = ElasticsearchBackend(
+        es,
+        block_tracker=tracker,
+        historic_cache=ResourceCache()
+    )
+    body = {
+        'query': {'range': {'blockNumber.num': {'gte': 0}}},
+        'size': 0,
+        'aggs': {'gas': {'max': {'field': 'gas.num'}}}
+    }
+
+    resource = backend.search(index='ethereum', doc_type='tx', body=body)
+    assert resource.content['hits']['total'] == 11
+    assert resource.content['aggregations']['gas'] == {'value': 7}
+    assert resource.price == 102
+    assert not resource.finalized
+    assert es.search.call_count == 2
+
+    # The finalized part comes from the cache from now on.
+    tracker.update(2600)
+    resource = backend.search(index='ethereum', doc_type='tx', body=body)
+    assert resource.price == 102
+    assert es.search.call_count == 3
+    assert len(backend.historic_cache) == 1
+
+
+def test_finality_split_window():
+    blocks = [10, 20, 30, 2550, 2560]
+
+    def search(index, doc_type, body, **kwargs):
+        clauses = body['query']['bool']['filter'] if 'bool' in body['query'] else [body['query']]
+        found = blocks
+        for clause in clauses:
+            bounds = clause['range']['blockNumber.num']
+            lower = max(bounds.get('gte', 0), bounds.get('gt', -1) + 1)
+            found = [number for number in found if lower <= number <= bounds.get('lte', number)]
+        found = sorted(found, reverse=True)
+        start = int(kwargs.get('from', body.get('from', 0)))
+        end = start + int(kwargs.get('size', body.get('size', 10)))
+        hits = [{'_id': str(number), 'sort': [number]} for number in found[start:end]]
+        return {'took': 1, 'hits': {'total': len(found), 'max_score': None, 'hits': hits}}
+
+    es = mock.Mock()
+    es.search = mock.Mock(side_effect=search)
+    tracker = BlockTracker(None, reorg_safe=6)
+    tracker.update(2500)
+    backend = ElasticsearchBackend(es, block_tracker=tracker, historic_cache=ResourceCache())
+    body = {
+        'query': {'range': {'blockNumber.num': {'gte': 0}}},
+        'sort': [{'blockNumber.num': 'desc'}],
+        'size': 1,
+    }
+
+    # The URL window is moved into the bodies of both parts.
+    resource = backend.search(index='ethereum', doc_type='tx', body=body, size='3')
+    assert es.search.call_count == 2
+    for _, kwargs in es.search.call_args_list:
+        assert kwargs['body']['size'] == 3 and 'size' not in kwargs
+    assert [hit['_id'] for hit in resource.content['hits']['hits']] == ['2560', '2550', '30']
+    assert resource.content['hits']['total'] == 5
+
+    # Hits after the first ones can not be merged from the parts.
+    resource = backend.search(index='ethereum', doc_type='tx', body=body, size='2', **{
+        'from': '1'
+    })
+    assert es.search.call_count == 3
+    assert [hit['_id'] for hit in resource.content['hits']['hits']] == ['2550', '30']
+
+
+def test_count():
+    es = mock.Mock()
+    es.search.return_value = {'took': 3, 'timed_out': False, 'hits': {'total': 42}}
+    tracker = BlockTracker(None, reorg_safe=6)
+    tracker.update(100)
+    backend = ElasticsearchBackend(es, block_tracker=tracker)
+
+    resource = backend.count(
+        index='ethereum',
+        doc_type='log',
+        body={'query': {'range': {'blockNumber.num': {'lte': 50}}}, 'aggs': {}}
+    )
+    assert resource.content == 42
+    assert resource.price == 3
+    assert resource.finalized
+    _, kwargs = es.search.call_args
+    assert kwargs['body'] == {'query': {'range': {'blockNumber.num': {'lte': 50}}}, 'size': 0}
+    assert kwargs['filter_path'] == 'took,timed_out,hits.total'
+
+    es.msearch.return_value = {'responses': [
+        {'took': 1, 'hits': {'total': 1}},
+        {'took': 2, 'hits': {'total': 0}},
+        {'error': {'type': 'query_shard_exception'}},
+    ]}
+    resources = backend.exists_items([
+        {'match_all': {}},
+        {'term': {'x': 1}},
+        {'range': {'x': 'invalid'}},
+    ])
+    assert [resource.content for resource in resources[:2]] == [1, 0]
+    assert [resource.price for resource in resources[:2]] == [1, 2]
+    assert 'error' in resources[2].content
+    _, kwargs = es.msearch.call_args
+    assert json.loads(kwargs['body'][1])['terminate_after'] == 1
+
+    # The limit of the backend does not make searches go on longer.
+    backend.terminate_after = 1000
+    backend.exists_items([{'match_all': {}}])
+    _, kwargs = es.msearch.call_args
+    assert json.loads(kwargs['body'][1])['terminate_after'] == 1
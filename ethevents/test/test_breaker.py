@@ -0,0 +1,66 @@
+import pytest
+from elasticsearch.exceptions import ConnectionError, RequestError
+
+from ethevents.server.breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitOpen
+
+
+class FakeClock(object):
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def fail(error):
+    raise error
+
+
+def test_opens_on_errors_and_recovers():
+    clock = FakeClock()
+    breaker = CircuitBreaker(error_threshold=0.5, min_queries=4, open_duration=30, clock=clock)
+
+    # Bad queries are not Elasticsearch's fault.
+    for _ in range(4):
+        with pytest.raises(RequestError):
+            breaker.call(fail, RequestError(400, 'parsing_exception', {}))
+    assert breaker.state == CLOSED
+
+    assert breaker.call(lambda: 1) == 1
+    for _ in range(5):
+        with pytest.raises(ConnectionError):
+            breaker.call(fail, ConnectionError('N/A', 'refused', None))
+    assert breaker.state == OPEN
+
+    with pytest.raises(CircuitOpen) as e:
+        breaker.call(lambda: 1)
+    assert e.value.retry_after == 30
+    assert breaker.is_open()
+
+    # A failing probe opens it again.
+    clock.now += 30
+    assert not breaker.is_open()
+    with pytest.raises(ConnectionError):
+        breaker.call(fail, ConnectionError('N/A', 'refused', None))
+    assert breaker.state == OPEN
+
+    clock.now += 30
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    # Only a single probe at a time.
+    assert not breaker.allow()
+    breaker.record(False, 0.1)
+    assert breaker.state == CLOSED
+    assert breaker.stats()['openings'] == 2
+
+
+def test_opens_on_latency():
+    clock = FakeClock()
+    breaker = CircuitBreaker(latency_threshold=5, min_queries=3, clock=clock)
+
+    def slow():
+        clock.now += 6
+
+    for _ in range(3):
+        breaker.call(slow)
+    assert breaker.state == OPEN
@@ -0,0 +1,203 @@
+import gevent
+import pytest
+
+from ethevents.server.backend import Resource
+from ethevents.server.cache import (
+    AdmissionCache,
+    FrequencySketch,
+    ResourceCache,
+    SingleFlight,
+    estimate_size,
+)
+
+
+class FakeClock(object):
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_lru_eviction():
+    cache = ResourceCache(max_bytes=30, sizeof=lambda resource: 10)
+    for key in range(3):
+        cache.put(key, Resource(content=key, price=1, expires_at=float('inf')))
+    assert len(cache) == 3
+    assert cache.size == 30
+
+    # Touch the oldest entry, so the second one is least recently used.
+    assert cache.get(0).content == 0
+    cache.put(3, Resource(content=3, price=1, expires_at=float('inf')))
+
+    assert len(cache) == 3
+    assert 1 not in cache
+    assert 0 in cache and 2 in cache and 3 in cache
+    assert cache.stats()['evictions'] == 1
+
+
+def test_oversized_entry_is_kept_until_replaced():
+    cache = ResourceCache(max_bytes=10, sizeof=lambda resource: len(resource.content))
+    cache.put('small', Resource(content='12345', price=1, expires_at=float('inf')))
+    cache.put('big', Resource(content='x' * 20, price=1, expires_at=float('inf')))
+    assert 'small' not in cache
+    assert cache.get('big') is not None
+    assert cache.size == 20
+
+
+def test_expiry():
+    clock = FakeClock()
+    cache = ResourceCache(clock=clock)
+    cache.put('a', Resource(content='a', price=1, expires_at=clock.now + 10))
+    cache.put('b', Resource(content='b', price=1, expires_at=clock.now + 20))
+    # Replacing an entry must not let its old expiry evict the new one.
+    cache.put('a', Resource(content='a2', price=1, expires_at=clock.now + 30))
+
+    clock.now += 15
+    cache.expire()
+    assert len(cache) == 2
+
+    clock.now += 10
+    assert cache.get('b') is None
+    assert cache.get('b', ignore_expiry=True) is None
+    assert cache.get('a').content == 'a2'
+
+    clock.now += 10
+    assert cache.get('a', ignore_expiry=True).content == 'a2'
+    cache.expire()
+    assert len(cache) == 0
+    assert cache.size == 0
+
+    stats = cache.stats()
+    assert stats['expirations'] == 2
+    assert stats['hits'] == 2
+    assert stats['misses'] == 2
+
+
+def test_estimate_size():
+    assert estimate_size('abc') == 3
+    assert estimate_size(b'abcd') == 4
+    assert estimate_size({'took': 5, 'hits': ['ab', 'cd']}) > estimate_size({'took': 5})
+
+
+def test_single_flight():
+    in_flight = SingleFlight()
+    calls = []
+
+    def query(value):
+        calls.append(value)
+        gevent.sleep(0.01)
+        return Resource(content=value, price=len(calls), expires_at=float('inf'))
+
+    greenlets = [gevent.spawn(in_flight.run, 'key', query, 'result') for _ in range(10)]
+    gevent.joinall(greenlets, raise_error=True)
+
+    assert calls == ['result']
+    assert len({id(greenlet.value) for greenlet in greenlets}) == 1
+    assert len(in_flight) == 0
+    assert in_flight.stats()['coalesced'] == 9
+
+    # Once done, the next call executes again.
+    assert in_flight.run('key', query, 'again').content == 'again'
+
+
+def test_single_flight_shares_exceptions():
+    in_flight = SingleFlight()
+
+    def failing_query():
+        gevent.sleep(0.01)
+        raise ValueError('backend down')
+
+    greenlets = [gevent.spawn(in_flight.run, 'key', failing_query) for _ in range(3)]
+    gevent.joinall(greenlets)
+    for greenlet in greenlets:
+        with pytest.raises(ValueError):
+            greenlet.get()
+    assert len(in_flight) == 0
+
+
+def test_single_flight_cancellation():
+    cancelled = []
+    in_flight = SingleFlight(on_cancel=cancelled.append)
+    finished = []
+
+    def query(value):
+        gevent.sleep(0.05)
+        finished.append(value)
+        return value
+
+    # The query goes on as long as somebody waits for it.
+    greenlets = [gevent.spawn(in_flight.run, 'key', query, 'result') for _ in range(2)]
+    gevent.sleep(0.01)
+    greenlets[0].kill()
+    assert greenlets[1].get() == 'result'
+    assert finished == ['result']
+
+    greenlets = [gevent.spawn(in_flight.run, 'key', query, 'abandoned') for _ in range(2)]
+    gevent.sleep(0.01)
+    gevent.killall(greenlets)
+    gevent.sleep(0.1)
+    assert finished == ['result']
+    assert cancelled == ['key']
+    assert len(in_flight) == 0
+    stats = in_flight.stats()
+    assert stats['cancelled'] == 1
+    assert stats['time_saved'] > 0
+
+
+def test_frequency_sketch():
+    sketch = FrequencySketch(width=64)
+    for _ in range(20):
+        sketch.increment('hot')
+    sketch.increment('cold')
+    assert sketch.frequency('hot') == FrequencySketch.MAX_COUNT
+    assert sketch.frequency('cold') >= 1
+    assert sketch.frequency('hot') > sketch.frequency('never')
+
+    sketch.reset()
+    assert sketch.frequency('hot') == FrequencySketch.MAX_COUNT // 2
+
+
+def test_price_probes_do_not_flush_paid_results():
+    cache = AdmissionCache(max_bytes=100, probation_fraction=0.2, sizeof=lambda resource: 10)
+    paid = Resource(content='paid', price=1, expires_at=float('inf'))
+    for key in range(8):
+        cache.put(key, paid)
+        for _ in range(3):
+            cache.get(key)
+        cache.promote(key, paid)
+    assert len(cache.protected) == 8
+
+    # A scan of distinct queries that are never paid for only churns the probation tier.
+    for key in range(100, 200):
+        probe = Resource(content='probe', price=1, expires_at=float('inf'))
+        cache.get(key)
+        cache.put(key, probe)
+        cache.promote(key, probe)
+    assert all(key in cache.protected for key in range(8))
+    assert len(cache.probation) == 2
+    assert cache.stats()['rejections'] == 100
+
+    for key in range(8):
+        assert cache.get(key) == paid
+    stats = cache.stats()
+    assert stats['protected_hit_rate'] > 0
+    assert stats['protected']['hits'] == 8
+
+
+def test_stale_entries():
+    clock = FakeClock()
+    cache = ResourceCache(clock=clock, stale_ttl=60)
+    cache.put('a', Resource(content='a', price=1, expires_at=clock.now + 10))
+
+    clock.now += 20
+    assert cache.get('a') is None
+    assert cache.get('a', ignore_expiry=True).content == 'a'
+    cache.put('b', Resource(content='b', price=1, expires_at=clock.now + 10))
+    assert 'a' in cache
+
+    clock.now += 60
+    cache.expire()
+    assert 'a' not in cache
+    assert cache.get('b', ignore_expiry=True).content == 'b'
+    assert cache.stats()['expirations'] == 1
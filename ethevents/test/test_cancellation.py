@@ -0,0 +1,66 @@
+import socket
+
+import gevent
+import mock
+from gevent.pywsgi import WSGIServer
+
+from ethevents.server.cancellation import (
+    ClientDisconnected,
+    DisconnectWatcher,
+    cancel_tasks,
+)
+
+
+def test_disconnect_watcher():
+    outcomes = []
+
+    def app(environ, start_response):
+        body = environ['wsgi.input'].read()
+        try:
+            gevent.sleep(float(body))
+        except ClientDisconnected:
+            outcomes.append('aborted')
+            raise
+        outcomes.append('answered')
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [b'done']
+
+    watcher = DisconnectWatcher(app)
+    server = WSGIServer(('127.0.0.1', 0), watcher, log=None, error_log=None)
+    server.start()
+
+    def send(delay: bytes) -> socket.socket:
+        client = socket.create_connection(('127.0.0.1', server.server_port))
+        client.sendall(b''.join([
+            b'POST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: ',
+            str(len(delay)).encode('ascii'),
+            b'\r\n\r\n',
+            delay,
+        ]))
+        return client
+
+    try:
+        client = send(b'0.05')
+        assert client.recv(1024).startswith(b'HTTP/1.1 200')
+        client.close()
+        assert outcomes == ['answered']
+
+        send(b'10').close()
+        gevent.sleep(0.1)
+        assert outcomes == ['answered', 'aborted']
+        assert watcher.disconnects == 1
+    finally:
+        server.stop()
+
+
+def test_cancel_tasks():
+    es = mock.Mock()
+    es.tasks.list.return_value = {'nodes': {'node': {'tasks': {
+        'node:1': {'headers': {'X-Opaque-Id': 'abandoned'}},
+        'node:2': {'headers': {'X-Opaque-Id': 'abandoned'}, 'parent_task_id': 'node:1'},
+        'node:3': {'headers': {'X-Opaque-Id': 'other'}},
+        'node:4': {},
+    }}}}
+
+    assert cancel_tasks(es, 'abandoned') == 1
+    es.tasks.cancel.assert_called_once_with(task_id='node:1')
@@ -0,0 +1,57 @@
+import gzip
+
+import pytest
+
+from ethevents.server.backend import Resource
+from ethevents.server.cache import ResourceCache
+from ethevents.server.compression import CompressedContent, GzipCodec, get_codec
+from ethevents.server.shared_cache import deserialize_resource, serialize_resource
+
+CONTENT = {
+    'took': 3,
+    'hits': {'hits': [{'_id': str(i), '_source': {'to': '0x0'}} for i in range(50)]}
+}
+
+
+def test_gzip_is_compatible():
+    codec = GzipCodec()
+    data = b'{"took":1}' * 100
+    assert gzip.decompress(codec.compress(data)) == data
+    assert codec.decompress(gzip.compress(data)) == data
+
+
+def test_compressed_content():
+    codec = get_codec('gzip')
+    compressed = CompressedContent.compress(CONTENT, codec)
+    assert not compressed.raw
+    assert compressed.decode() == CONTENT
+    assert len(compressed) < len(compressed.decompress())
+
+    raw = CompressedContent.compress(b'{"took":3}', codec)
+    assert raw.raw
+    assert raw.decode() == b'{"took":3}'
+
+
+def test_zstd_codec():
+    pytest.importorskip('zstandard')
+    codec = get_codec('zstd')
+    assert codec.name == 'zstd'
+    assert CompressedContent.compress(CONTENT, codec).decode() == CONTENT
+
+
+def test_compressed_cache():
+    cache = ResourceCache(codec=GzipCodec())
+    cache.put('key', Resource(content=CONTENT, price=3, expires_at=float('inf')))
+
+    resource = cache.get('key')
+    assert isinstance(resource.content, CompressedContent)
+    assert resource.content.decode() == CONTENT
+    assert cache.size == len(resource.content)
+
+
+def test_compressed_serialization():
+    resource = Resource(content=CONTENT, price=3, expires_at=12.5)
+    restored = deserialize_resource(serialize_resource(resource, GzipCodec()))
+    assert isinstance(restored.content, CompressedContent)
+    assert restored.content.decode() == CONTENT
+    assert restored.price == 3
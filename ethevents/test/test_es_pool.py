@@ -0,0 +1,86 @@
+import json
+
+import gevent
+import pytest
+from gevent.pywsgi import WSGIServer
+
+from ethevents.server.es_pool import (
+    HedgedConnection,
+    LeastOutstandingSelector,
+    connect,
+)
+
+
+class StandInNode(object):
+    """Local HTTP server answering every request like an Elasticsearch search."""
+
+    def __init__(self, name: str, delay: float = 0):
+        self.name = name
+        self.delay = delay
+        self.requests = 0
+        self.server = WSGIServer(('127.0.0.1', 0), self.app, log=None)
+        self.server.start()
+
+    @property
+    def url(self) -> str:
+        return 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def app(self, environ, start_response):
+        self.requests += 1
+        gevent.sleep(self.delay)
+        body = json.dumps({'took': 1, 'node': self.name, 'hits': {'total': 0, 'hits': []}})
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [body.encode('utf-8')]
+
+
+@pytest.fixture
+def nodes():
+    nodes = [StandInNode('slow', delay=1), StandInNode('fast')]
+    yield nodes
+    for node in nodes:
+        node.server.stop()
+
+
+def test_least_outstanding_selector():
+    class Connection(object):
+        def __init__(self, outstanding):
+            self.outstanding = outstanding
+
+    connections = [Connection(3), Connection(1), Connection(2)]
+    assert LeastOutstandingSelector({}).select(connections) is connections[1]
+
+
+def test_hedged_requests(nodes):
+    es = connect([node.url for node in nodes], hedge=True, pool_size=4)
+    transport = es.transport
+    by_host = {
+        connection.port: connection for connection in transport.connection_pool.connections
+    }
+    slow = by_host[nodes[0].server.server_port]
+
+    # No hedging before the usual latency is known.
+    transport.latencies.extend([0.01] * 10)
+    assert transport.hedge_delay() is None
+    transport.latencies.extend([0.01] * 10)
+    assert transport.hedge_delay() == transport.min_hedge_delay
+
+    started = gevent.get_hub().loop.now()
+    _, _, data = HedgedConnection(transport, slow).perform_request('POST', '/ethereum/_search')
+    assert json.loads(data)['node'] == 'fast'
+    assert gevent.get_hub().loop.now() - started < nodes[0].delay
+    assert transport.hedged == 1 and transport.hedge_wins == 1
+
+    # The losing request was cancelled.
+    gevent.sleep(0)
+    assert slow.outstanding == 0
+
+    # Writes are never sent twice.
+    HedgedConnection(transport, by_host[nodes[1].server.server_port]).perform_request(
+        'PUT', '/ethereum/tx/1'
+    )
+    assert transport.hedged == 1
+
+    # All the way through the client.
+    for _ in range(4):
+        assert es.search(index='ethereum', body={})['hits']['total'] == 0
+    assert transport.stats()['hedged'] >= 1
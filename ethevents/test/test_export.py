@@ -0,0 +1,81 @@
+import json
+import time
+
+import mock
+import pytest
+
+from ethevents.server.backend import ElasticsearchBackend
+from ethevents.server.cancellation import DeadlineExceeded
+from ethevents.server.export import (
+    EXPORT_PAGE_SIZE,
+    decode_cursor,
+    encode_cursor,
+    export_lines,
+    page_body,
+)
+
+
+def hit(i: int) -> dict:
+    return {'_id': str(i), '_source': {'blockNumber': i}, 'sort': [i, str(i)]}
+
+
+def test_page_body():
+    body = {'query': {'match_all': {}}, 'sort': 'blockNumber', 'from': 10, 'aggs': {}}
+    page = page_body(body)
+    assert page == {
+        'query': {'match_all': {}},
+        'sort': ['blockNumber', {'_id': 'asc'}],
+        'size': EXPORT_PAGE_SIZE,
+    }
+    assert body['from'] == 10
+    # Documents of one type are told apart by fields with doc values.
+    assert page_body(body, doc_type='tx')['sort'] == ['blockNumber', {'hash': 'asc'}]
+    assert page_body({'sort': [{'transactionHash': 'desc'}]}, doc_type='log')['sort'] == [
+        {'transactionHash': 'desc'},
+        {'logIndex.num': 'asc'},
+    ]
+
+    cursor = encode_cursor([5, 'abc'])
+    assert decode_cursor(cursor) == [5, 'abc']
+    page = page_body({'size': 10 ** 6, 'sort': [{'_id': 'desc'}]}, cursor)
+    assert page['size'] == EXPORT_PAGE_SIZE
+    assert page['sort'] == [{'_id': 'desc'}]
+    assert page['search_after'] == [5, 'abc']
+
+    for cursor in ('not a cursor', encode_cursor({'a': 1})[:-2], 'bm90IGpzb24='):
+        with pytest.raises(ValueError):
+            page_body(body, cursor)
+
+
+def test_export_lines():
+    lines = list(export_lines({'hits': {'hits': [hit(1), hit(2)]}}, 2))
+    assert [json.loads(line.decode('utf-8')) for line in lines[:2]] == [hit(1), hit(2)]
+    cursor = json.loads(lines[2].decode('utf-8'))['next']
+    assert decode_cursor(cursor) == [2, '2']
+
+    # A short page is the last one.
+    lines = list(export_lines({'hits': {'hits': [hit(3)]}}, 2))
+    assert json.loads(lines[-1].decode('utf-8')) == {'next': None}
+
+
+def test_export_page():
+    es = mock.Mock()
+    es.search.return_value = {'took': 4, 'timed_out': False, 'hits': {'hits': [hit(1)]}}
+    backend = ElasticsearchBackend(es)
+
+    resource = backend.export_page(
+        index='ethereum',
+        doc_type='log',
+        body={'query': {'match_all': {}}, 'size': 1},
+        cursor=encode_cursor([0, '0'])
+    )
+    assert resource.price == 4
+    # Kept just long enough for the paid request.
+    assert resource.expires_at <= time.time() + backend.result_ttl
+    _, kwargs = es.search.call_args
+    assert kwargs['body']['search_after'] == [0, '0']
+    assert kwargs['body']['sort'] == [{'transactionHash': 'asc'}, {'logIndex.num': 'asc'}]
+
+    es.search.return_value = {'took': 4, 'timed_out': True, 'hits': {'hits': []}}
+    with pytest.raises(DeadlineExceeded):
+        backend.export_page(index='ethereum', body={})
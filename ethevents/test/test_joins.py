@@ -0,0 +1,292 @@
+import gevent
+import mock
+
+from ethevents.examples import queries
+from ethevents.server import joins
+from ethevents.server.backend import ElasticsearchBackend
+from ethevents.server.blocks import BlockTracker
+from ethevents.server.finality import as_list
+from ethevents.server.joins import JoinIndex, parse_join
+
+TRANSFER = queries.gas_prices_for_event()['query']['bool']['filter']['has_child']['query'][
+    'match'
+]['signature']
+OTHER = '0x1234'
+
+
+def make_logs():
+    """Logs of 10 transactions in blocks 100 to 109, 3 of them with other logs too."""
+    logs = [
+        dict(signature=TRANSFER, address='0xa', transactionHash='0x{:02x}'.format(i),
+             blockNumber=dict(num=100 + i))
+        for i in range(10)
+    ]
+    logs += [
+        dict(signature=OTHER, address='0xb', transactionHash='0x{:02x}'.format(i),
+             blockNumber=dict(num=100 + i))
+        for i in range(3)
+    ]
+    return logs
+
+
+def fake_scan(logs):
+    def scan(es, query, **kwargs):
+        ((field, values), ), ((_, bounds), ) = [
+            clause[clause_type].items()
+            for clause, clause_type in zip(query['query']['bool']['filter'], ('terms', 'range'))
+        ]
+        for log in logs:
+            number = log['blockNumber']['num']
+            if log[field] in values and bounds.get('gt', -1) < number <= bounds['lte']:
+                yield {'_source': log}
+    return scan
+
+
+def join_index(logs, height: int, **kwargs) -> JoinIndex:
+    tracker = BlockTracker(None, reorg_safe=0)
+    tracker.update(height)
+    es = mock.Mock()
+    es.count.side_effect = lambda body, **_: {'count': sum(
+        1 for log in logs
+        if log['signature'] == body['query']['bool']['filter'][0]['term'].get('signature')
+    )}
+    return JoinIndex(es, tracker, **kwargs)
+
+
+def load(index: JoinIndex, body):
+    for key in index.wanted(body):
+        index.request(key)
+    gevent.sleep(0)
+
+
+def test_parse_join():
+    query = queries.gas_prices_for_event()['query']['bool']['filter']
+    join = parse_join(query['has_child'])
+    assert join.parent_type == 'tx'
+    assert join.keys == [('signature', TRANSFER)]
+
+    query = queries.last_blocks_that_logged()['query']['bool']['filter']
+    join = parse_join(query['has_child'])
+    assert join.parent_type == 'block'
+    assert join.keys == [('signature', TRANSFER)]
+
+    assert parse_join({'type': 'log', 'query': {'terms': {'address': ['0xa', '0xb']}}}).keys == [
+        ('address', '0xa'),
+        ('address', '0xb'),
+    ]
+    for params in (
+            # Transaction fields are not precomputed.
+            queries.last_blocks_with_address()['query']['bool']['filter']['has_child'],
+            {'type': 'log', 'query': {'term': {'data': '0x'}}},
+            {'type': 'log', 'query': {'match': {'signature': {'query': '0x', 'fuzziness': 1}}}},
+            {'type': 'log', 'query': {'term': {'signature': '0x'}}, 'min_children': 2},
+            {'type': 'log', 'query': {'term': {'signature': '0x'}}, 'inner_hits': {}},
+    ):
+        assert parse_join(params) is None
+
+
+def test_rewrite(monkeypatch):
+    logs = make_logs()
+    monkeypatch.setattr(joins, 'scan', fake_scan(logs))
+    index = join_index(logs, 105)
+    body = queries.gas_prices_for_event()
+
+    # Left as it is until loaded, searching does not load anything.
+    assert index.rewrite(body) is None
+    gevent.sleep(0)
+    assert not index.sets
+    assert index.wanted(body) == [('signature', TRANSFER)]
+    load(index, body)
+    assert not index.pending
+    assert index.wanted(body) == []
+    [rewritten] = index.rewrite(body)
+    assert rewritten['aggs'] == body['aggs']
+    join = rewritten['query']['bool']['filter']
+    parents, tail = join['bool']['should']
+    assert parents == {'ids': {'type': 'tx', 'values': ['0x{:02x}'.format(i) for i in range(6)]}}
+    assert tail['has_child']['query']['bool']['filter'] == [
+        body['query']['bool']['filter']['has_child']['query'],
+        {'range': {'blockNumber.num': {'gt': 105}}},
+    ]
+
+    # Blocks of logs with either signature, in filter context only.
+    body = {'query': {'bool': {'filter': [{'has_child': {'type': 'tx', 'query': {
+        'has_child': {'type': 'log', 'query': {'terms': {'signature': [TRANSFER, OTHER]}}}
+    }}}]}}}
+    assert index.rewrite(body) is None
+    ElasticsearchBackend(None, join_index=index).load_indexes('_count', body)
+    gevent.sleep(0)
+    [rewritten] = index.rewrite(body)
+    parents, tail = rewritten['query']['bool']['filter'][0]['bool']['should']
+    assert parents['bool']['filter'][1] == {'terms': {'number.num': list(range(100, 106))}}
+    assert index.rewrite({'query': body['query']['bool']['filter'][0]}) is None
+
+    # Newly finalized blocks are added.
+    index.block_tracker.update(107)
+    assert index.refresh()
+    assert index.sets[('signature', OTHER)].height == 107
+    [rewritten] = index.rewrite(queries.gas_prices_for_event())
+    parents, _ = rewritten['query']['bool']['filter']['bool']['should']
+    assert len(parents['ids']['values']) == 8
+    assert index.stats()['transactions'] == 8
+
+
+def test_oversized(monkeypatch):
+    logs = make_logs()
+    monkeypatch.setattr(joins, 'scan', fake_scan(logs))
+    index = join_index(logs, 109, max_size=5, max_keys=1)
+    body = queries.gas_prices_for_event()
+    load(index, body)
+    assert index.sets[('signature', TRANSFER)] is None
+    assert index.rewrite(body) is None
+    assert index.stats()['oversized'] == 1
+
+    # The least recently used key is dropped.
+    load(index, queries.gas_prices_for_event(event_sig=OTHER))
+    assert list(index.sets) == [('signature', OTHER)]
+
+
+def test_pending_loads(monkeypatch):
+    logs = make_logs()
+    monkeypatch.setattr(joins, 'scan', fake_scan(logs))
+    index = join_index(logs, 109, max_pending=1)
+    runs = []
+
+    def run(load, *args):
+        runs.append(args)
+        return load(*args)
+
+    # Beyond `max_pending`, keys are requested again by a later search.
+    index.request(('signature', TRANSFER), run)
+    index.request(('signature', OTHER), run)
+    gevent.sleep(0)
+    assert runs == [(('signature', TRANSFER), )]
+    assert list(index.sets) == [('signature', TRANSFER)]
+    assert index.wanted(queries.gas_prices_for_event(event_sig=OTHER)) == [('signature', OTHER)]
+
+    # Failed loads are dropped.
+    index.es.count.side_effect = Exception('unavailable')
+    index.request(('signature', OTHER), run)
+    gevent.sleep(0)
+    assert not index.pending
+    assert ('signature', OTHER) not in index.sets
+
+
+def test_transaction_budget(monkeypatch):
+    third = '0x5678'
+    logs = make_logs() + [
+        dict(signature=third, address='0xc', transactionHash='0x1{}'.format(i),
+             blockNumber=dict(num=100 + i))
+        for i in range(2)
+    ]
+    monkeypatch.setattr(joins, 'scan', fake_scan(logs))
+
+    # Transactions of dropped keys are removed from the table.
+    index = join_index(logs, 109, max_keys=2, max_transactions=11)
+    for signature in (TRANSFER, OTHER, third):
+        load(index, queries.gas_prices_for_event(event_sig=signature))
+    assert list(index.sets) == [('signature', OTHER), ('signature', third)]
+    assert index.stats()['transactions'] == 5
+    [rewritten] = index.rewrite(queries.gas_prices_for_event(event_sig=third))
+    parents, _ = rewritten['query']['bool']['filter']['bool']['should']
+    assert parents['ids']['values'] == ['0x10', '0x11']
+
+    # Keys are dropped to stay within the budget.
+    index = join_index(logs, 109, max_transactions=11)
+    for signature in (TRANSFER, third):
+        load(index, queries.gas_prices_for_event(event_sig=signature))
+    assert list(index.sets) == [('signature', third)]
+    assert index.stats()['transactions'] == 2
+
+
+def test_sharded_search(monkeypatch):
+    logs = make_logs()
+    monkeypatch.setattr(joins, 'scan', fake_scan(logs))
+    index = join_index(logs, 109, shard_size=4)
+    body = dict(queries.last_blocks_that_logged(), size=3)
+    load(index, body)
+
+    # Too many ids for one filter.
+    assert index.rewrite(body) is None
+    parts = index.rewrite(body, shardable=True)
+    assert len(parts) == 4
+    shards = [
+        part['query']['bool']['filter']['bool']['filter'][1]['terms']['number.num']
+        for part in parts[:3]
+    ]
+    assert shards == [[100, 101, 102, 103], [104, 105, 106, 107], [108, 109]]
+    assert 'has_child' in parts[3]['query']['bool']['filter']
+
+    def search(body, **kwargs):
+        # The optimizer merges the filters of the shards into the query.
+        blocks = [
+            number for clause in as_list(body['query']['bool']['filter'])
+            for number in clause.get('terms', {}).get('number.num', [])
+        ]
+        hits = [
+            {'_id': str(number), '_source': {}, 'sort': [number]}
+            for number in sorted(blocks, reverse=True)[:3]
+        ]
+        return {'took': 1, 'hits': {'total': len(blocks), 'max_score': None, 'hits': hits}}
+
+    es = mock.Mock()
+    es.search.side_effect = search
+    backend = ElasticsearchBackend(es, join_index=index)
+    resource = backend.search(index='ethereum', doc_type='block', body=body)
+    assert resource.price == 4
+    assert resource.content['hits']['total'] == 10
+    assert [hit['_id'] for hit in resource.content['hits']['hits']] == ['109', '108', '107']
+
+    # Counts are not split.
+    backend.count(index='ethereum', doc_type='block', body=body)
+    _, kwargs = es.search.call_args
+    assert 'has_child' in kwargs['body']['query']['bool']['filter']
+
+
+def test_sharded_terms(monkeypatch):
+    logs = make_logs()
+    monkeypatch.setattr(joins, 'scan', fake_scan(logs))
+    index = join_index(logs, 109, shard_size=4)
+    # The top miner of each shard of blocks is not the top one of all blocks.
+    miners = dict(zip(range(100, 110), 'aaabcccbbb'))
+    body = dict(queries.last_blocks_that_logged(), size=0, aggs={
+        'miners': {'terms': {'field': 'miner', 'size': 1}}
+    })
+    load(index, body)
+    assert len(index.rewrite(body, shardable=True)) == 4
+
+    def search(body, **kwargs):
+        query = body['query']['bool']['filter']
+        blocks = [
+            number for clause in as_list(query)
+            for number in clause.get('terms', {}).get('number.num', [])
+        ]
+        joined = [clause for clause in as_list(query) if 'has_child' in clause]
+        if joined and 'range' not in str(joined):
+            # The original join, not the one restricted to newer blocks.
+            blocks = list(miners)
+        counts = dict()
+        for number in blocks:
+            counts[miners[number]] = counts.get(miners[number], 0) + 1
+        buckets = [
+            {'key': miner, 'doc_count': count}
+            for miner, count in sorted(counts.items(), key=lambda item: -item[1])[:1]
+        ]
+        return {
+            'took': 1,
+            'hits': {'total': len(blocks), 'max_score': None, 'hits': []},
+            'aggregations': {'miners': {
+                'doc_count_error_upper_bound': 0,
+                'sum_other_doc_count': len(blocks) - sum(b['doc_count'] for b in buckets),
+                'buckets': buckets,
+            }},
+        }
+
+    es = mock.Mock()
+    es.search.side_effect = search
+    backend = ElasticsearchBackend(es, join_index=index)
+    resource = backend.search(index='ethereum', doc_type='block', body=body)
+    assert es.search.call_count == 1
+    assert resource.content['aggregations']['miners']['buckets'] == [
+        {'key': 'b', 'doc_count': 4}
+    ]
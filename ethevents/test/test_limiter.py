@@ -0,0 +1,153 @@
+import gevent
+import pytest
+
+from ethevents.server.limiter import (
+    AdaptiveLimiter,
+    ConcurrencyLimiter,
+    FairQueue,
+    Overloaded,
+)
+
+
+def test_concurrency_limit_and_queue():
+    limiter = ConcurrencyLimiter(max_concurrency=2, max_queue=2, queue_deadline=5)
+    running = []
+    max_running = []
+
+    def query(i):
+        running.append(i)
+        max_running.append(len(running))
+        gevent.sleep(0.01)
+        running.remove(i)
+        return i
+
+    greenlets = [gevent.spawn(limiter.run, query, i) for i in range(5)]
+    gevent.joinall(greenlets)
+
+    assert max(max_running) == 2
+    assert [greenlet.value for greenlet in greenlets[:4]] == [0, 1, 2, 3]
+    # Neither a free slot nor room in the queue.
+    assert isinstance(greenlets[4].exception, Overloaded)
+    assert greenlets[4].exception.retry_after >= 1
+
+    stats = limiter.stats()
+    assert stats['admitted'] == 4
+    assert stats['shed'] == 1
+    assert stats['in_flight'] == 0
+    assert stats['queue_time_p99'] > 0
+
+
+def test_queue_deadline():
+    limiter = ConcurrencyLimiter(max_concurrency=1, queue_deadline=0.01)
+    slow = gevent.spawn(limiter.run, gevent.sleep, 0.1)
+    gevent.sleep(0)
+    with pytest.raises(Overloaded):
+        limiter.run(lambda: None)
+    slow.join()
+
+    # Once queries are known to be slow, waiting is not even attempted.
+    assert limiter.average_run_time > 0.001
+    blocking = gevent.spawn(limiter.run, gevent.sleep, 0.1)
+    gevent.sleep(0)
+    limiter.queue_deadline = limiter.average_run_time / 2
+    with pytest.raises(Overloaded):
+        limiter.run(lambda: None)
+    assert len(limiter.queue) == 0
+    blocking.join()
+    assert limiter.run(lambda: 1) == 1
+
+
+def test_cancelled_queries_free_their_slots():
+    limiter = ConcurrencyLimiter(max_concurrency=1, queue_deadline=5)
+    running = gevent.spawn(limiter.run, gevent.sleep, 0.05)
+    queued = gevent.spawn(limiter.run, gevent.sleep, 10)
+    gevent.sleep(0.01)
+    assert len(limiter.queue) == 1
+
+    queued.kill()
+    running.kill()
+    assert limiter.in_flight == 0
+    assert len(limiter.queue) == 0
+    # Cancelled queries do not count as fast ones.
+    assert limiter.average_run_time == 0
+    assert limiter.run(lambda: 1) == 1
+
+
+def test_fair_scheduling():
+    limiter = ConcurrencyLimiter(max_concurrency=1, queue_deadline=5)
+    order = []
+
+    def query(sender):
+        order.append(sender)
+        gevent.sleep(0.001)
+
+    blocking = gevent.spawn(limiter.run, gevent.sleep, 0.01)
+    gevent.sleep(0)
+    # A heavy sender queues up first, then two light ones arrive.
+    greenlets = [gevent.spawn(limiter.run, query, 'heavy', sender='heavy') for _ in range(6)]
+    greenlets += [gevent.spawn(limiter.run, query, 'light', sender='light') for _ in range(2)]
+    greenlets += [
+        gevent.spawn(limiter.run, query, 'rich', sender='rich', weight=2) for _ in range(2)
+    ]
+    gevent.joinall(greenlets + [blocking])
+
+    assert order[:6].count('heavy') == 2
+    assert order[:6].count('light') == 2
+    # Double weight gets both queries in before the other senders' second ones.
+    assert order[:4].count('rich') == 2
+
+    stats = limiter.sender_stats()
+    assert stats['heavy']['queries'] == 6
+    assert stats['light']['average_queue_time'] < stats['heavy']['average_queue_time']
+
+
+def test_fair_queue_removal():
+    queue = FairQueue()
+    a, b = object(), object()
+    queue.push(a, 'x')
+    queue.push(b, 'x')
+    queue.remove(a)
+    assert len(queue) == 1
+    assert queue.pop() is b
+    assert len(queue) == 0
+
+
+class FakeClock(object):
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_adaptive_limit():
+    clock = FakeClock()
+    limiter = AdaptiveLimiter(initial_limit=4, min_limit=2, max_limit=8, clock=clock)
+
+    def query(latency, took=None):
+        clock.now += latency
+        if took is not None:
+            limiter.observe_took(took)
+
+    # Saturated and fast: the limit grows additively.
+    for _ in range(40):
+        limiter.in_flight = limiter.limit - 1
+        limiter.run(query, 0.01, took=5)
+    assert limiter.limit == 8
+
+    # Latency goes up: the limit shrinks multiplicatively, but not below the minimum.
+    limiter.in_flight = 0
+    for _ in range(100):
+        limiter.run(query, 0.5)
+    assert limiter.limit == 2
+
+    # Fast wall-clock times do not help while Elasticsearch reports slow queries.
+    limiter.in_flight = 1
+    for _ in range(20):
+        limiter.run(query, 0.01, took=500)
+    assert limiter.limit == 2
+
+    stats = limiter.stats()
+    assert stats['limit'] == 2
+    limits = [limit for _, limit in stats['limit_history']]
+    assert limits[0] == 4 and max(limits) == 8 and limits[-1] == 2
@@ -0,0 +1,62 @@
+import json
+import os
+
+import mock
+from elasticsearch.exceptions import NotFoundError
+
+from ethevents.server.mappings import MappingStore
+
+MAPPINGS_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'docs', 'mappings')
+
+
+def test_mapping_files():
+    mappings = MappingStore(None)
+    mappings.load_directory(MAPPINGS_DIR)
+
+    mapping = mappings.lookup('ethereum')
+    (concrete_index, ) = json.loads(mapping.resource.content.decode('utf-8')).keys()
+    assert {'block', 'tx', 'log'} <= set(
+        json.loads(mapping.resource.content.decode('utf-8'))[concrete_index]['mappings']
+    )
+    assert mapping.resource.price == 5
+    assert mappings.lookup('ethereum') is mapping
+
+    log_mapping = mappings.lookup('ethereum', 'log')
+    assert list(json.loads(log_mapping.resource.content.decode('utf-8'))[concrete_index][
+        'mappings'
+    ]) == ['log']
+    assert log_mapping.etag != mapping.etag
+    assert mappings.lookup('ethereum', 'missing') is None
+    assert mappings.lookup('other') is None
+
+
+def test_mapping_refresh():
+    es = mock.Mock()
+    responses = {'ethereum': {'ethereum_2': {'mappings': {'tx': {'properties': {}}}}}}
+
+    def get_mapping(index):
+        if index not in responses:
+            raise NotFoundError(404, 'index_not_found_exception')
+        return responses[index]
+
+    es.indices.get_mapping.side_effect = get_mapping
+    mappings = MappingStore(es)
+    assert mappings.lookup() is None
+
+    assert mappings.refresh()
+    etag = mappings.lookup().etag
+    assert mappings.lookup('ethereum', 'tx').etag == etag
+    assert mappings.stats()['indices'] == ['ethereum']
+
+    # Unchanged mappings keep their ETag.
+    assert mappings.refresh()
+    assert mappings.lookup().etag == etag
+
+    responses['ethereum']['ethereum_2']['mappings']['tx']['properties']['gas'] = {}
+    assert mappings.refresh()
+    assert mappings.lookup().etag != etag
+
+    # The mappings are kept while Elasticsearch is unavailable.
+    es.indices.get_mapping.side_effect = ConnectionError('down')
+    assert not mappings.refresh()
+    assert mappings.lookup('ethereum') is not None
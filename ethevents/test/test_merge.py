@@ -0,0 +1,98 @@
+import math
+
+from ethevents.examples.queries import gas_prices_query
+from ethevents.server.merge import merge_responses, mergeable
+
+
+def stats(values):
+    return dict(
+        count=len(values),
+        min=min(values),
+        max=max(values),
+        sum=sum(values),
+        avg=sum(values) / len(values),
+        sum_of_squares=sum(value ** 2 for value in values),
+    )
+
+
+def test_mergeable():
+    assert mergeable(gas_prices_query())
+    assert mergeable({'query': {}, 'size': 5, 'sort': {'blockNumber.num': 'desc'}})
+    # Hits sorted by score can't be merged.
+    assert not mergeable({'query': {}, 'size': 5})
+    assert not mergeable({'query': {}, 'size': 0, 'aggs': {'a': {'cardinality': {'field': 'to'}}}})
+    assert not mergeable({'query': {}, 'size': 0, 'aggs': {'a': {'avg': {'field': 'gas'}}}})
+    assert not mergeable({
+        'size': 0,
+        'aggs': {'a': {'terms': {'field': 'to'}, 'aggs': {'b': {'percentiles': {}}}}}
+    })
+    assert not mergeable({
+        'query': {},
+        'size': 0,
+        'aggs': {'a': {'date_histogram': {'field': 'timestamp', 'interval': 'day', 'keyed': True}}}
+    })
+
+
+def test_merge_responses():
+    body = {
+        'size': 3,
+        'sort': [{'blockNumber.num': 'desc'}],
+        'aggs': {
+            'histogram': {
+                'histogram': {'field': 'gasPrice.num', 'interval': 10},
+                'aggs': {'gas': {'extended_stats': {'field': 'gas.num'}}}
+            },
+            'callers': {'terms': {'field': 'from', 'size': 2}},
+            'largest': {'max': {'field': 'value.num'}},
+        }
+    }
+    historic = {
+        'took': 100,
+        '_shards': {'total': 5, 'successful': 5, 'failed': 0},
+        'hits': {'total': 3, 'max_score': None, 'hits': [
+            {'_id': 'b', 'sort': [5]}, {'_id': 'c', 'sort': [3]}, {'_id': 'd', 'sort': [1]},
+        ]},
+        'aggregations': {
+            'histogram': {'buckets': [
+                {'key': 0, 'doc_count': 2, 'gas': dict(stats([1, 3]), variance=1)},
+                {'key': 10, 'doc_count': 1, 'gas': dict(stats([5]), variance=0)},
+            ]},
+            'callers': {'doc_count_error_upper_bound': 0, 'sum_other_doc_count': 0, 'buckets': [
+                {'key': '0x1', 'doc_count': 2}, {'key': '0x2', 'doc_count': 1},
+            ]},
+            'largest': {'value': 7},
+        }
+    }
+    tail = {
+        'took': 3,
+        '_shards': {'total': 5, 'successful': 5, 'failed': 0},
+        'hits': {'total': 1, 'max_score': None, 'hits': [{'_id': 'a', 'sort': [9]}]},
+        'aggregations': {
+            'histogram': {'buckets': [
+                {'key': 10, 'doc_count': 1, 'gas': dict(stats([7]), variance=0)},
+            ]},
+            'callers': {'doc_count_error_upper_bound': 0, 'sum_other_doc_count': 0, 'buckets': [
+                {'key': '0x3', 'doc_count': 1},
+            ]},
+            'largest': {'value': None},
+        }
+    }
+
+    merged = merge_responses(body, [historic, tail])
+
+    assert merged['took'] == 103
+    assert merged['_shards']['total'] == 10
+    assert merged['hits']['total'] == 4
+    assert [hit['_id'] for hit in merged['hits']['hits']] == ['a', 'b', 'c']
+
+    buckets = merged['aggregations']['histogram']['buckets']
+    assert [(bucket['key'], bucket['doc_count']) for bucket in buckets] == [(0, 2), (10, 2)]
+    gas = buckets[1]['gas']
+    assert gas['count'] == 2 and gas['min'] == 5 and gas['max'] == 7 and gas['avg'] == 6
+    assert math.isclose(gas['variance'], 1)
+    assert math.isclose(gas['std_deviation_bounds']['upper'], 8)
+
+    callers = merged['aggregations']['callers']
+    assert [bucket['key'] for bucket in callers['buckets']] == ['0x1', '0x2']
+    assert callers['sum_other_doc_count'] == 1
+    assert merged['aggregations']['largest'] == {'value': 7}
@@ -0,0 +1,70 @@
+import json
+
+import mock
+import pytest
+from werkzeug.exceptions import BadRequest, MethodNotAllowed
+
+from ethevents.server.backend import ElasticsearchBackend, msearch_lines, split_msearch
+from ethevents.server.msearch import MsearchItem, read_msearch, splice
+
+
+def test_read_msearch():
+    data = b'{"index": "ethereum"}\n\n{"size": 0}\r\n{}\n{"query": {"match_all": {}}}'
+    searches = list(read_msearch(data))
+    assert [(search.header, search.body) for search in searches] == [
+        ({'index': 'ethereum'}, {'size': 0}),
+        ({}, {'query': {'match_all': {}}}),
+    ]
+    assert searches[0].header_line == b'{"index": "ethereum"}'
+    assert searches[0].body_line == b'{"size": 0}'
+
+    # Values beyond what the fast parser supports are still read.
+    (search, ) = read_msearch(b'{}\n{"query": {"term": {"value": 100000000000000000000000}}}')
+    assert search.body['query']['term']['value'] == 10 ** 23
+
+    for data in (b'{}', b'{}\n[]', b'{}\n{"size": }', b'{}\n{}\n\xff\n{}'):
+        with pytest.raises(ValueError):
+            list(read_msearch(data))
+        with pytest.raises(BadRequest):
+            split_msearch(data)
+
+
+def test_splice():
+    line = b'{ "query" : {"match_all": {}} }'
+    spliced = splice(line, json.loads(line.decode('utf-8')), {'timeout': '10ms'})
+    assert spliced.endswith(b'"query" : {"match_all": {}} }')
+    assert json.loads(spliced.decode('utf-8')) == {'query': {'match_all': {}}, 'timeout': '10ms'}
+    assert splice(line, {}, {}) is line
+    assert splice(b'{ }', {}, {'timeout': '10ms'}) == b'{"timeout":"10ms"}'
+    # No duplicate keys.
+    assert json.loads(splice(b'{"timeout": "1s"}', {'timeout': '1s'}, {'timeout': '10ms'})) == {
+        'timeout': '10ms'
+    }
+
+
+def test_msearch_lines():
+    limits = {'timeout': '10ms'}
+    (search, ) = split_msearch(b'{"index": "ethereum"}\n{"size": 0}\n')
+    header_line, body_line = msearch_lines(search, limits)
+    # Unchanged lines are forwarded as they are.
+    assert header_line is search.header_line
+    assert body_line == b'{"timeout":"10ms","size": 0}'
+
+    (search, ) = split_msearch(b'{"index": "other"}\n{"size": 0}\n')
+    header_line, _ = msearch_lines(search, limits)
+    assert json.loads(header_line.decode('utf-8')) == {'index': 'ethereum'}
+
+    # Searches that were not read from a request.
+    header_line, body_line = msearch_lines(MsearchItem({}, {'size': 0}), limits)
+    assert header_line == b'{}'
+    assert json.loads(body_line.decode('utf-8')) == {'size': 0, 'timeout': '10ms'}
+
+    for body in (
+            b'{"script": {"lang": "painless"}}',
+            b'{"\\u0073cript": {"lang": "painless"}}',
+    ):
+        (search, ) = split_msearch(b'{}\n' + body)
+        es = mock.Mock()
+        with pytest.raises(MethodNotAllowed):
+            ElasticsearchBackend(es).msearch_items([search])
+        assert not es.msearch.called
@@ -0,0 +1,209 @@
+import copy
+import json
+import random
+from typing import Any, Dict, Optional
+
+import mock
+
+from ethevents.server.backend import ElasticsearchBackend, filtered_query
+from ethevents.server.finality import as_list
+from ethevents.server.optimizer import (
+    DROP_EMPTY_CLAUSES,
+    DROP_SORT,
+    FILTER_CONTEXT,
+    FLATTEN_BOOL,
+    UNWRAP_BOOL,
+    optimize,
+)
+
+FIELDS = ('a', 'b', 'c')
+
+
+def matches(query: Dict, doc: Dict, filter_context: bool) -> Optional[float]:
+    """Score of `doc` for `query` following the rules of Elasticsearch 6, `None` if it does
+    not match. A local stand-in for Elasticsearch in the equivalence tests."""
+    ((clause_type, params), ) = query.items()
+    if clause_type == 'match_all':
+        score = 1.0
+    elif clause_type == 'term':
+        ((field, value), ) = params.items()
+        score = 1.0 + value if doc[field] == value else None
+    elif clause_type == 'range':
+        ((field, bounds), ) = params.items()
+        score = 1.0 if bounds['gte'] <= doc[field] <= bounds['lte'] else None
+    elif clause_type == 'constant_score':
+        score = None if matches(params['filter'], doc, True) is None else 1.0
+    else:
+        assert clause_type == 'bool'
+        clauses = {
+            context: [clause for clause in as_list(params.get(context)) if clause != {}]
+            for context in ('must', 'filter', 'should', 'must_not')
+        }
+        must = [matches(clause, doc, filter_context) for clause in clauses['must']]
+        should = [matches(clause, doc, filter_context) for clause in clauses['should']]
+        should = [score for score in should if score is not None]
+        required = clauses['must'] or clauses['filter']
+        minimum_should_match = params.get('minimum_should_match')
+        if minimum_should_match is None:
+            # Filter context makes `should` required.
+            minimum_should_match = 1 if filter_context or not required else 0
+        if clauses['should'] and not required:
+            minimum_should_match = max(minimum_should_match, 1)
+        if not clauses['should']:
+            minimum_should_match = 0
+        failed = (
+            any(score is None for score in must),
+            any(matches(clause, doc, True) is None for clause in clauses['filter']),
+            any(matches(clause, doc, True) is not None for clause in clauses['must_not']),
+            len(should) < minimum_should_match,
+        )
+        if any(failed):
+            score = None
+        elif not any(clauses.values()):
+            score = 1.0
+        else:
+            score = sum(must) + sum(should)
+    if score is not None and filter_context:
+        return 0.0
+    return score
+
+
+def search(body: Dict, params: Dict, docs) -> Any:
+    """What Elasticsearch would answer: total, matching documents (as seen by aggregations)
+    and hits."""
+    query = body.get('query', {'match_all': {}})
+    found = [(doc, matches(query, doc, False)) for doc in docs]
+    found = [(doc, score) for doc, score in found if score is not None]
+    size = int(params.get('size', body.get('size', 10)))
+    if 'sort' in body:
+        ((field, order), ) = body['sort'].items()
+        found.sort(key=lambda item: (item[0][field], item[0]['_id']), reverse=order == 'desc')
+        hits = [(doc['_id'], None) for doc, _ in found[:size]]
+    else:
+        found.sort(key=lambda item: (-item[1], item[0]['_id']))
+        hits = [(doc['_id'], score) for doc, score in found[:size]]
+    return len(found), sorted(doc['_id'] for doc, _ in found), hits
+
+
+def random_query(rng: random.Random, depth: int = 0) -> Dict:
+    kind = rng.random()
+    if depth >= 3 or kind < 0.35:
+        field = rng.choice(FIELDS)
+        if rng.random() < 0.7:
+            return {'term': {field: rng.randint(0, 2)}}
+        low = rng.randint(0, 2)
+        return {'range': {field: {'gte': low, 'lte': low + rng.randint(0, 1)}}}
+    if kind < 0.4:
+        return {'match_all': {}}
+    if kind < 0.45:
+        return {'constant_score': {'filter': random_query(rng, depth + 1)}}
+    params = dict()
+    for context in ('must', 'filter', 'should', 'must_not'):
+        if rng.random() < 0.5:
+            clauses = [random_query(rng, depth + 1) for _ in range(rng.randint(0, 2))]
+            if rng.random() < 0.1:
+                clauses.append({})
+            params[context] = clauses[0] if len(clauses) == 1 and rng.random() < 0.5 else clauses
+    if params.get('should') and rng.random() < 0.2:
+        params['minimum_should_match'] = rng.randint(0, 1)
+    return {'bool': params}
+
+
+def random_body(rng: random.Random) -> Dict:
+    body = {'query': random_query(rng)}
+    shape = rng.random()
+    if shape < 0.3:
+        body['size'] = 0
+        body['aggs'] = {'a': {'terms': {'field': 'a'}}}
+    elif shape < 0.6:
+        body['sort'] = {rng.choice(FIELDS): rng.choice(['asc', 'desc'])}
+        body['size'] = rng.choice([0, 3, 10])
+    elif shape < 0.7:
+        body['min_score'] = 1
+    return body
+
+
+def test_equivalence():
+    rng = random.Random(0)
+    docs = [
+        dict({field: rng.randint(0, 2) for field in FIELDS}, _id=i)
+        for i in range(40)
+    ]
+    rewritten = 0
+    for _ in range(2000):
+        body = random_body(rng)
+        params = {'size': '0'} if rng.random() < 0.1 else {}
+        original = copy.deepcopy(body)
+        optimized, rewrites = optimize(body, params)
+        assert body == original
+        if rewrites:
+            rewritten += 1
+        else:
+            assert optimized is body
+        assert search(optimized, params, docs) == search(body, params, docs), (body, optimized)
+    assert rewritten > 500
+
+
+def test_rewrites():
+    term = {'term': {'to': '0x1'}}
+    sender = {'term': {'from': '0x2'}}
+
+    body = dict(filtered_query(must=[term]), size=0, sort={'blockNumber.num': 'desc'})
+    optimized, rewrites = optimize(body)
+    assert optimized == {'query': {'bool': {'filter': [term]}}, 'size': 0}
+    assert rewrites == [DROP_EMPTY_CLAUSES, DROP_SORT, FILTER_CONTEXT]
+
+    body = {
+        'query': {'bool': {'filter': [{'bool': {'filter': [term], 'must_not': [sender]}}]}},
+        'sort': {'blockNumber.num': 'desc'},
+    }
+    optimized, rewrites = optimize(body)
+    assert optimized['query'] == {'bool': {'filter': [term], 'must_not': [sender]}}
+    assert optimized['sort'] == body['sort']
+    assert rewrites == [FLATTEN_BOOL]
+
+    body = {'query': {'bool': {'must': {'bool': {'must': [term]}}}}}
+    assert optimize(body) == ({'query': term}, [UNWRAP_BOOL])
+
+    # Scores are read.
+    for body in (
+            {'query': {'bool': {'must': [term, sender]}}},
+            {'query': {'bool': {'must': [term, sender]}}, 'size': 0, 'min_score': 2},
+            {'query': {'bool': {'must': [term, sender]}}, 'sort': ['_score']},
+            {'query': {'bool': {'must': [term, sender]}}, 'size': 0, 'rescore': {
+                'query': {'rescore_query': term}
+            }},
+            {'query': {'bool': {'must': [term, sender]}}, 'size': 0, 'aggs': {
+                'a': {'terms': {'field': 'to'}, 'aggs': {'top': {'top_hits': {}}}}
+            }},
+    ):
+        assert optimize(body) == (body, [])
+
+    # Optional `should` clauses would be required in filter context, the inner `bool` stays
+    # in query context.
+    body = {'query': {'bool': {'must': [{'bool': {'must': [term], 'should': [sender]}}]}}}
+    optimized, _ = optimize(dict(body, size=0))
+    assert optimized['query'] == {'bool': {'filter': [term], 'should': [sender]}}
+
+
+def test_backend_optimizes():
+    term = {'term': {'to': '0x1'}}
+    backend = ElasticsearchBackend(None)
+    body = {'query': {'bool': {'must': [term]}}, 'size': 0}
+    assert backend.rewrites('_search', body) == [FILTER_CONTEXT]
+    assert backend.rewrites('_search', body, {'size': '10'}) == [UNWRAP_BOOL]
+    assert backend.rewrites('_count', {'query': {'bool': {'must': [term, term]}}}) == [
+        FILTER_CONTEXT
+    ]
+
+    # Searches of an `_msearch` with its parameters.
+    es = mock.Mock()
+    es.msearch.return_value = {'responses': [{'took': 1}]}
+    backend = ElasticsearchBackend(es)
+    backend.msearch_items([({}, body)], size='10')
+    _, kwargs = es.msearch.call_args
+    assert json.loads(kwargs['body'][1])['query'] == term
+
+    backend = ElasticsearchBackend(None, optimize_queries=False)
+    assert backend.rewrites('_search', body) == []
+    assert backend.optimize(body) == (body, [])
@@ -1,11 +1,13 @@
 import time
 from _pytest.monkeypatch import MonkeyPatch
 from elasticsearch import Elasticsearch
+import requests
 
 from ethevents import App
 from ethevents.client.proxy import run_proxy
 from ethevents.server.api_server import APIServer
 from ethevents.server.backend import ElasticsearchBackend, Resource
+from ethevents.server.compression import CompressedContent, GzipCodec
 
 
 def test_proxy(
@@ -33,3 +35,35 @@ def test_proxy(
 
     proxy.stop()
     proxy_greenlet.join()
+
+
+def test_proxy_compressed(
+        monkeypatch: MonkeyPatch,
+        api_server: APIServer,
+        initialized_client_app: App,
+        api_endpoint_address: str
+):
+    app = initialized_client_app
+
+    def search_patched(*args, **kwargs):
+        content = CompressedContent.compress({'something': 1}, GzipCodec())
+        return Resource(content, 5, time.time() + 30)
+
+    monkeypatch.setattr(ElasticsearchBackend, 'search', search_patched)
+
+    proxy, proxy_greenlet, _ = run_proxy(
+        client_app=app,
+        endpoint_url='http://' + api_endpoint_address
+    )
+
+    # Delivered gzipped to the proxy, which forwards the decoded body.
+    response = requests.get(
+        'http://localhost:5478/ethereum/_search',
+        json={'getme': 'anything'},
+        headers={'Accept-Encoding': 'gzip'}
+    )
+    assert 'Content-Encoding' not in response.headers
+    assert response.json() == {'something': 1}
+
+    proxy.stop()
+    proxy_greenlet.join()
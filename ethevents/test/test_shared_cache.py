@@ -0,0 +1,134 @@
+import os
+
+import pytest
+
+from ethevents.server.backend import Resource
+from ethevents.server.cache import ResourceCache
+from ethevents.server.shared_cache import (
+    RedisCache,
+    SqliteCache,
+    TieredCache,
+    deserialize_resource,
+    serialize_resource,
+)
+
+
+class FakeClock(object):
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_serialization():
+    resource = Resource(content={'took': 3, 'hits': {'hits': []}}, price=3, expires_at=12.5)
+    assert deserialize_resource(serialize_resource(resource)) == resource
+
+    tagged = resource._replace(block_height=5000000, finalized=True)
+    assert deserialize_resource(serialize_resource(tagged)) == tagged
+
+    raw = Resource(content=b'{"took":3}', price=3, expires_at=12.5)
+    assert deserialize_resource(serialize_resource(raw)) == raw
+
+
+def test_sqlite_cache_is_shared(tmpdir):
+    path = os.path.join(str(tmpdir), 'cache.sqlite')
+    worker_a = SqliteCache(path)
+    worker_b = SqliteCache(path)
+
+    resource = Resource(content={'took': 7}, price=7, expires_at=float('inf'))
+    worker_a.put('key', resource)
+
+    assert 'key' in worker_b
+    assert worker_b.get('key') == resource
+    assert worker_b.pop('key') == resource
+    assert worker_a.get('key') is None
+    assert worker_a.size == 0
+
+
+def test_sqlite_cache_reads_do_not_write(tmpdir):
+    path = os.path.join(str(tmpdir), 'cache.sqlite')
+    worker_a = SqliteCache(path)
+    worker_b = SqliteCache(path)
+    resource = Resource(content={'took': 7}, price=7, expires_at=float('inf'))
+    worker_a.put('key', resource)
+
+    # Hits are not held up by a write in another worker.
+    worker_b.db.execute('BEGIN IMMEDIATE')
+    try:
+        assert worker_a.get('key') == resource
+    finally:
+        worker_b.db.execute('ROLLBACK')
+    worker_a.expire()
+    assert not worker_a.accessed
+
+
+def test_sqlite_cache_expiry_and_budget(tmpdir):
+    clock = FakeClock()
+    entry = Resource(content='x' * 20, price=1, expires_at=float('inf'))
+    max_bytes = 3 * len(serialize_resource(entry))
+    cache = SqliteCache(
+        os.path.join(str(tmpdir), 'cache.sqlite'),
+        max_bytes=max_bytes,
+        clock=clock
+    )
+
+    cache.put('expiring', Resource(content='x', price=1, expires_at=clock.now + 10))
+    clock.now += 20
+    assert cache.get('expiring', ignore_expiry=True) is not None
+    assert cache.get('expiring') is None
+    assert len(cache) == 0
+
+    for key in 'abc':
+        cache.put(key, entry)
+        clock.now += 1
+    assert cache.get('a') is not None
+    clock.now += 1
+    cache.put('d', entry)
+
+    assert cache.size <= max_bytes
+    assert 'b' not in cache
+    assert 'a' in cache and 'd' in cache
+    assert cache.stats()['evictions'] >= 1
+
+
+def test_redis_cache():
+    fakeredis = pytest.importorskip('fakeredis')
+    client = fakeredis.FakeStrictRedis()
+    worker_a = RedisCache(client=client)
+    worker_b = RedisCache(client=client)
+
+    resource = Resource(content={'took': 7}, price=7, expires_at=float('inf'))
+    worker_a.put('key', resource)
+    assert worker_b.get('key') == resource
+    assert len(worker_b) == 1
+    assert worker_b.pop('key') == resource
+    assert worker_a.get('key') is None
+
+
+def test_tiered_cache_survives_restart(tmpdir):
+    path = os.path.join(str(tmpdir), 'disk.sqlite')
+    cache = TieredCache(ResourceCache(), SqliteCache(path))
+    finalized = Resource(content={'took': 9}, price=9, expires_at=float('inf'), finalized=True)
+    recent = Resource(content={'took': 1}, price=1, expires_at=float('inf'), block_height=100)
+    cache.put('finalized', finalized)
+    cache.put('popular', finalized)
+    cache.put('recent', recent)
+    for _ in range(3):
+        assert cache.get('popular') == finalized
+    assert cache.get('recent') == recent
+    cache.close()
+
+    # Only finalized results are kept, and only loaded once they are requested.
+    restarted = TieredCache(ResourceCache(), SqliteCache(path))
+    assert len(restarted) == 0
+    assert restarted.get('recent') is None
+    assert restarted.get('finalized') == finalized
+    assert len(restarted) == 1
+    assert restarted.stats()['disk_hits'] == 1
+
+    warmed_up = TieredCache(ResourceCache(), SqliteCache(path))
+    assert warmed_up.warm_up(1) == 1
+    assert 'popular' in warmed_up.memory
+    assert 'finalized' not in warmed_up.memory
@@ -0,0 +1,166 @@
+import glob
+import json
+import os
+
+import pytest
+from werkzeug.exceptions import BadRequest, MethodNotAllowed
+
+from ethevents.examples import queries
+from ethevents.server.backend import filtered_query, sanitize
+from ethevents.server.validation import (
+    MAX_BUCKETS,
+    MAX_RESULT_WINDOW,
+    InvalidQuery,
+    ScriptRejected,
+    validate_search,
+)
+
+EXAMPLES_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'docs', 'example-queries')
+
+
+def nested_bool(depth: int) -> dict:
+    query = {'match_all': {}}
+    for _ in range(depth):
+        query = {'bool': {'must': [query]}}
+    return query
+
+
+def terms(size: int, **aggs) -> dict:
+    agg = {'terms': {'field': 'address', 'size': size}}
+    if aggs:
+        agg['aggs'] = aggs
+    return agg
+
+
+def test_example_queries():
+    for body in (
+            queries.gas_prices_query(),
+            queries.common_event_topics(),
+            queries.gas_prices_for_event(),
+            queries.caller_for_event(),
+            queries.last_transactions_to(),
+            queries.last_blocks_with_address(),
+            queries.last_blocks_that_logged(),
+    ):
+        validate_search(body)
+    validate_search(None, {'size': '10', 'from': '20'})
+    validate_search(filtered_query(filter=[{'term': {'to': '0x1'}}]))
+
+    for filename in glob.glob(os.path.join(EXAMPLES_DIR, '**', '*.json'), recursive=True):
+        with open(filename) as f:
+            validate_search(json.load(f))
+
+
+def test_highlight_and_rescore():
+    term = {'term': {'to': '0x1'}}
+    validate_search({'query': term, 'highlight': {
+        'fields': {'input': {}, 'to': {'highlight_query': term, 'number_of_fragments': 0}},
+        'pre_tags': ['<b>'],
+    }})
+    validate_search({'query': term, 'highlight': {'fields': [{'input': {}}]}})
+    rescore = {'window_size': 50, 'query': {'rescore_query': term, 'query_weight': 0.5}}
+    validate_search({'query': term, 'rescore': rescore})
+    validate_search({'query': term, 'rescore': [rescore, {'query': {'rescore_query': term}}]})
+
+    for body in (
+            {'highlight': {'fields': {'input': {'highlight_query': {'script': {}}}}}},
+            {'highlight': {'script_fields': {}}},
+            {'rescore': {'query': {'rescore_query': {'function_score': {}}}}},
+            {'rescore': [rescore, {'query': {'rescore_query': {'script': {}}}}]},
+    ):
+        with pytest.raises(ScriptRejected):
+            validate_search(body)
+    for body in (
+            {'highlight': {'highlight_query': {'regexp': {'input': '.*'}}}},
+            {'highlight': {'fields': 'input'}},
+            {'rescore': {'learning_to_rank': {}}},
+            {'rescore': {'query': {'rescore_query': term}, 'window_size': MAX_RESULT_WINDOW + 1}},
+            {'rescore': {'query': {'query_weight': 1}}},
+    ):
+        with pytest.raises(InvalidQuery):
+            validate_search(body)
+
+
+def test_values_are_not_inspected():
+    validate_search({'query': {'bool': {'filter': [
+        {'term': {'input': 'script'}},
+        {'match': {'to': {'query': 'lang', 'operator': 'and'}}},
+    ]}}})
+
+
+def test_scripts():
+    for body in (
+            {'query': {'script': {'script': {'source': '1', 'lang': 'painless'}}}},
+            {'query': {'bool': {'filter': {'function_score': {}}}}},
+            {'aggs': {'a': {'terms': {'script': {'source': 'doc.x'}}}}},
+            {'aggs': {'a': {'scripted_metric': {}}}},
+            {'aggs': {'a': {'top_hits': {'script_fields': {}}}}},
+            {'query': {'has_child': {'type': 'tx', 'inner_hits': {'script_fields': {}}}}},
+            {'script_fields': {'x': {'script': '1'}}},
+            {'sort': [{'_script': {'script': '1'}}]},
+    ):
+        with pytest.raises(ScriptRejected):
+            validate_search(body)
+
+
+def test_limits():
+    validate_search({'query': nested_bool(30)})
+    with pytest.raises(InvalidQuery):
+        validate_search({'query': nested_bool(40)})
+
+    validate_search({'size': MAX_RESULT_WINDOW})
+    for body, params in (
+            ({'size': MAX_RESULT_WINDOW, 'from': 1}, None),
+            ({'size': -1}, None),
+            ({'size': 'many'}, None),
+            (None, {'size': str(MAX_RESULT_WINDOW + 1)}),
+    ):
+        with pytest.raises(InvalidQuery):
+            validate_search(body, params)
+
+    # 100 topics with 99 contracts each.
+    validate_search({'aggs': {'topic': terms(100, contract=terms(99))}})
+    with pytest.raises(InvalidQuery):
+        validate_search({'aggs': {'topic': terms(100, contract=terms(100))}})
+    with pytest.raises(InvalidQuery):
+        validate_search({'aggs': {'a': {'histogram': {
+            'field': 'gasPrice.num',
+            'interval': 1,
+            'min_doc_count': 0,
+            'extended_bounds': {'min': 0, 'max': MAX_BUCKETS},
+        }}}})
+    with pytest.raises(InvalidQuery):
+        validate_search({'aggs': {'a': {'top_hits': {'size': 1000}}}})
+
+    join = {'has_child': {'type': 'tx', 'query': {
+        'has_child': {'type': 'log', 'query': {'match_all': {}}}
+    }}}
+    validate_search({'query': join})
+    with pytest.raises(InvalidQuery):
+        validate_search({'query': {'has_parent': {'parent_type': 'block', 'query': join}}})
+
+
+def test_allow_list():
+    for body in (
+            [],
+            {'query': {'regexp': {'input': '.*'}}},
+            {'query': {'match_all': {}, 'term': {'to': '0x1'}}},
+            {'query': {'bool': {'must': [], 'inner_hits': {}}}},
+            {'aggs': {'a': {'avg': {'field': 'gas'}, 'aggs': {'b': terms(1)}}}},
+            {'aggs': {'a': {'filter': {'wildcard': {'input': '*'}}}}},
+            {'suggest': {}},
+            {'collapse': {'field': 'to', 'inner_hits': {}}},
+    ):
+        with pytest.raises(InvalidQuery):
+            validate_search(body)
+
+
+def test_sanitize():
+    assert sanitize({'index': 'other', 'body': {'size': 1}}) == {
+        'index': 'ethereum',
+        'body': {'size': 1},
+    }
+    with pytest.raises(MethodNotAllowed):
+        sanitize({'body': {'query': {'script': {}}}})
+    with pytest.raises(BadRequest):
+        sanitize({'body': {'size': 1}, 'from': MAX_RESULT_WINDOW})